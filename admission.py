@@ -0,0 +1,339 @@
+"""
+In-process admission control and load shedding.
+
+When a cohort starts sessions at the same time every request slows down
+together, including the tool calls Ultravox makes mid-conversation. Every
+route has a priority class instead:
+
+    critical: tool callbacks, which the agent is waiting on while it talks
+    high: creating calls, which starts a session
+    normal: everything not classified otherwise
+    low: listing summaries, exports and the waitlist
+
+At most ``max_concurrency`` requests are handled at once, and some routes
+have a lower limit of their own. Requests over a limit wait, and a free slot
+goes to the highest priority class first. A request that waits longer than
+its class's queue-time target is shed with a 503 and Retry-After, and while
+the queue of its class and above is already older than that target, a new
+request is shed on arrival rather than after waiting. Health and monitoring
+routes are exempt.
+
+Clients can also be rate limited with a token bucket each, except for the
+critical routes, whose requests all come from Ultravox. A rate limited
+request gets a 429 with Retry-After.
+
+Shed and rate limited requests are counted in admission_shed_total.
+"""
+
+import asyncio
+import itertools
+import math
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+from fastapi.responses import ORJSONResponse
+from fastapi.routing import APIRoute
+
+from metrics import ADMISSION_QUEUE_SECONDS, ADMISSION_SHED, ADMISSION_WAITING, InstrumentedRoute
+
+# Priority classes, lower is more urgent. Routes classified as EXEMPT are never queued or shed.
+CRITICAL, HIGH, NORMAL, LOW = 0, 1, 2, 3
+EXEMPT = None
+PRIORITY_NAMES = {CRITICAL: "critical", HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+# Seconds a request of each class may wait for a slot
+DEFAULT_QUEUE_TARGETS = {CRITICAL: 5.0, HIGH: 2.0, NORMAL: 1.0, LOW: 0.25}
+
+
+class Shed(Exception):
+    """
+    Raised when a request is turned away, with the response to send
+    """
+
+    def __init__(self, status_code: int, retry_after: float, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+    def response(self) -> ORJSONResponse:
+        message = "Too many requests" if self.status_code == 429 else "Server is busy"
+        return ORJSONResponse(
+            content={"error": f"{message}, please try again later"},
+            status_code=self.status_code,
+            headers={"Retry-After": str(max(1, math.ceil(self.retry_after)))},
+        )
+
+
+class TokenBuckets:
+    """
+    A token bucket per client, refilled at ``rate`` tokens a second up to ``burst``
+
+        Args:
+            rate: Requests per second a client may make on average
+            burst: Requests a client may make at once
+            max_clients: Buckets kept before the full ones are dropped, a full bucket being
+                the same as none
+    """
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._clock = clock
+        self._buckets: Dict[str, List[float]] = {}
+
+    def take(self, client: str) -> float:
+        """
+        Takes a token from the client's bucket, returning 0, or the seconds until one is available
+        """
+        now = self._clock()
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            if len(self._buckets) >= self.max_clients:
+                self._prune(now)
+            bucket = self._buckets[client] = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return (1 - tokens) / self.rate
+        bucket[0] = tokens - 1
+        return 0.0
+
+    def _prune(self, now: float) -> None:
+        self._buckets = {
+            client: bucket for client, bucket in self._buckets.items()
+            if bucket[0] + (now - bucket[1]) * self.rate < self.burst
+        }
+
+
+class _Waiter:
+    __slots__ = ("priority", "sequence", "route", "enqueued_at", "future")
+
+    def __init__(self, priority: int, sequence: int, route: str, enqueued_at: float, future: asyncio.Future):
+        self.priority = priority
+        self.sequence = sequence
+        self.route = route
+        self.enqueued_at = enqueued_at
+        self.future = future
+
+
+class AdmissionController:
+    """
+    Decides which requests are handled now, which wait and which are shed.
+    Must only be used from the event loop.
+
+        Args:
+            priorities: Priority class by route, as "METHOD /path/template"
+            max_concurrency: Requests handled at once, exempt routes not included
+            route_limits: Lower limits for some routes, by route
+            queue_targets: Seconds a request may wait for a slot, by priority class
+            rate_limits: Optional per-client token buckets, for every class but critical
+            client_header: Header naming the client for rate limits, e.g. one a trusted proxy sets.
+                The peer address otherwise.
+    """
+
+    def __init__(
+        self,
+        priorities: Dict[str, Optional[int]],
+        max_concurrency: int = 64,
+        route_limits: Optional[Dict[str, int]] = None,
+        queue_targets: Optional[Dict[int, float]] = None,
+        rate_limits: Optional[TokenBuckets] = None,
+        client_header: Optional[str] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.priorities = priorities
+        self.max_concurrency = max_concurrency
+        self.route_limits = route_limits or {}
+        self.queue_targets = {**DEFAULT_QUEUE_TARGETS, **(queue_targets or {})}
+        self.rate_limits = rate_limits
+        self.client_header = client_header.lower().encode("latin-1") if client_header else None
+        self._clock = clock
+        self.in_flight = 0
+        self._route_in_flight: Dict[str, int] = {}
+        self._waiters: List[_Waiter] = []
+        self._sequence = itertools.count()
+
+    @classmethod
+    def from_env(cls, priorities: Dict[str, Optional[int]], route_limits: Optional[Dict[str, int]] = None) -> "AdmissionController":
+        """
+        Creates a controller configured by the environment:
+
+            ADMISSION_MAX_CONCURRENCY: Requests handled at once (64)
+            ADMISSION_ROUTE_LIMITS: Route limits on top of route_limits, e.g. "GET /summaries=8,GET /export/sessions=2"
+            ADMISSION_QUEUE_TARGETS: Queue-time targets in milliseconds, e.g. "low=250,normal=1000"
+            RATE_LIMIT_PER_SECOND: Requests per second per client, 0 for no rate limits (0)
+            RATE_LIMIT_BURST: Requests a client may make at once (twice the rate)
+            RATE_LIMIT_CLIENT_HEADER: Header naming the client
+        """
+        limits = dict(route_limits or {})
+        for item in filter(None, os.getenv("ADMISSION_ROUTE_LIMITS", "").split(",")):
+            route, limit = item.rsplit("=", 1)
+            limits[route.strip()] = int(limit)
+        names = {name: priority for priority, name in PRIORITY_NAMES.items()}
+        targets = {}
+        for item in filter(None, os.getenv("ADMISSION_QUEUE_TARGETS", "").split(",")):
+            name, milliseconds = item.split("=", 1)
+            targets[names[name.strip()]] = float(milliseconds) / 1000
+        rate = float(os.getenv("RATE_LIMIT_PER_SECOND", "0"))
+        rate_limits = TokenBuckets(rate, float(os.getenv("RATE_LIMIT_BURST", str(rate * 2)))) if rate > 0 else None
+        return cls(
+            priorities,
+            max_concurrency=int(os.getenv("ADMISSION_MAX_CONCURRENCY", "64")),
+            route_limits=limits,
+            queue_targets=targets,
+            rate_limits=rate_limits,
+            client_header=os.getenv("RATE_LIMIT_CLIENT_HEADER") or None,
+        )
+
+    def priority(self, route: str) -> Optional[int]:
+        return self.priorities.get(route, NORMAL)
+
+    def _client(self, scope) -> str:
+        if self.client_header is not None:
+            for name, value in scope.get("headers", ()):
+                if name == self.client_header:
+                    return value.decode("latin-1").split(",")[0].strip()
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    def _has_room(self, route: str) -> bool:
+        if self.in_flight >= self.max_concurrency:
+            return False
+        limit = self.route_limits.get(route)
+        return limit is None or self._route_in_flight.get(route, 0) < limit
+
+    def _start(self, route: str) -> None:
+        self.in_flight += 1
+        self._route_in_flight[route] = self._route_in_flight.get(route, 0) + 1
+
+    def _shed(self, route: str, priority: int, exc: Shed) -> Shed:
+        ADMISSION_SHED.inc((route, PRIORITY_NAMES[priority], exc.reason))
+        return exc
+
+    def _oldest_wait(self, priority: int, now: float) -> float:
+        """
+        How long the oldest request of this class or a more urgent one has waited
+        """
+        waits = [now - waiter.enqueued_at for waiter in self._waiters if waiter.priority <= priority]
+        return max(waits, default=0.0)
+
+    async def admit(self, route: str, scope) -> bool:
+        """
+        Waits until the request may be handled. Returns False for exempt routes, which aren't
+        counted and must not be released, and True otherwise.
+
+            Raises:
+                Shed: If the request is rate limited or waited longer than its queue-time target
+        """
+        priority = self.priority(route)
+        if priority is EXEMPT:
+            return False
+
+        if self.rate_limits is not None and priority != CRITICAL:
+            wait = self.rate_limits.take(self._client(scope))
+            if wait > 0:
+                raise self._shed(route, priority, Shed(429, wait, "rate_limited"))
+
+        # Waiters are handed slots as soon as they free up, so any still waiting are held by a route limit
+        if self._has_room(route):
+            self._start(route)
+            ADMISSION_QUEUE_SECONDS.observe((PRIORITY_NAMES[priority],), 0.0)
+            return True
+
+        target = self.queue_targets[priority]
+        now = self._clock()
+        if self._oldest_wait(priority, now) > target:
+            # The queue is already behind its target, waiting would only make it worse
+            raise self._shed(route, priority, Shed(503, target, "queue_backlog"))
+
+        waiter = _Waiter(priority, next(self._sequence), route, now, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._waiters.sort(key=lambda waiter: (waiter.priority, waiter.sequence))
+        labels = (PRIORITY_NAMES[priority],)
+        ADMISSION_WAITING.inc(labels)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), target)
+        except asyncio.TimeoutError:
+            if not waiter.future.done():
+                self._waiters.remove(waiter)
+                waiter.future.cancel()
+                raise self._shed(route, priority, Shed(503, target, "queue_timeout"))
+        except asyncio.CancelledError:
+            # The client went away while waiting, or just after it was given a slot
+            if waiter.future.done():
+                self.release(route)
+            else:
+                self._waiters.remove(waiter)
+                waiter.future.cancel()
+            raise
+        finally:
+            ADMISSION_WAITING.dec(labels)
+        ADMISSION_QUEUE_SECONDS.observe(labels, self._clock() - waiter.enqueued_at)
+        return True
+
+    def release(self, route: str) -> None:
+        """
+        Frees the slot of a request that was admitted, and gives it to the most urgent waiter that fits
+        """
+        self.in_flight -= 1
+        self._route_in_flight[route] -= 1
+        for waiter in list(self._waiters):
+            if self.in_flight >= self.max_concurrency:
+                break
+            if self._has_room(waiter.route):
+                self._waiters.remove(waiter)
+                self._start(waiter.route)
+                waiter.future.set_result(None)
+
+    def stats(self) -> dict:
+        waiting: Dict[str, int] = {}
+        for waiter in self._waiters:
+            name = PRIORITY_NAMES[waiter.priority]
+            waiting[name] = waiting.get(name, 0) + 1
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "waiting": waiting,
+            "rate_limited_clients": len(self.rate_limits._buckets) if self.rate_limits is not None else 0,
+        }
+
+
+_controller: Optional[AdmissionController] = None
+
+
+def set_controller(controller: Optional[AdmissionController]) -> None:
+    global _controller
+    _controller = controller
+
+
+class AdmissionRoute(APIRoute):
+    """
+    Route class that goes through the admission controller set with set_controller before handling a request
+    """
+
+    async def handle(self, scope, receive, send) -> None:
+        controller = _controller
+        if controller is None:
+            await super().handle(scope, receive, send)
+            return
+        route = f"{scope['method']} {self.path}"
+        try:
+            admitted = await controller.admit(route, scope)
+        except Shed as e:
+            await e.response()(scope, receive, send)
+            return
+        try:
+            await super().handle(scope, receive, send)
+        finally:
+            if admitted:
+                controller.release(route)
+
+
+class InstrumentedAdmissionRoute(InstrumentedRoute, AdmissionRoute):
+    """
+    Counted and timed like InstrumentedRoute, requests that were shed included, then admitted
+    """
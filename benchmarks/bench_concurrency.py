@@ -0,0 +1,55 @@
+"""
+Concurrency benchmark for the Firestore-backed tool endpoints.
+
+Fires 200 concurrent tool calls at the app with Firestore replaced by an
+in-memory stand-in that takes ``--latency`` ms per round trip. The "blocking"
+run makes each round trip stall the event loop, like calling the synchronous
+client from an async handler did; the "async" run awaits it.
+
+    python -m benchmarks.bench_concurrency --latency 5
+"""
+
+import argparse
+import asyncio
+from unittest.mock import patch
+
+from benchmarks.common import load_app, run_concurrent
+from fakes import FakeFirestore
+from storage import FirestoreStore
+
+
+def tool_calls(count: int) -> list:
+    requests = []
+    for i in range(count):
+        session_id = f"bench_session_{i % 20}"
+        if i % 2:
+            requests.append(("POST", "/sessions/tasks", {"session_id": session_id, "task": f"Task {i}"}))
+        else:
+            requests.append((
+                "POST",
+                "/sessions/cognitive-distortions",
+                {"session_id": session_id, "cognitiveDistortions": [f"Distortion {i}"]},
+            ))
+    return requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=5.0, help="Firestore round trip latency in ms")
+    args = parser.parse_args()
+
+    app_module = load_app()
+    for label, blocking in (("blocking", True), ("async", False)):
+        fake = FakeFirestore(latency=args.latency / 1000, blocking=blocking)
+        with patch.object(app_module, "store", FirestoreStore(fake)):
+            result = asyncio.run(run_concurrent(app_module.app, tool_calls(args.calls), concurrency=args.calls))
+        print(
+            f"{label:>8}: {result['requests_per_s']:8.1f} req/s  "
+            f"p50 {result['p50_ms']:7.1f} ms  p99 {result['p99_ms']:7.1f} ms  "
+            f"statuses {result['statuses']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Import time of the ``main`` module, which every cold start pays before the
+first request is served.
+
+Imports it in a fresh interpreter with ``-X importtime`` and reports the
+cumulative time and the slowest modules. test_import_time.py runs the same
+measurement against IMPORT_BUDGET_MS.
+
+    python -m benchmarks.bench_import --top 15
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Milliseconds, overridable with IMPORT_BUDGET_MS for slower machines
+IMPORT_BUDGET_MS = 1500.0
+
+
+def parse_importtime(stderr: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Parses ``-X importtime`` output into {module: (self_us, cumulative_us)}
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def measure_import(module: str = "main", env: Dict[str, str] = None) -> Tuple[Dict[str, Tuple[int, int]], str]:
+    """
+    Imports module in a fresh interpreter and returns its importtime breakdown and what it printed.
+    Credentials point nowhere, so an import that reads them fails.
+    """
+    run_env = dict(os.environ)
+    run_env.pop("STORAGE_BACKEND", None)
+    run_env["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.join(ROOT, "missing-credentials.json")
+    run_env.update(env or {})
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, env=run_env, capture_output=True, text=True, check=False,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr), result.stdout
+
+
+def best_of(runs: int, module: str = "main") -> Tuple[float, Dict[str, Tuple[int, int]]]:
+    """
+    Returns the fastest cumulative import time in milliseconds of a few runs, and that run's breakdown
+    """
+    best = None
+    for _ in range(runs):
+        modules, _ = measure_import(module)
+        total_ms = modules[module][1] / 1000
+        if best is None or total_ms < best[0]:
+            best = (total_ms, modules)
+    return best
+
+
+def slowest(modules: Dict[str, Tuple[int, int]], top: int) -> List[Tuple[str, int]]:
+    """
+    Returns the top-level packages that took the longest, with their cumulative microseconds
+    """
+    packages = {}
+    for name, (_, cumulative_us) in modules.items():
+        package = name.split(".")[0]
+        packages[package] = max(packages.get(package, 0), cumulative_us)
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    budget_ms = float(os.getenv("IMPORT_BUDGET_MS", IMPORT_BUDGET_MS))
+    total_ms, modules = best_of(args.runs)
+    print(f"import main: {total_ms:.1f} ms (best of {args.runs}), budget {budget_ms:.0f} ms: {'ok' if total_ms < budget_ms else 'OVER'}")
+    for package, cumulative_us in slowest(modules, args.top):
+        print(f"  {package:<30} {cumulative_us / 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
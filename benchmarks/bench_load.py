@@ -0,0 +1,316 @@
+"""
+Hermetic load test of the whole API.
+
+Boots the app, lifespan included, with every dependency replaced by a local
+fake from fakes.py: an in-memory Firestore, a fake Ultravox /api/calls
+server, a fake Exa client and a local SMTP sink. Each takes a latency and a
+failure rate, so the API can be loaded without production credentials and
+under the dependency behaviour of your choice.
+
+The traffic is a mix of voice sessions run concurrently. A session creates
+its call, makes a few tool calls while the frontend polls the session's data,
+saves its summary and sometimes emails the insights; now and then someone
+lists the summaries. ``--backend sqlite`` or ``memory`` stores the data with
+SQLiteStore instead of the fake Firestore, to compare backends. Throughput and p50/p95/p99 latency are reported per
+endpoint and saved as JSON, and ``--compare`` checks them against an earlier
+run, exiting with 1 if any endpoint's p95 regressed by more than
+``--tolerance``.
+
+    python -m benchmarks.bench_load --sessions 200 --concurrency 50
+    python -m benchmarks.bench_load --firestore-ms 20 --ultravox-failure-rate 0.05
+    python -m benchmarks.bench_load --backend sqlite
+    python -m benchmarks.bench_load --compare benchmarks/results/baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+from unittest.mock import patch
+
+import httpx
+
+from benchmarks.common import load_app, percentile
+from cache import TTLCache, TwoTierCache
+from fakes import FakeExa, FakeFirestore, FakeSMTPServer, FakeUltravoxServer
+from mailer import Mailer
+from outbox import Outbox
+from sqlite_store import SQLiteStore
+from storage import FirestoreStore
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+# Queries the agent searches resources for, few enough that the cache gets hits like in production
+QUERIES = [
+    "breathing exercises for anxiety",
+    "how to stop catastrophizing",
+    "sleep hygiene tips",
+    "grounding techniques for panic attacks",
+    "journaling prompts for negative thoughts",
+    "how to deal with work stress",
+    "mindfulness for beginners",
+    "challenging all or nothing thinking",
+]
+DISTORTIONS = ["Catastrophizing", "All-or-nothing thinking", "Mind reading", "Overgeneralization", "Labeling"]
+
+# Weights of what the agent does on each turn of a session
+TOOL_WEIGHTS = {"tasks": 0.4, "cognitive-distortions": 0.35, "resources": 0.25}
+
+
+class Recorder:
+    """
+    Latencies and statuses of the requests sent, per endpoint
+    """
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def add(self, endpoint: str, latency: float, ok: bool) -> None:
+        self.latencies.setdefault(endpoint, []).append(latency)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self, elapsed: float) -> dict:
+        endpoints = {}
+        everything = []
+        for endpoint, latencies in sorted(self.latencies.items()):
+            everything.extend(latencies)
+            endpoints[endpoint] = summarize(latencies, self.errors.get(endpoint, 0), elapsed)
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "total": summarize(everything, sum(self.errors.values()), elapsed),
+            "endpoints": endpoints,
+        }
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_s": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def send(client: httpx.AsyncClient, recorder: Recorder, endpoint: str, method: str, url: str, body: Optional[dict] = None) -> httpx.Response:
+    """
+    Sends a request and records it under its endpoint template. 5xx answers count as errors,
+    except the 503 that tells the agent resources aren't available right now.
+    """
+    started = time.perf_counter()
+    response = await client.request(method, url, json=body)
+    ok = response.status_code < 500 or (endpoint == "POST /sessions/resources" and response.status_code == 503)
+    recorder.add(endpoint, time.perf_counter() - started, ok)
+    return response
+
+
+async def voice_session(client: httpx.AsyncClient, recorder: Recorder, session_id: str, rng: random.Random, think: float) -> None:
+    async def pause():
+        if think:
+            await asyncio.sleep(rng.uniform(0.5, 1.5) * think)
+
+    await send(client, recorder, "POST /sessions/{session_id}/calls", "POST", f"/sessions/{session_id}/calls")
+    tasks = []
+    for turn in range(rng.randint(3, 8)):
+        await pause()
+        tool = rng.choices(list(TOOL_WEIGHTS), weights=list(TOOL_WEIGHTS.values()))[0]
+        if tool == "tasks":
+            task = f"Task {turn} for {session_id}"
+            tasks.append(task)
+            await send(client, recorder, "POST /sessions/tasks", "POST", "/sessions/tasks",
+                       {"session_id": session_id, "task": task})
+        elif tool == "cognitive-distortions":
+            await send(client, recorder, "POST /sessions/cognitive-distortions", "POST", "/sessions/cognitive-distortions",
+                       {"session_id": session_id, "cognitiveDistortions": rng.sample(DISTORTIONS, rng.randint(1, 2))})
+        else:
+            await send(client, recorder, "POST /sessions/resources", "POST", "/sessions/resources",
+                       {"session_id": session_id, "query": rng.choice(QUERIES)})
+
+        # The frontend polls what the tool call changed, through the bundle or the single endpoints
+        if rng.random() < 0.5:
+            await send(client, recorder, "GET /sessions/{session_id}/bundle", "GET", f"/sessions/{session_id}/bundle")
+        else:
+            await send(client, recorder, "GET /sessions/{session_id}/tasks", "GET", f"/sessions/{session_id}/tasks")
+            await send(client, recorder, "GET /sessions/{session_id}/cognitive-distortions", "GET",
+                       f"/sessions/{session_id}/cognitive-distortions")
+
+    await pause()
+    await send(client, recorder, "POST /sessions/summary", "POST", "/sessions/summary", {
+        "session_id": session_id,
+        "conversationSummary": f"Summary of {session_id}",
+        "identifiedCognitiveDistortions": rng.sample(DISTORTIONS, 2),
+        "suggestedExercises": "Breathing exercises",
+    })
+    if rng.random() < 0.3:
+        await send(client, recorder, "POST /emails", "POST", "/emails", {
+            "email_address": f"{session_id}@example.com",
+            "insights": {"summary": f"Summary of {session_id}", "tasks": tasks, "topics": DISTORTIONS[:2]},
+        })
+    if rng.random() < 0.2:
+        await send(client, recorder, "GET /summaries", "GET", "/summaries?limit=20")
+
+
+@contextmanager
+def hermetic_app(args: argparse.Namespace) -> Iterator[dict]:
+    """
+    Imports the app and points every dependency at a fake. Yields the app module and the fakes.
+    """
+    app_module = load_app()
+    with ExitStack() as stack:
+        ultravox_server = stack.enter_context(FakeUltravoxServer(
+            latency=args.ultravox_ms / 1000, failure_rate=args.ultravox_failure_rate, seed=args.seed
+        ))
+        smtp_server = stack.enter_context(FakeSMTPServer(
+            latency=args.smtp_ms / 1000, failure_rate=args.smtp_failure_rate, seed=args.seed
+        ))
+        firestore = FakeFirestore(latency=args.firestore_ms / 1000, failure_rate=args.firestore_failure_rate, seed=args.seed)
+        exa = FakeExa(latency=args.exa_ms / 1000, failure_rate=args.exa_failure_rate, seed=args.seed)
+        workdir = stack.enter_context(tempfile.TemporaryDirectory())
+
+        stack.enter_context(patch.dict(os.environ, {
+            "ULTRAVOX_API_KEY": "load-test",
+            "ULTRAVOX_API_URL": ultravox_server.url,
+            "EXA_API_KEY": "load-test",
+            "SMTP_HOST": smtp_server.host,
+            "SMTP_PORT": str(smtp_server.port),
+            "SMTP_USE_SSL": "false",
+            "EMAIL_ADDRESS": "maggie@example.com",
+            "EMAIL_PASSWORD": "load-test",
+        }))
+        cache = TTLCache(maxsize=app_module.SESSION_CACHE_SIZE, ttl=30) if app_module.SESSION_CACHE_SIZE > 0 else None
+        if args.backend == "firestore":
+            store = FirestoreStore(firestore, cache=cache)
+        else:
+            store = SQLiteStore(os.path.join(workdir, "maggie.sqlite3") if args.backend == "sqlite" else ":memory:", cache=cache)
+            stack.callback(store.close)
+        stack.enter_context(patch.object(app_module, "store", store))
+        stack.enter_context(patch.object(app_module, "exa_client", exa))
+        # A cold, memory-only cache each run, so runs are comparable
+        stack.enter_context(patch.object(app_module, "resource_cache", TwoTierCache(
+            TTLCache(maxsize=512, ttl=app_module.EXA_CACHE_TTL)
+        )))
+        stack.enter_context(patch.object(app_module, "mailer", Mailer(
+            Outbox(os.path.join(workdir, "outbox.sqlite3")), retry_base_delay=0.05, retry_max_delay=0.5, poll_interval=0.05
+        )))
+        yield {
+            "app_module": app_module,
+            "firestore": firestore,
+            "exa": exa,
+            "ultravox": ultravox_server,
+            "smtp": smtp_server,
+        }
+
+
+async def run_load(app, sessions: int, concurrency: int, think: float = 0.0, seed: int = 0) -> dict:
+    """
+    Runs ``sessions`` voice sessions against the app, ``concurrency`` at a time, and returns the report
+    """
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(concurrency)
+    rng = random.Random(seed)
+    session_seeds = [rng.random() for _ in range(sessions)]
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://load", timeout=60) as client:
+            async def run_session(index: int) -> None:
+                async with semaphore:
+                    await voice_session(client, recorder, f"load_session_{index}", random.Random(session_seeds[index]), think)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(run_session(i) for i in range(sessions)))
+            elapsed = time.perf_counter() - started
+
+    return recorder.summary(elapsed)
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Prints how each endpoint moved against the baseline and returns the ones whose p95 regressed
+    """
+    regressions = []
+    print(f"\n{'endpoint':<50} {'p95 before':>11} {'p95 now':>9} {'change':>8} {'req/s change':>13}")
+    for endpoint, now in report["endpoints"].items():
+        before = baseline["endpoints"].get(endpoint)
+        if before is None:
+            print(f"{endpoint:<50} {'new':>11}")
+            continue
+        change = (now["p95_ms"] - before["p95_ms"]) / before["p95_ms"] if before["p95_ms"] else 0.0
+        rate_change = (now["requests_per_s"] - before["requests_per_s"]) / before["requests_per_s"] if before["requests_per_s"] else 0.0
+        flag = ""
+        if change > tolerance:
+            regressions.append(endpoint)
+            flag = "  REGRESSED"
+        print(f"{endpoint:<50} {before['p95_ms']:>9.1f}ms {now['p95_ms']:>7.1f}ms {change:>+8.0%} {rate_change:>+13.0%}{flag}")
+    return regressions
+
+
+def print_report(report: dict) -> None:
+    print(f"{'endpoint':<50} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    rows = list(report["endpoints"].items()) + [("total", report["total"])]
+    for endpoint, stats in rows:
+        print(
+            f"{endpoint:<50} {stats['requests']:>8} {stats['errors']:>6} {stats['requests_per_s']:>8.1f} "
+            f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f}"
+        )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=200, help="Voice sessions to run")
+    parser.add_argument("--concurrency", type=int, default=50, help="Sessions running at once")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="Average pause between the steps of a session")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=("firestore", "sqlite", "memory"), default="firestore",
+                        help="Store sessions in the fake Firestore or with SQLiteStore")
+    for dependency, latency in (("firestore", 5.0), ("ultravox", 50.0), ("exa", 300.0), ("smtp", 20.0)):
+        parser.add_argument(f"--{dependency}-ms", type=float, default=latency, help=f"{dependency} latency in ms")
+        parser.add_argument(f"--{dependency}-failure-rate", type=float, default=0.0, help=f"Fraction of {dependency} calls that fail")
+    parser.add_argument("--output", type=Path, help="Where to save the results, benchmarks/results/load-<time>.json by default")
+    parser.add_argument("--compare", type=Path, help="Results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="p95 increase counted as a regression")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    with hermetic_app(args) as env:
+        report = asyncio.run(run_load(env["app_module"].app, args.sessions, args.concurrency, args.think_ms / 1000, args.seed))
+        report["dependencies"] = {
+            "firestore_rpcs": env["firestore"].rpc_count,
+            "firestore_failures": env["firestore"].failed_rpcs,
+            "exa_searches": len(env["exa"].searches),
+            "ultravox_calls": len(env["ultravox"].calls),
+            "smtp_messages": len(env["smtp"].messages),
+        }
+    report["config"] = {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()}
+    report["finished_at"] = datetime.now().isoformat(timespec="seconds")
+
+    print_report(report)
+    output = args.output or RESULTS_DIR / f"load-{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\nSaved to {output}")
+
+    if args.compare:
+        regressions = compare(report, json.loads(args.compare.read_text()), args.tolerance)
+        if regressions:
+            print(f"\np95 regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Microbenchmark of parsing a request body and encoding the response, per endpoint.
+
+"before" is what the handlers did: json.loads, body.get checks, and a dict
+run through jsonable_encoder and the standard json module. "after" is what
+FastAPI does with the typed models: json.loads and model validation of the
+body, then validation and serialization of the response model, encoded with
+orjson.
+
+    python -m benchmarks.bench_models
+"""
+
+import json
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from models import (
+    CognitiveDistortionsRequest, DistortionsSaved, SessionBundle, SessionDocument, SummaryRequest,
+    SummarySaved, TaskRequest, TaskSaved, UserTasks,
+)
+
+SESSION_ID = "4f9d2a6e-1c3b-4d8e-9a7f-0b5c6d7e8f90"
+
+TASK_BODY = json.dumps({"session_id": SESSION_ID, "task": "Write down three things that went well today"}).encode()
+DISTORTIONS_BODY = json.dumps({
+    "session_id": SESSION_ID,
+    "cognitiveDistortions": ["catastrophizing", "all-or-nothing thinking", "mind reading"],
+}).encode()
+SUMMARY_BODY = json.dumps({
+    "session_id": SESSION_ID,
+    "conversationSummary": "The user talked about anxiety before work presentations. " * 8,
+    "identifiedCognitiveDistortions": ["catastrophizing", "fortune telling"],
+    "suggestedExercises": "Progressive muscle relaxation before presenting, and a thought record afterwards.",
+}).encode()
+
+TASKS_DOCUMENT = {
+    "id": "tasks_doc",
+    "session_id": SESSION_ID,
+    "timestamp": "2024-01-15T10:30:00",
+    "tasks": [f"Task number {i} for the week" for i in range(10)],
+}
+RESOURCES_DOCUMENT = {
+    "id": "resources_doc",
+    "session_id": SESSION_ID,
+    "timestamp": "2024-01-15T10:30:00",
+    "resources": [
+        {"url": f"https://example.com/{i}", "title": f"Resource {i}", "text": "Breathing exercises. " * 400, "image": None}
+        for i in range(2)
+    ],
+}
+
+
+def before_task():
+    body = json.loads(TASK_BODY)
+    if not body.get("session_id", "") or not body.get("task", ""):
+        raise ValueError
+    return JSONResponse(jsonable_encoder(
+        {"message": "User task saved successfully.", "task_id": "tasks_doc", "status": "success", "status_code": 200}
+    )).body
+
+
+def after_task():
+    TaskRequest.model_validate(json.loads(TASK_BODY))
+    result = TaskSaved.model_validate({"message": "User task saved successfully.", "task_id": "tasks_doc"})
+    return ORJSONResponse(result.model_dump(mode="json")).body
+
+
+def before_distortions():
+    body = json.loads(DISTORTIONS_BODY)
+    if not body.get("session_id", "") or not body.get("cognitiveDistortions", []):
+        raise ValueError
+    return JSONResponse(jsonable_encoder(
+        {"message": "Cognitive distortions saved successfully.", "distortion_id": "distortions_doc",
+         "status": "success", "status_code": 200}
+    )).body
+
+
+def after_distortions():
+    CognitiveDistortionsRequest.model_validate(json.loads(DISTORTIONS_BODY))
+    result = DistortionsSaved.model_validate(
+        {"message": "Cognitive distortions saved successfully.", "distortion_id": "distortions_doc"}
+    )
+    return ORJSONResponse(result.model_dump(mode="json")).body
+
+
+def before_summary():
+    body = json.loads(SUMMARY_BODY)
+    if not body.get("session_id", ""):
+        raise ValueError
+    body.get("conversationSummary", ""), body.get("identifiedCognitiveDistortions", []), body.get("suggestedExercises", "")
+    return JSONResponse(jsonable_encoder(
+        {"message": "Conversation summary saved successfully.", "summary_id": "summary_doc",
+         "status": "success", "status_code": 200}
+    )).body
+
+
+def after_summary():
+    SummaryRequest.model_validate(json.loads(SUMMARY_BODY))
+    result = SummarySaved.model_validate({"message": "Conversation summary saved successfully.", "summary_id": "summary_doc"})
+    return ORJSONResponse(result.model_dump(mode="json")).body
+
+
+def before_get_tasks():
+    return JSONResponse(jsonable_encoder({"userTasks": [TASKS_DOCUMENT]})).body
+
+
+def after_get_tasks():
+    return ORJSONResponse(UserTasks.model_validate({"userTasks": [TASKS_DOCUMENT]}).model_dump(mode="json")).body
+
+
+def before_get_resources():
+    return JSONResponse(jsonable_encoder(RESOURCES_DOCUMENT)).body
+
+
+def after_get_resources():
+    return ORJSONResponse(SessionDocument.model_validate(RESOURCES_DOCUMENT).model_dump(mode="json")).body
+
+
+def before_bundle():
+    return JSONResponse(jsonable_encoder(
+        {"session_id": SESSION_ID, "userTasks": [TASKS_DOCUMENT], "resources": RESOURCES_DOCUMENT}
+    )).body
+
+
+def after_bundle():
+    bundle = SessionBundle.model_validate(
+        {"session_id": SESSION_ID, "userTasks": [TASKS_DOCUMENT], "resources": RESOURCES_DOCUMENT}
+    )
+    return ORJSONResponse(bundle.model_dump(mode="json", exclude_unset=True)).body
+
+
+def main():
+    for label, before, after in (
+        ("POST /sessions/tasks", before_task, after_task),
+        ("POST /sessions/cognitive-distortions", before_distortions, after_distortions),
+        ("POST /sessions/summary", before_summary, after_summary),
+        ("GET /sessions/{id}/tasks", before_get_tasks, after_get_tasks),
+        ("GET /sessions/{id}/resources", before_get_resources, after_get_resources),
+        ("GET /sessions/{id}/bundle", before_bundle, after_bundle),
+    ):
+        assert json.loads(before()) == json.loads(after()), label
+        calls = 20000
+        before_us = timeit.timeit(before, number=calls) / calls * 1e6
+        after_us = timeit.timeit(after, number=calls) / calls * 1e6
+        print(f"{label:>38}: before {before_us:8.2f} us/call  after {after_us:8.2f} us/call  ({before_us / after_us:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
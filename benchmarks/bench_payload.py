@@ -0,0 +1,59 @@
+"""
+Microbenchmark of building and encoding the Ultravox call payload.
+
+"dict" is get_payload() plus the json.dumps that httpx did on every call;
+"template" is get_payload_json(), which splices the session ID into bytes
+compiled once at startup.
+
+    python -m benchmarks.bench_payload
+"""
+
+import json
+import timeit
+import tracemalloc
+
+from payload import compile_payload_template, get_payload, get_payload_json
+
+SESSION_ID = "4f9d2a6e-1c3b-4d8e-9a7f-0b5c6d7e8f90"
+
+
+def dict_payload():
+    return get_payload(SESSION_ID)
+
+
+def dict_payload_encoded():
+    return json.dumps(get_payload(SESSION_ID)).encode("utf-8")
+
+
+def template_payload_encoded():
+    return get_payload_json(SESSION_ID)
+
+
+def allocated_bytes(func, calls: int = 1000) -> float:
+    """Average bytes allocated per call, measured as the traced peak of each call"""
+    tracemalloc.start()
+    total = 0
+    for _ in range(calls):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        func()
+        total += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return total / calls
+
+
+def main():
+    compile_payload_template()
+    print(f"payload size: {len(get_payload_json(SESSION_ID))} bytes")
+    for label, func in (
+        ("get_payload (dict only)", dict_payload),
+        ("get_payload + json encode", dict_payload_encoded),
+        ("get_payload_json (template)", template_payload_encoded),
+    ):
+        calls = 20000
+        per_call_us = timeit.timeit(func, number=calls) / calls * 1e6
+        print(f"{label:>28}: {per_call_us:8.2f} us/call  {allocated_bytes(func):10.0f} bytes allocated/call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Helpers shared by the benchmark scripts.
+
+Run the benchmarks from the repository root, e.g.
+``python -m benchmarks.bench_concurrency``.
+"""
+
+import asyncio
+import math
+import statistics
+import time
+from typing import List
+
+import httpx
+
+
+def load_app():
+    """
+    Imports the ``main`` module. Firebase credentials are only read when the
+    store is first used, and the benchmarks replace the store before that.
+    """
+    import main
+    return main
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    """
+    Nearest-rank percentile of already sorted values, 0 if there are none
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+async def run_concurrent(app, requests, concurrency: int) -> dict:
+    """
+    Sends ``requests`` ((method, url, json) tuples) to the ASGI app with at most
+    ``concurrency`` in flight and returns throughput and latency figures.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def send(method, url, body):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.request(method, url, json=body)
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(*request) for request in requests))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(requests),
+        "elapsed_s": elapsed,
+        "requests_per_s": len(requests) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "statuses": statuses,
+    }
@@ -0,0 +1,229 @@
+"""
+Caches used to avoid repeating expensive lookups.
+
+TTLCache is a bounded in-process LRU whose entries expire. DiskCache keeps
+zlib-compressed JSON values in a SQLite file so they survive restarts.
+TwoTierCache puts the first in front of the second and counts hits and misses
+per tier.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional
+
+
+def approximate_size(value: Any) -> int:
+    """
+    Rough in-memory footprint of a JSON-like value in bytes, counting nested dicts, lists and strings
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(key) + approximate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approximate_size(item) for item in value)
+    return size
+
+
+class TTLCache:
+    """
+    In-process LRU cache whose entries expire ``ttl`` seconds after they are set.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[0] if entry else None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def values(self) -> List[Any]:
+        """
+        Returns a snapshot of the cached values, including expired ones not yet evicted
+        """
+        with self._lock:
+            return [value for value, _ in self._entries.values()]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class DiskCache:
+    """
+    Persistent cache of JSON-serializable values, compressed with zlib in a SQLite file.
+
+    The database is opened on first use, so creating a DiskCache does no I/O. Expired
+    entries are deleted when the database is opened, when a read finds one, and every
+    ``prune_every`` sets, so the file doesn't keep growing.
+    """
+
+    def __init__(self, path: str, ttl: float, prune_every: int = 100, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+        self._clock = clock
+        self._sets = 0
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value BLOB NOT NULL)"
+            )
+            self._prune(self._connection)
+        return self._connection
+
+    def _prune(self, connection: sqlite3.Connection) -> None:
+        self.pruned += connection.execute("DELETE FROM cache WHERE expires_at <= ?", (self._clock(),)).rowcount
+        connection.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] <= self._clock():
+                self.misses += 1
+                if row is not None:
+                    connection.execute("DELETE FROM cache WHERE key = ? AND expires_at = ?", (key, row[1]))
+                    connection.commit()
+                    self.pruned += 1
+                return None
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, key: str, value: Any) -> None:
+        blob = zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO cache (key, expires_at, value) VALUES (?, ?, ?)",
+                (key, self._clock() + self.ttl, blob),
+            )
+            connection.commit()
+            self._sets += 1
+            if self._sets % self.prune_every == 0:
+                self._prune(connection)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def stats(self) -> dict:
+        return {"path": self.path, "hits": self.hits, "misses": self.misses, "pruned": self.pruned}
+
+
+class TwoTierCache:
+    """
+    A TTLCache in front of an optional DiskCache. Disk hits are copied into memory.
+    """
+
+    def __init__(self, memory: TTLCache, disk: Optional[DiskCache] = None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    async def get_async(self, key: str) -> Optional[Any]:
+        """
+        Like get, but reads the disk tier in a worker thread
+        """
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = await asyncio.to_thread(self.disk.get, key)
+            if value is not None:
+                self.memory.set(key, value)
+        return value
+
+    async def set_async(self, key: str, value: Any) -> None:
+        """
+        Like set, but writes the disk tier in a worker thread
+        """
+        self.memory.set(key, value)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.set, key, value)
+
+    def stats(self) -> dict:
+        hits = self.memory.hits
+        misses = self.memory.misses
+        if self.disk is not None:
+            # A memory miss that hit the disk is still a hit overall
+            hits += self.disk.hits
+            misses = self.disk.misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats() if self.disk is not None else None,
+        }
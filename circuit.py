@@ -0,0 +1,235 @@
+"""
+Circuit breakers for the API's dependencies.
+
+When Exa, SMTP or Firestore is failing or very slow, waiting out every call's
+timeout ties up the workers and queues that call it. A CircuitBreaker watches
+the outcome and duration of the last calls to one dependency and opens once
+too many of them failed or were slow. While it is open calls fail straight
+away with CircuitOpen, and callers answer with their degraded response: the
+resource tool says resources aren't available, emails stay queued in the
+outbox, and tool writes go through the write-behind buffer. After
+``open_seconds`` a few probe calls are let through (half-open), which close
+the circuit if they succeed and open it again if they don't.
+
+Breaker states are exported in /metrics as circuit_breaker_state.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
+
+from metrics import CIRCUIT_REJECTED, CIRCUIT_STATE, CIRCUIT_TRANSITIONS
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+# circuit_breaker_state gauge values
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling a dependency whose circuit is open
+    """
+
+    def __init__(self, dependency: str, retry_after: float):
+        super().__init__(f"The {dependency} circuit is open, retry in {retry_after:.0f}s")
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Opens after too many of the last ``window`` calls to a dependency failed or were slow.
+
+        Args:
+            dependency: The dependency's name, as in the metrics
+            failure_rate: Fraction of failed calls that opens the circuit
+            slow_call_seconds: Calls taking at least this long count as slow, None to ignore latency
+            slow_call_rate: Fraction of slow calls that opens the circuit
+            window: The number of recent calls looked at
+            min_calls: Calls needed in the window before it can open
+            open_seconds: Seconds the circuit stays open before probing
+            half_open_calls: Probe calls let through, all of which must succeed to close it
+            is_failure: Whether an exception raised by a call is the dependency failing.
+                By default every exception is.
+    """
+
+    def __init__(
+        self,
+        dependency: str,
+        failure_rate: float = 0.5,
+        slow_call_seconds: Optional[float] = None,
+        slow_call_rate: float = 0.8,
+        window: int = 20,
+        min_calls: int = 10,
+        open_seconds: float = 30.0,
+        half_open_calls: int = 1,
+        is_failure: Callable[[BaseException], bool] = lambda error: True,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.dependency = dependency
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.is_failure = is_failure
+        self._clock = clock
+        self._lock = threading.Lock()
+        # (failed, slow) of the last calls while closed
+        self._outcomes: Deque[Tuple[bool, bool]] = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        CIRCUIT_STATE.set((dependency,), STATE_VALUES[CLOSED])
+
+    @classmethod
+    def from_env(cls, dependency: str, **defaults) -> "CircuitBreaker":
+        """
+        Creates a breaker configured by <DEPENDENCY>_CIRCUIT_* variables, falling back to defaults
+        """
+        prefix = f"{dependency.upper()}_CIRCUIT_"
+        settings = dict(defaults)
+        for name, parse in (
+            ("failure_rate", float), ("slow_call_seconds", float), ("slow_call_rate", float),
+            ("window", int), ("min_calls", int), ("open_seconds", float), ("half_open_calls", int),
+        ):
+            value = os.getenv(prefix + name.upper())
+            if value:
+                settings[name] = parse(value)
+        return cls(dependency, **settings)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def _transition(self, state: str) -> None:
+        self._state = state
+        if state == OPEN:
+            self._opened_at = self._clock()
+        elif state == HALF_OPEN:
+            self._probes = 0
+            self._probe_successes = 0
+        else:
+            self._outcomes.clear()
+        CIRCUIT_STATE.set((self.dependency,), STATE_VALUES[state])
+        CIRCUIT_TRANSITIONS.inc((self.dependency, state))
+        log = logger.warning if state == OPEN else logger.info
+        log(f"Circuit for {self.dependency} is now {state}")
+
+    def retry_after(self) -> float:
+        """
+        Returns the seconds until the circuit lets a call through, 0 if it does now
+        """
+        with self._lock:
+            if self._state != OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.open_seconds - self._clock())
+
+    def available(self) -> bool:
+        """
+        Returns whether allow() would let a call through now, without taking a probe slot
+        """
+        with self._lock:
+            if self._state == OPEN:
+                return self._clock() >= self._opened_at + self.open_seconds
+            if self._state == HALF_OPEN:
+                return self._probes < self.half_open_calls
+            return True
+
+    def allow(self) -> bool:
+        """
+        Returns whether a call may go ahead, taking a probe slot if the circuit is half-open.
+        A call that is allowed must be followed by record() or release().
+        """
+        with self._lock:
+            if self._state == OPEN:
+                if self._clock() < self._opened_at + self.open_seconds:
+                    return False
+                self._transition(HALF_OPEN)
+            if self._state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    return False
+                self._probes += 1
+            return True
+
+    def record(self, elapsed: float, failed: bool) -> None:
+        """
+        Records the outcome of an allowed call
+        """
+        slow = self.slow_call_seconds is not None and elapsed >= self.slow_call_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if failed or slow:
+                    self._transition(OPEN)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._transition(CLOSED)
+            elif self._state == CLOSED:
+                self._outcomes.append((failed, slow))
+                calls = len(self._outcomes)
+                if calls < self.min_calls:
+                    return
+                failures = sum(1 for failed, _ in self._outcomes if failed)
+                slow_calls = sum(1 for _, slow in self._outcomes if slow)
+                if failures >= self.failure_rate * calls or slow_calls >= self.slow_call_rate * calls:
+                    self._transition(OPEN)
+            # Calls that started before the circuit opened don't change it
+
+    def release(self) -> None:
+        """
+        Gives back the probe slot of an allowed call that was cancelled before it had an outcome
+        """
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def guard(self) -> "_Guard":
+        """
+        Runs a call to the dependency through the breaker, with or without await inside the block:
+
+            with exa_breaker.guard():
+                result = await search(query)
+
+            Raises:
+                CircuitOpen: If the circuit is open, without running the block
+        """
+        return _Guard(self)
+
+    def stats(self) -> dict:
+        return {"state": self.state, "retry_after": round(self.retry_after(), 1)}
+
+
+class _Guard:
+    __slots__ = ("breaker", "started")
+
+    def __init__(self, breaker: CircuitBreaker):
+        self.breaker = breaker
+
+    def __enter__(self) -> "_Guard":
+        if not self.breaker.allow():
+            CIRCUIT_REJECTED.inc((self.breaker.dependency,))
+            raise CircuitOpen(self.breaker.dependency, self.breaker.retry_after())
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        elapsed = time.perf_counter() - self.started
+        if exc_type is None:
+            self.breaker.record(elapsed, False)
+        elif issubclass(exc_type, Exception):
+            self.breaker.record(elapsed, self.breaker.is_failure(exc))
+        else:
+            # Cancelled, which says nothing about the dependency
+            self.breaker.release()
@@ -0,0 +1,23 @@
+import os
+import tempfile
+from unittest.mock import patch
+
+import pytest
+
+from fakes import FakeFirestore
+from storage import FirestoreStore
+
+# Tests count RPCs and connections exactly, which warming up at startup would add to.
+# test_warmup.py turns it on where it's under test.
+os.environ.setdefault("WARMUP", "false")
+
+# Emails queued by tests go to a throwaway outbox rather than the one in .data/
+os.environ.setdefault("EMAIL_OUTBOX_PATH", os.path.join(tempfile.mkdtemp(prefix="outbox-"), "outbox.sqlite3"))
+
+
+@pytest.fixture
+def fake_db():
+    """Replace the Firestore store with one backed by an in-memory database"""
+    fake = FakeFirestore()
+    with patch("main.store", FirestoreStore(fake)):
+        yield fake
@@ -0,0 +1,96 @@
+"""
+Streaming NDJSON export of every session, for analytics.
+
+Each line is one session with its summary, tasks and cognitive distortions.
+Lines are produced as the sessions are read, so neither the API endpoint nor
+the command line tool ever holds more than one page of sessions.
+
+    python export.py --since 2024-01-01T00:00:00 --gzip --output sessions.ndjson.gz
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import zlib
+from datetime import datetime, timezone
+from typing import AsyncIterator, Optional
+
+from storage import SessionStore, create_store
+
+# Lines are grouped into chunks of about this many bytes before they are yielded
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_since(value: str) -> datetime:
+    """
+    Parses an ISO 8601 date or datetime, taking naive values as UTC
+
+        Raises:
+            ValueError: If the value isn't ISO 8601
+    """
+    since = datetime.fromisoformat(value)
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return since
+
+
+async def ndjson_chunks(
+    store: SessionStore, since: Optional[datetime] = None, page_size: int = 500
+) -> AsyncIterator[bytes]:
+    """
+    Yields the export as NDJSON, one line per session, in chunks of about CHUNK_SIZE bytes
+    """
+    chunk = []
+    size = 0
+    async for session in store.export_sessions(page_size=page_size, since=since):
+        line = json.dumps(session, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8") + b"\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Compresses a stream of chunks into one gzip stream
+    """
+    compressor = zlib.compressobj(wbits=31)  # 31 writes a gzip header and trailer
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+async def export(store: SessionStore, output, since: Optional[datetime], gzip: bool, page_size: int) -> None:
+    chunks = ndjson_chunks(store, since, page_size)
+    if gzip:
+        chunks = gzip_chunks(chunks)
+    async for chunk in chunks:
+        output.write(chunk)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export every session as NDJSON")
+    parser.add_argument("--since", type=parse_since, help="Only export sessions updated at or after this ISO 8601 time")
+    parser.add_argument("--gzip", action="store_true", help="Compress the output with gzip")
+    parser.add_argument("--output", help="File to write to, standard output if omitted")
+    parser.add_argument("--page-size", type=int, default=500, help="Sessions fetched per Firestore round trip")
+    args = parser.parse_args()
+
+    store = create_store()
+
+    if args.output:
+        with open(args.output, "wb") as output:
+            asyncio.run(export(store, output, args.since, args.gzip, args.page_size))
+    else:
+        asyncio.run(export(store, sys.stdout.buffer, args.since, args.gzip, args.page_size))
+
+
+if __name__ == "__main__":
+    main()
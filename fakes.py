@@ -0,0 +1,605 @@
+"""
+In-memory stand-ins for the external services the API talks to.
+
+These are used by the tests and the benchmarks so they can exercise the real
+handlers without production credentials or network access. Each one takes a
+``latency`` and a ``failure_rate``, the fraction of calls that fail the way
+the real service does when it is having trouble, drawn from a seeded random
+generator so a run can be repeated.
+"""
+
+import asyncio
+import bisect
+import json
+import random
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from google.api_core.exceptions import ServiceUnavailable
+from google.cloud.firestore_v1.transforms import ArrayUnion
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data: Optional[dict], update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+
+    def to_dict(self) -> Optional[dict]:
+        if self._data is None:
+            return None
+        return dict(self._data)
+
+
+class FakeDocumentReference:
+    def __init__(self, client: "FakeFirestore", path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self) -> "FakeCollectionReference":
+        return FakeCollectionReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, name: str) -> "FakeCollectionReference":
+        return FakeCollectionReference(self._client, f"{self.path}/{name}")
+
+    async def get(self) -> FakeDocumentSnapshot:
+        await self._client._rpc()
+        data, update_time = self._client._documents.get(self.path, (None, None))
+        return FakeDocumentSnapshot(self, data, update_time)
+
+    async def set(self, document_data: dict, merge: bool = False):
+        await self._client._rpc()
+        self._client._write(self.path, document_data, merge=merge)
+
+    async def update(self, field_updates: dict):
+        await self._client._rpc()
+        if self.path not in self._client._documents:
+            raise KeyError(f"No document to update: {self.path}")
+        self._client._write(self.path, field_updates, merge=True)
+
+    async def delete(self):
+        await self._client._rpc()
+        if self._client._documents.pop(self.path, None) is not None:
+            self._client._version += 1
+
+
+class FakeCollectionReference:
+    def __init__(self, client: "FakeFirestore", path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self) -> Optional[FakeDocumentReference]:
+        if "/" not in self.path:
+            return None
+        return FakeDocumentReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def document(self, document_id: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self._client, f"{self.path}/{document_id}")
+
+    async def stream(self):
+        await self._client._rpc()
+        depth = self.path.count("/") + 1
+        for path in sorted(self._client._documents):
+            if path.startswith(self.path + "/") and path.count("/") == depth:
+                data, update_time = self._client._documents[path]
+                yield FakeDocumentSnapshot(FakeDocumentReference(self._client, path), data, update_time)
+
+    async def list_documents(self, page_size: Optional[int] = None):
+        """
+        Yields a reference to every document in the collection, including documents that
+        don't exist but have subcollections, fetching page_size references per RPC
+        """
+        children = self._client._children.get(self.path, [])
+        page_size = page_size or len(children) or 1
+        start = 0
+        while True:
+            await self._client._rpc()
+            page = children[start:start + page_size]
+            for document_id in page:
+                yield self.document(document_id)
+            if len(page) < page_size:
+                return
+            start += page_size
+
+
+class FakeQuery:
+    """
+    Query over the in-memory documents, supporting order_by, start_after and limit.
+
+    Like Firestore, documents missing an ordered field are left out, and ties
+    are broken by document path in the direction of the last ordering. As with
+    a Firestore index, a page costs the same wherever its cursor is: results are
+    kept sorted and start_after bisects into them instead of scanning.
+    """
+
+    def __init__(self, client: "FakeFirestore", scope: tuple, matches, orders=(), cursor=None, limit_count=None):
+        self._client = client
+        self._scope = scope
+        self._matches = matches
+        self._orders = tuple(orders)
+        self._cursor = cursor
+        self._limit = limit_count
+
+    def _copy(self, **changes) -> "FakeQuery":
+        state = {"orders": self._orders, "cursor": self._cursor, "limit_count": self._limit}
+        state.update(changes)
+        return FakeQuery(self._client, self._scope, self._matches, **state)
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING") -> "FakeQuery":
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int) -> "FakeQuery":
+        return self._copy(limit_count=count)
+
+    def start_after(self, document_fields: dict) -> "FakeQuery":
+        return self._copy(cursor=document_fields)
+
+    def _all_orders(self):
+        if any(field == "__name__" for field, _ in self._orders):
+            return self._orders
+        direction = self._orders[-1][1] if self._orders else "ASCENDING"
+        return self._orders + (("__name__", direction),)
+
+    @staticmethod
+    def _value(path: str, data: dict, field: str):
+        if field == "__name__":
+            return path
+        return data[field]
+
+    def _sort_key(self, values):
+        # Negating isn't possible for strings, so descending fields are wrapped instead
+        return tuple(
+            _Descending(value) if direction == "DESCENDING" else value
+            for value, (_, direction) in zip(values, self._all_orders())
+        )
+
+    def _sorted_rows(self, orders) -> tuple:
+        """
+        Returns the (sort keys, rows) of the matching documents in query order. Like a
+        Firestore index it is built once and reused until a document changes.
+        """
+        key = (self._scope, orders)
+        cached = self._client._query_indexes.get(key)
+        if cached is not None and cached[0] == self._client._version:
+            return cached[1], cached[2]
+        rows = []
+        for path, (data, update_time) in self._client._documents.items():
+            if not self._matches(path):
+                continue
+            if any(field != "__name__" and field not in data for field, _ in orders):
+                continue
+            values = [self._value(path, data, field) for field, _ in orders]
+            rows.append((self._sort_key(values), path, data, update_time))
+        rows.sort(key=lambda row: row[0])
+        keys = [row[0] for row in rows]
+        self._client._query_indexes[key] = (self._client._version, keys, rows)
+        return keys, rows
+
+    async def stream(self):
+        await self._client._rpc()
+        orders = self._all_orders()
+        keys, rows = self._sorted_rows(orders)
+
+        start = 0
+        if self._cursor is not None:
+            cursor_values = []
+            for field, _ in orders:
+                value = self._cursor[field]
+                cursor_values.append(getattr(value, "path", value) if field == "__name__" else value)
+            start = bisect.bisect_right(keys, self._sort_key(cursor_values))
+        end = len(rows) if self._limit is None else start + self._limit
+        rows = rows[start:end]
+
+        self._client.documents_read += len(rows)
+        for _, path, data, update_time in rows:
+            yield FakeDocumentSnapshot(FakeDocumentReference(self._client, path), data, update_time)
+
+
+class _Descending:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class FakeWriteBatch:
+    def __init__(self, client: "FakeFirestore"):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference: FakeDocumentReference, document_data: dict, merge: bool = False):
+        self._writes.append((reference.path, document_data, merge))
+
+    async def commit(self):
+        """Applies every write in one RPC, or none of them if the client is set to fail"""
+        await self._client._rpc()
+        if self._client.fail_batches:
+            self._client.fail_batches -= 1
+            raise RuntimeError("Fake batch commit failure")
+        for path, document_data, merge in self._writes:
+            self._client._write(path, document_data, merge)
+        self._client.batch_sizes.append(len(self._writes))
+
+
+class FakeFirestore:
+    """
+    Minimal in-memory replacement for the async Firestore client.
+
+    Every RPC waits ``latency`` seconds. With ``blocking=True`` the wait uses
+    ``time.sleep`` so it behaves like the synchronous client being called from
+    an async handler, which stalls the whole event loop. A ``failure_rate``
+    fraction of RPCs raise ServiceUnavailable after waiting.
+    """
+
+    def __init__(self, latency: float = 0.0, blocking: bool = False, failure_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.blocking = blocking
+        self.failure_rate = failure_rate
+        self.failed_rpcs = 0
+        self._random = random.Random(seed)
+        self.rpc_count = 0
+        self.documents_read = 0
+        self.batch_sizes = []
+        self.fail_batches = 0
+        self._last_update_time: Optional[datetime] = None
+        # Sorted ids of the documents in each collection, including ones that only have subcollections
+        self._children: Dict[str, List[str]] = {}
+        self._documents: Dict[str, tuple] = {}
+        # Sorted query results by (scope, orders), rebuilt once a document changes
+        self._version = 0
+        self._query_indexes: Dict[tuple, tuple] = {}
+
+    async def _rpc(self):
+        self.rpc_count += 1
+        if self.latency:
+            if self.blocking:
+                time.sleep(self.latency)
+            else:
+                await asyncio.sleep(self.latency)
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            self.failed_rpcs += 1
+            raise ServiceUnavailable("Injected Firestore failure")
+
+    def _write(self, path: str, data: dict, merge: bool = False):
+        if path not in self._documents:
+            self._index(path)
+        existing = self._documents.get(path, (None, None))[0]
+        document = dict(existing) if merge and existing else {}
+        for key, value in data.items():
+            if isinstance(value, ArrayUnion):
+                current = list(document.get(key) or [])
+                current.extend(item for item in value.values if item not in current)
+                value = current
+            document[key] = value
+        self._documents[path] = (document, self._next_update_time())
+        self._version += 1
+
+    def _index(self, path: str):
+        segments = path.split("/")
+        for end in range(1, len(segments), 2):
+            children = self._children.setdefault("/".join(segments[:end]), [])
+            document_id = segments[end]
+            position = bisect.bisect_left(children, document_id)
+            if position == len(children) or children[position] != document_id:
+                children.insert(position, document_id)
+
+    def _next_update_time(self) -> datetime:
+        # Firestore update times have nanosecond precision, so two writes never share one
+        now = datetime.now(timezone.utc)
+        if self._last_update_time is not None and now <= self._last_update_time:
+            now = self._last_update_time + timedelta(microseconds=1)
+        self._last_update_time = now
+        return now
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def document(self, path: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self, path)
+
+    def collection_group(self, collection_id: str) -> FakeQuery:
+        return FakeQuery(self, ("collection_group", collection_id), lambda path: path.rsplit("/", 2)[-2] == collection_id)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    async def get_all(self, references):
+        """Fetches several documents in one RPC, yielding a snapshot for each, existing or not"""
+        await self._rpc()
+        for reference in references:
+            self.documents_read += 1
+            data, update_time = self._documents.get(reference.path, (None, None))
+            yield FakeDocumentSnapshot(reference, data, update_time)
+
+    def seed(self, path: str, data: dict):
+        """Store a document directly, without counting an RPC."""
+        self._write(path, data)
+
+    def dump(self, path: str) -> Optional[dict]:
+        """Read a document directly, without counting an RPC."""
+        return self._documents.get(path, (None, None))[0]
+
+
+class _FakeUltravoxHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.fake._connection_opened()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        fake = self.server.fake
+        number = fake._call_received(self.path, json.loads(body or b"{}"))
+        latency = fake.tail_latency if fake.tail_every and number % fake.tail_every == 0 else fake.latency
+        if latency:
+            time.sleep(latency)
+        if fake._should_fail():
+            response = json.dumps({"detail": "Injected Ultravox failure"}).encode()
+            self.send_response(503)
+        else:
+            call_id = str(uuid.uuid4())
+            response = json.dumps({"callId": call_id, "joinUrl": f"wss://fake.ultravox/calls/{call_id}"}).encode()
+            self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_HEAD(self):
+        # Connection warm-up, not a call
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeUltravoxServer:
+    """
+    Local HTTP server that answers ``POST /api/calls`` like Ultravox does.
+
+    It counts the TCP connections it accepts, so tests can check that the API
+    reuses pooled connections. Use it as a context manager; ``url`` is the base
+    URL to point ``ULTRAVOX_API_URL`` at. A ``failure_rate`` fraction of calls
+    are answered with a 503. With ``tail_every`` set, every tail_every-th call
+    takes ``tail_latency`` instead of ``latency``, a tail that hedging can cut.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        seed: Optional[int] = None,
+        tail_latency: float = 0.0,
+        tail_every: int = 0,
+    ):
+        self.latency = latency
+        self.tail_latency = tail_latency
+        self.tail_every = tail_every
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self.connections = 0
+        self.calls = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeUltravoxHandler)
+        self._server.daemon_threads = True
+        # Clients hang up on slow responses when a deadline passes or a hedge wins
+        self._server.handle_error = lambda request, client_address: None
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def _connection_opened(self):
+        with self._lock:
+            self.connections += 1
+
+    def _call_received(self, path: str, payload: dict) -> int:
+        with self._lock:
+            self.calls.append((path, payload))
+            return len(self.calls)
+
+    def _should_fail(self) -> bool:
+        with self._lock:
+            return bool(self.failure_rate) and self._random.random() < self.failure_rate
+
+    def __enter__(self) -> "FakeUltravoxServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        fake = self.server.fake
+        fake._connection_opened(self.connection)
+        self._reply("220 fake.smtp ESMTP ready")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.wfile.write(b"250-fake.smtp\r\n250 AUTH PLAIN LOGIN\r\n")
+            elif verb == "AUTH":
+                fake._logged_in()
+                self._reply("235 Authentication successful")
+            elif verb == "MAIL":
+                sender, recipients = command.split(":", 1)[1].strip(" <>"), []
+                self._reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[1].strip(" <>"))
+                self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if data_line in (b".\r\n", b""):
+                        break
+                    data.append(data_line)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                failure = fake._take_failure()
+                if failure:
+                    self._reply(failure)
+                    continue
+                fake._message_received(sender, recipients, b"".join(data))
+                self._reply("250 OK queued")
+            elif verb in ("NOOP", "RSET"):
+                self._reply("250 OK")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+
+class FakeSMTPServer:
+    """
+    Local plain-text SMTP server that accepts any login and records every message.
+
+    It counts connections and logins, and ``drop_connections()`` closes every open
+    connection from the server side, like an SMTP server timing idle clients out.
+    ``fail_next()`` makes it reject the next messages with an error reply, and a
+    ``failure_rate`` fraction of the others get a temporary error reply.
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self.connections = 0
+        self.logins = 0
+        self.messages = []
+        self._failures = []
+        self._sockets = []
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _FakeSMTPHandler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def host(self) -> str:
+        return self._server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def _connection_opened(self, sock):
+        with self._lock:
+            self.connections += 1
+            self._sockets.append(sock)
+
+    def _logged_in(self):
+        with self._lock:
+            self.logins += 1
+
+    def _message_received(self, sender, recipients, data: bytes):
+        with self._lock:
+            self.messages.append({"from": sender, "to": recipients, "data": data})
+
+    def fail_next(self, count: int, reply: str = "451 Temporary local problem, try again later"):
+        with self._lock:
+            self._failures.extend([reply] * count)
+
+    def _take_failure(self):
+        with self._lock:
+            if self._failures:
+                return self._failures.pop(0)
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                return "451 Injected SMTP failure, try again later"
+            return None
+
+    def drop_connections(self):
+        with self._lock:
+            sockets, self._sockets = self._sockets, []
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self) -> "FakeSMTPServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.drop_connections()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeExa:
+    """
+    Stand-in for the synchronous Exa client, answering ``search_and_contents`` with
+    ``num_results`` made-up pages about the query.
+
+    Like the real SDK it blocks the calling thread for ``latency`` seconds. A
+    ``failure_rate`` fraction of searches raise instead.
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.searches = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def search_and_contents(self, query: str, num_results: int = 10, **kwargs):
+        with self._lock:
+            self.searches.append(query)
+            failed = bool(self.failure_rate) and self._random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise ValueError("Injected Exa failure")
+        slug = "-".join(query.lower().split())
+        return SimpleNamespace(results=[
+            SimpleNamespace(
+                url=f"https://fake.exa/{slug}/{i}",
+                title=f"{query} ({i + 1})",
+                text=f"\nAn article about {query}.",
+                image=None,
+                favicon=None,
+            )
+            for i in range(num_results)
+        ])
@@ -0,0 +1,62 @@
+"""
+HTTP validators for the GET endpoints.
+
+Polling clients send back the ETag of the last response in If-None-Match, and
+get an empty 304 while nothing has changed. Session document endpoints derive
+the ETag from the documents' update times, so a 304 costs no serialization at
+all; the others hash the serialized body.
+"""
+
+import hashlib
+from typing import Iterable, Optional
+
+from fastapi import Request, Response
+from fastapi.responses import ORJSONResponse
+
+# Session data can change at any moment during a conversation, so browsers must revalidate every time
+REVALIDATE = "private, no-cache"
+# Nothing worth caching, and the numbers are stale the moment they are sent
+NO_STORE = "no-store"
+
+
+def make_etag(*parts: object) -> str:
+    """
+    Builds a strong ETag from the values that identify a representation
+    """
+    digest = hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Whether the request's If-None-Match matches the ETag, using the weak comparison RFC 9110 asks for
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates: Iterable[str] = (candidate.strip() for candidate in header.split(","))
+    return any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+
+def set_validators(response: Response, etag: Optional[str], cache_control: str) -> None:
+    if etag is not None:
+        response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = cache_control
+
+
+def conditional_json(request: Request, content: object, cache_control: str = REVALIDATE) -> Response:
+    """
+    Serializes content and returns it with an ETag hashed from the body, or a 304 if the client has it
+    """
+    response = ORJSONResponse(content=content)
+    etag = make_etag(response.body.decode("utf-8"))
+    if etag_matches(request, etag):
+        return not_modified(etag, cache_control)
+    set_validators(response, etag, cache_control)
+    return response
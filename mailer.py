@@ -0,0 +1,384 @@
+"""
+Email delivery off the event loop.
+
+smtplib is blocking and a fresh SMTP_SSL connection costs a TLS handshake and
+a login, so Mailer sends from a few dedicated threads that each borrow an
+authenticated connection from SMTPConnectionPool. Connections are reused
+across messages and replaced when the server has dropped them or they have
+been idle too long. Emails are persisted in an Outbox first, so callers get
+an email id back straight away and can look up the delivery status with it.
+The outbox is a SQLite file, so its calls run in worker threads too.
+While the SMTP circuit is open nothing is sent and emails wait in the outbox.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import smtplib
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
+from contextlib import nullcontext
+from typing import List, Optional, Tuple
+
+import tracing
+from circuit import CircuitBreaker, CircuitOpen
+from metrics import timed
+from outbox import Outbox, OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPConfig:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: Optional[str],
+        password: Optional[str],
+        use_ssl: bool = True,
+        timeout: float = 10.0,
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+
+    @classmethod
+    def from_env(cls) -> "SMTPConfig":
+        return cls(
+            host=os.getenv("SMTP_HOST", "smtp.gmail.com"),
+            port=int(os.getenv("SMTP_PORT", "465")),
+            username=os.getenv("EMAIL_ADDRESS"),
+            password=os.getenv("EMAIL_PASSWORD"),
+            use_ssl=os.getenv("SMTP_USE_SSL", "true").lower() != "false",
+            timeout=float(os.getenv("SMTP_TIMEOUT", "10")),
+        )
+
+
+def is_permanent(error: BaseException) -> bool:
+    """
+    Whether the server refused the message itself (5xx), so sending it again won't help
+    """
+    return isinstance(error, smtplib.SMTPRecipientsRefused) or (
+        isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600
+    )
+
+
+def smtp_circuit_breaker() -> CircuitBreaker:
+    # A refused message is no sign of the server failing, unlike dropped connections and temporary errors
+    return CircuitBreaker.from_env("smtp", slow_call_seconds=10.0, is_failure=lambda error: not is_permanent(error))
+
+
+class SMTPConnectionPool:
+    """
+    Thread-safe pool of authenticated SMTP connections.
+
+    A connection that has been idle longer than ``max_idle`` seconds, or that
+    doesn't answer a NOOP, is closed and replaced when it is next acquired.
+    """
+
+    def __init__(self, config: SMTPConfig, max_idle: float = 60.0):
+        self.config = config
+        self.max_idle = max_idle
+        self.connections_opened = 0
+        self._idle: List[tuple] = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> smtplib.SMTP:
+        config = self.config
+        with timed("smtp", "connect"):
+            if config.use_ssl:
+                server = smtplib.SMTP_SSL(
+                    config.host, config.port, context=ssl.create_default_context(), timeout=config.timeout
+                )
+            else:
+                server = smtplib.SMTP(config.host, config.port, timeout=config.timeout)
+            if config.username and config.password:
+                server.login(config.username, config.password)
+        with self._lock:
+            self.connections_opened += 1
+        return server
+
+    @staticmethod
+    def _close(server: smtplib.SMTP) -> None:
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def acquire(self) -> smtplib.SMTP:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server, released_at = self._idle.pop()
+            if time.monotonic() - released_at > self.max_idle:
+                self._close(server)
+                continue
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            server.close()
+        return self._connect()
+
+    def release(self, server: smtplib.SMTP, broken: bool = False) -> None:
+        if broken:
+            server.close()
+            return
+        with self._lock:
+            self._idle.append((server, time.monotonic()))
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            self._close(server)
+
+
+class Mailer:
+    """
+    Delivers the emails in an Outbox from a background dispatcher.
+
+    Due messages are sent in batches of up to ``batch_size`` over one pooled
+    connection, with up to ``pool_size`` batches in flight. A message that fails
+    with a temporary error is retried with exponential backoff and jitter, up to
+    ``max_attempts`` attempts; permanent SMTP errors (5xx) fail it straight away.
+    With a ``breaker``, sends stop while its circuit is open, and the messages
+    it turned away are rescheduled for when it lets a probe through, without
+    counting as an attempt. Sent and failed messages are purged from the outbox
+    ``retention`` seconds after they finished.
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        pool_size: int = 2,
+        max_idle: float = 60.0,
+        batch_size: int = 20,
+        max_attempts: int = 6,
+        retry_base_delay: float = 5.0,
+        retry_max_delay: float = 600.0,
+        poll_interval: float = 1.0,
+        breaker: Optional[CircuitBreaker] = None,
+        retention: float = 7 * 24 * 3600,
+        purge_interval: float = 60.0,
+    ):
+        self.outbox = outbox
+        self.pool_size = pool_size
+        self.max_idle = max_idle
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.poll_interval = poll_interval
+        self.breaker = breaker
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self.purged = 0
+        self._purged_at: Optional[float] = None
+        self.pool: Optional[SMTPConnectionPool] = None
+        self.batches_sent = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._dispatching = False
+        self._running = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self) -> None:
+        """
+        Starts the dispatcher on the running event loop, which submit must then be called from
+        """
+        if self._dispatcher is not None:
+            await self.stop()
+        requeued = await asyncio.to_thread(self.outbox.requeue_interrupted)
+        if requeued:
+            logger.info(f"Requeued {requeued} emails interrupted by a restart")
+        self.pool = SMTPConnectionPool(SMTPConfig.from_env(), max_idle=self.max_idle)
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="smtp")
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._running = True
+        self._dispatcher = asyncio.create_task(self._dispatch_forever())
+
+    async def stop(self) -> None:
+        # wait_for can swallow a cancellation that races with the wakeup, so the loop also checks this flag
+        self._running = False
+        if self._dispatcher is not None:
+            if self._loop is asyncio.get_running_loop():
+                self._dispatcher.cancel()
+                await asyncio.gather(self._dispatcher, return_exceptions=True)
+            # A dispatcher started on another loop ended when that loop was closed
+            self._dispatcher = None
+        self._loop = None
+        if self.pool is not None:
+            self.pool.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def join(self) -> None:
+        """
+        Waits until no email is due for delivery or being sent. Emails aren't due while the circuit is open.
+        """
+        while True:
+            next_attempt_at = await asyncio.to_thread(self.outbox.next_attempt_at)
+            due = next_attempt_at is not None and next_attempt_at <= time.time()
+            if self.breaker is not None and self.breaker.retry_after() > 0:
+                due = False
+            if not due and not self._dispatching:
+                return
+            await asyncio.sleep(0.01)
+
+    async def submit(self, message: Message) -> str:
+        """
+        Stores a message in the outbox and wakes the dispatcher. Must be called from the event loop
+        the mailer was started on.
+
+            Returns:
+                The email id to look the delivery status up with
+
+            Raises:
+                RuntimeError: If the mailer isn't started on the running event loop
+        """
+        if self._loop is not asyncio.get_running_loop():
+            raise RuntimeError("The mailer isn't started on this event loop")
+
+        email_id = await asyncio.to_thread(self.outbox.add, message)
+        self._wakeup.set()
+        return email_id
+
+    async def status(self, email_id: str) -> Optional[dict]:
+        return await asyncio.to_thread(self.outbox.status, email_id)
+
+    def _retry_delay(self, attempts: int) -> float:
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _purge(self) -> None:
+        if self._purged_at is not None and time.monotonic() - self._purged_at < self.purge_interval:
+            return
+        self._purged_at = time.monotonic()
+        purged = await asyncio.to_thread(self.outbox.purge, time.time() - self.retention)
+        if purged:
+            self.purged += purged
+            logger.info(f"Purged {purged} finished emails from the outbox")
+
+    async def _dispatch_forever(self) -> None:
+        while self._running:
+            try:
+                await self._dispatch_once()
+                await self._purge()
+            except Exception as e:
+                logger.error(f"Email dispatcher failed: {str(e)}")
+
+            next_attempt_at = await asyncio.to_thread(self.outbox.next_attempt_at)
+            timeout = self.poll_interval
+            if next_attempt_at is not None:
+                timeout = min(timeout, max(0.0, next_attempt_at - time.time()))
+            if self.breaker is not None and self.breaker.retry_after() > 0:
+                # Nothing can be sent until the circuit lets a probe through
+                timeout = self.breaker.retry_after()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _dispatch_once(self) -> None:
+        """
+        Sends every message that is due, in batches over pooled connections
+        """
+        self._dispatching = True
+        try:
+            loop = asyncio.get_running_loop()
+            while self.breaker is None or self.breaker.retry_after() == 0:
+                messages = await asyncio.to_thread(self.outbox.claim_due, self.batch_size * self.pool_size)
+                if not messages:
+                    return
+                batches = [messages[i:i + self.batch_size] for i in range(0, len(messages), self.batch_size)]
+                results = await asyncio.gather(*(
+                    loop.run_in_executor(self._executor, self._send_batch, batch) for batch in batches
+                ))
+                self.batches_sent += len(batches)
+                outcomes = [
+                    (outbox_message, error)
+                    for batch, errors in zip(batches, results)
+                    for outbox_message, error in zip(batch, errors)
+                ]
+                await asyncio.to_thread(self._record_all, outcomes)
+        finally:
+            self._dispatching = False
+
+    def _record_all(self, outcomes: List[Tuple[OutboxMessage, Optional[Exception]]]) -> None:
+        for outbox_message, error in outcomes:
+            self._record(outbox_message, error)
+
+    def _record(self, outbox_message: OutboxMessage, error: Optional[Exception]) -> None:
+        email_id = outbox_message.email_id
+        if isinstance(error, CircuitOpen):
+            # Never tried, so it keeps its attempts
+            self.outbox.mark_retry(email_id, outbox_message.attempts, time.time() + error.retry_after, str(error))
+            return
+        attempts = outbox_message.attempts + 1
+        if error is None:
+            self.outbox.mark_sent(email_id, attempts)
+            logger.info(f"Email {email_id} sent to {outbox_message.message['To']}")
+            return
+
+        if is_permanent(error) or attempts >= self.max_attempts:
+            self.outbox.mark_failed(email_id, attempts, str(error))
+            logger.error(f"Email {email_id} failed after {attempts} attempts: {str(error)}")
+        else:
+            delay = self._retry_delay(attempts)
+            self.outbox.mark_retry(email_id, attempts, time.time() + delay, str(error))
+            logger.info(f"Email {email_id} attempt {attempts} failed, retrying in {delay:.1f}s: {str(error)}")
+
+    def _send_batch(self, batch: List[OutboxMessage]) -> List[Optional[Exception]]:
+        """
+        Sends a batch over one connection, returning the error of each message (None if sent)
+        """
+        errors: List[Optional[Exception]] = []
+        server = None
+        # Delivery runs outside any request, so each batch is a trace of its own
+        with tracing.start_trace("smtp.send_batch", messages=len(batch)):
+            for outbox_message in batch:
+                try:
+                    with self.breaker.guard() if self.breaker is not None else nullcontext():
+                        if server is None:
+                            server = self.pool.acquire()
+                        with timed("smtp", "send"):
+                            server.send_message(outbox_message.message)
+                    errors.append(None)
+                except CircuitOpen as e:
+                    errors.append(e)
+                except (smtplib.SMTPServerDisconnected, OSError) as e:
+                    # The connection is gone, the rest of the batch gets a new one
+                    if server is not None:
+                        self.pool.release(server, broken=True)
+                        server = None
+                    errors.append(e)
+                except smtplib.SMTPException as e:
+                    # The server rejected this message, the connection itself is still usable
+                    errors.append(e)
+        if server is not None:
+            self.pool.release(server)
+        return errors
+
+    def stats(self) -> dict:
+        return {
+            "outbox": self.outbox.counts(),
+            "batches_sent": self.batches_sent,
+            "purged": self.purged,
+            "connections_opened": self.pool.connections_opened if self.pool is not None else 0,
+        }
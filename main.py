@@ -1,62 +1,205 @@
+import asyncio
+import base64
+import functools
+import json
+import math
 import os
-import smtplib
-import ssl
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, List, Optional, Tuple
 
-from fastapi import FastAPI, status, Request, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, status, Request, Response, Query
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, StreamingResponse
 import httpx
 from datetime import datetime
 from pathlib import Path
-import firebase_admin
-from firebase_admin import credentials, firestore
 import logging
-from pydantic import BaseModel
 
 from fastapi.middleware.cors import CORSMiddleware
 
-from exa_py import Exa
+import admission
+import tracing
+import ultravox
+from admission import CRITICAL, EXEMPT, HIGH, LOW, AdmissionController, InstrumentedAdmissionRoute
+from cache import DiskCache, TTLCache, TwoTierCache
+from circuit import CircuitBreaker, CircuitOpen
+from export import gzip_chunks, ndjson_chunks, parse_since
+from http_cache import NO_STORE, REVALIDATE, conditional_json, etag_matches, make_etag, not_modified, set_validators
+from resource_queue import QueueFull, ResourceFetchQueue
+from mailer import Mailer, smtp_circuit_breaker
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY, set_slow_operation_threshold, timed
+from models import (
+    CallCreated, CognitiveDistortions, CognitiveDistortionsRequest, DistortionsSaved, Email, EmailQueued,
+    EmailStatus, Message, Resource, ResourcesRequest, SessionBundle, SessionDocument, SummaryPage,
+    SummaryRequest, SummarySaved, TaskRequest, TaskSaved, ToolResult, UserTasks, WaitlistRequest,
+    validation_message,
+)
+from outbox import Outbox
+from payload import compile_payload_template, get_payload_json
+from tracing import TracingMiddleware, span
+from warmup import WarmUp
+from storage import COGNITIVE_DISTORTIONS, RESOURCES, SUMMARY, TASKS, create_store
+from write_behind import BufferFull, WriteBehindBuffer
+
+if TYPE_CHECKING:
+    from exa_py import Exa
+
+
+
+# Shared Ultravox client, created in the lifespan hook
+http_client: Optional[httpx.AsyncClient] = None
+# Deadline, retries and hedging of call creation, see ultravox.CallCreator
+call_creator = ultravox.CallCreator.from_env()
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None:
+        http_client = ultravox.create_client()
+    return http_client
+
 
-from payload import get_payload
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    http_client = ultravox.create_client()
+    await resource_queue.start()
+    await mailer.start()
+    await write_buffer.start()
+    tracing.set_exporter(trace_exporter)
+    admission.set_controller(admission_controller if ADMISSION else None)
+    # /ready answers 503 until the connections are open, see warm_up_steps()
+    if WARMUP:
+        warmup.start(warm_up_steps())
+    else:
+        warmup.skip()
+    yield
+    await warmup.stop()
+    admission.set_controller(None)
+    await write_buffer.stop()
+    await mailer.stop()
+    await resource_queue.stop()
+    await http_client.aclose()
+    http_client = None
+    tracing.set_exporter(None)
+    if trace_exporter is not None:
+        trace_exporter.close()
 
 
+# orjson encodes the response bodies, several times faster than the standard json module
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+# Every route declared below is counted and timed in /metrics, and goes through admission control
+app.router.route_class = InstrumentedAdmissionRoute
 
+# Priority classes of the routes, see admission.py. Routes not listed are normal.
+ROUTE_PRIORITIES = {
+    # Tool callbacks, the agent waits on them mid-conversation
+    "POST /sessions/resources": CRITICAL,
+    "POST /sessions/tasks": CRITICAL,
+    "POST /sessions/cognitive-distortions": CRITICAL,
+    "POST /sessions/summary": CRITICAL,
+    "POST /sessions/{session_id}/calls": HIGH,
+    "GET /summaries": LOW,
+    "GET /export/sessions": LOW,
+    "POST /waitlist": LOW,
+    # Health checks and monitoring must answer however busy the worker is
+    "GET /": EXEMPT,
+    "GET /ready": EXEMPT,
+    "GET /stats": EXEMPT,
+    "GET /metrics": EXEMPT,
+}
+ADMISSION = os.getenv("ADMISSION", "true").lower() != "false"
+# An export streams every session, a couple at a time is plenty
+admission_controller = AdmissionController.from_env(ROUTE_PRIORITIES, route_limits={"GET /export/sessions": 2})
 
-app = FastAPI()
+
+@app.exception_handler(RequestValidationError)
+async def request_validation_error(request: Request, exc: RequestValidationError):
+    """
+    Answers a body that doesn't match its model with a 400 and a message the agent can act on.
+    Bad query and path parameters keep FastAPI's 422.
+    """
+    body_errors = [error for error in exc.errors() if error["loc"][:1] == ("body",)]
+    if not body_errors:
+        return await request_validation_exception_handler(request, exc)
+    return ORJSONResponse(
+        content={"message": validation_message(body_errors)},
+        status_code=status.HTTP_400_BAD_REQUEST
+    )
 
 
-# Set up logger
-logging.basicConfig(level=logging.INFO)
+# Set up logger, every line carries the trace id of the request it was logged in
+tracing.install_log_record_factory()
+logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(trace_id)s:%(message)s")
 logger = logging.getLogger(__name__)
 
-# Initialize Firestore database
-cred = credentials.Certificate(os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "./firebase-key.json"))
-firebase_app = firebase_admin.initialize_app(cred)
-db = firestore.client()
+# Finished traces go to a JSON lines file or an OTLP collector, see tracing.exporter_from_env
+trace_exporter = tracing.exporter_from_env()
+
+# Calls to Firestore, Exa, Ultravox or SMTP slower than this are logged
+set_slow_operation_threshold(float(os.getenv("SLOW_OPERATION_MS", "1000")) / 1000)
+
+# Per-session documents polled by the frontend, invalidated by every write through the store.
+# Set SESSION_CACHE_SIZE to 0 to read the backend every time.
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1024"))
+# Firestore unless STORAGE_BACKEND says sqlite or memory, see storage.create_store
+store = create_store(
+    cache=TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=float(os.getenv("SESSION_CACHE_TTL", "30")))
+    if SESSION_CACHE_SIZE > 0 else None,
+)
+
+# Opt-in: acknowledge tool calls before their writes reach Firestore
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "false").lower() == "true"
+write_buffer = WriteBehindBuffer(
+    commit=lambda writes: store.commit_session_writes(writes),
+    flush_interval=float(os.getenv("WRITE_BEHIND_FLUSH_MS", "50")) / 1000,
+    max_pending=int(os.getenv("WRITE_BEHIND_MAX_OPS", "100")),
+    max_buffered=int(os.getenv("WRITE_BEHIND_MAX_BUFFERED", "10000")),
+    max_attempts=int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "5")),
+)
+
+
+def session_writer():
+    """
+    Returns what the tool endpoints write through: the write-behind buffer if enabled, else the store.
+    While the store's circuit is open the buffer holds the writes until it recovers.
+    """
+    return write_buffer if WRITE_BEHIND or not store.available() else store
+
+
+async def write_session(write: Callable[[Any], Awaitable[None]]) -> None:
+    """
+    Makes a tool endpoint's write through session_writer(). A write the store turns away
+    with CircuitOpen, or that fails and leaves its circuit open, goes to the write-behind
+    buffer instead, to be flushed once the store recovers.
+
+        Raises:
+            BufferFull: If the write-behind buffer is full
+    """
+    writer = session_writer()
+    try:
+        await write(writer)
+    except Exception as e:
+        if writer is write_buffer or not (isinstance(e, CircuitOpen) or not store.available()):
+            raise
+        logger.warning(f"Store is unavailable, buffering the write: {str(e)}")
+        await write(write_buffer)
+
+FRONTEND_ORIGINS = ["https://maggieweb.vercel.app", "http://localhost:8080", "http://localhost:5173", "https://www.trymaggie.site"]  # Update if your frontend runs elsewhere
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["https://maggieweb.vercel.app", "http://localhost:8080", "http://localhost:5173", "https://www.trymaggie.site"],  # Update if your frontend runs elsewhere
+    allow_origins=FRONTEND_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # ETag for clients that send If-None-Match themselves instead of relying on the browser cache
+    expose_headers=["ETag", "Server-Timing"],
 )
-
-class Insights(BaseModel):
-    summary: str
-    tasks: list[str]
-    topics: list[str]
-
-class Email(BaseModel):
-    email_address: str
-    insights: Insights
-
-class Resource(BaseModel):
-    url: str
-    title: str
-    text: str
-    image: Optional[str] = None
-
+# Outermost, so the trace and the Server-Timing total cover the whole request
+app.add_middleware(TracingMiddleware, timing_allow_origins=FRONTEND_ORIGINS)
 
 def parse_results(data:List[dict]) -> List[Resource]:
     results = []
@@ -77,72 +220,229 @@ def parse_results(data:List[dict]) -> List[Resource]:
         ))
     return results
 
-def fetch_and_store_resources(query: str, session_id: str) -> List[Resource]:
-    if not session_id:
-        logger.error("No session ID provided for storing resources")
-        return []
-        
-    exa = Exa(api_key = os.getenv("EXA_API_KEY"))
-    result = exa.search_and_contents(
-        query,
-        text = True,
-        type = "auto",
-        num_results = 2
-    )
+# Exa client, built on first use so importing this module doesn't import the SDK
+exa_client: Optional["Exa"] = None
+exa_breaker = CircuitBreaker.from_env("exa", slow_call_seconds=10.0)
+
+# Search results keyed by normalized query, in memory and on disk.
+# Set EXA_CACHE_PATH to an empty string to keep them in memory only.
+EXA_CACHE_TTL = float(os.getenv("EXA_CACHE_TTL", "86400"))
+EXA_CACHE_PATH = os.getenv("EXA_CACHE_PATH", ".cache/exa.sqlite3")
+resource_cache = TwoTierCache(
+    TTLCache(maxsize=int(os.getenv("EXA_CACHE_SIZE", "512")), ttl=EXA_CACHE_TTL),
+    DiskCache(EXA_CACHE_PATH, ttl=EXA_CACHE_TTL) if EXA_CACHE_PATH else None,
+)
+
+
+def get_exa_client() -> "Exa":
+    global exa_client
+    if exa_client is None:
+        import exa_py
+
+        exa_client = exa_py.Exa(api_key = os.getenv("EXA_API_KEY"))
+    return exa_client
+
+
+# Opening outbound connections before taking traffic, turned off with WARMUP=false
+WARMUP = os.getenv("WARMUP", "true").lower() != "false"
+
+
+async def warm_up_payload() -> None:
+    compile_payload_template()
+    get_payload_json("warmup")
+
+
+async def warm_up_store() -> None:
+    await store.warm_up()
+
+
+async def warm_up_ultravox() -> None:
+    await ultravox.warm_up(get_http_client(), int(os.getenv("ULTRAVOX_WARM_CONNECTIONS", "1")))
+
+
+async def warm_up_exa() -> None:
+    # Importing the SDK and building the client is blocking work
+    await asyncio.get_running_loop().run_in_executor(exa_executor, get_exa_client)
+
+
+async def warm_up_models() -> None:
+    # First use of a model's validator and serializer, and of the orjson encoder
+    TaskRequest.model_validate({"session_id": "warmup", "task": "Warm up"})
+    CognitiveDistortionsRequest.model_validate({"session_id": "warmup", "cognitiveDistortions": ["Labeling"]})
+    ORJSONResponse(content=CallCreated(joinUrl="wss://warmup").model_dump())
+
+
+def warm_up_steps() -> dict:
+    """
+    Returns the warm-up steps that apply to this configuration
+    """
+    steps = {"payload": warm_up_payload, "models": warm_up_models, "store": warm_up_store}
+    if os.getenv("ULTRAVOX_API_KEY"):
+        steps["ultravox"] = warm_up_ultravox
+    if os.getenv("EXA_API_KEY"):
+        steps["exa"] = warm_up_exa
+    return steps
+
+
+warmup = WarmUp(timeout=float(os.getenv("WARMUP_TIMEOUT", "30")))
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a search query so trivially different phrasings share a cache entry
+    """
+    return " ".join(query.lower().split()).strip(" .,;:!?\"'")
+
+
+async def search_resources(query: str) -> List[Resource]:
+    """
+    Searches Exa for resources about a query, answering repeated queries from the cache
+    """
+    key = normalize_query(query)
+    cached = await resource_cache.get_async(key)
+    if cached is not None:
+        logger.info(f"Resource cache hit for query: {key}")
+        return [Resource(**resource) for resource in cached]
+
+    # The Exa SDK is synchronous, run it on the resource fetch threads
+    with exa_breaker.guard(), timed("exa", "search_and_contents"):
+        result = await asyncio.get_running_loop().run_in_executor(
+            exa_executor,
+            functools.partial(
+                get_exa_client().search_and_contents,
+                query,
+                text = True,
+                type = "auto",
+                num_results = 2
+            )
+        )
     data = result.results
     if not data:
         logger.error("No websites found")
         return []
-    
+
     resources = parse_results(data)
-    
+    await resource_cache.set_async(key, [resource.model_dump() for resource in resources])
+    return resources
+
+
+async def store_resources(session_id: str, resources: List[Resource]) -> None:
     # Store all resources in a single document under sessions/{session_id}/resources/
     if resources:
         try:
-            doc_ref = db.collection("sessions").document(session_id).collection("resources").document("resources_doc")
             resource_data = {
                 "timestamp": datetime.now().isoformat(),
                 "resources": [resource.model_dump() for resource in resources]  # Store as array
             }
-            doc_ref.set(resource_data)
+            await store.set_session_document(session_id, RESOURCES, resource_data)
             logger.info(f"Successfully stored {len(resources)} resources for session {session_id}")
         except Exception as e:
             logger.error(f"Failed to store resources in Firestore: {str(e)}")
-    
-    return resources
 
-@app.post("/sessions/resources")
-async def create_session_resources(request: Request, background_tasks: BackgroundTasks):
-    # Parse the request body first
-    body = await request.json()
-    
-    # Extract session_id from body
-    session_id = body.get("session_id", "")
-    
-    if not session_id:
-        return JSONResponse(
-            content={"message": "No session ID provided"},
-            status_code=status.HTTP_400_BAD_REQUEST
-        )
-        
-    query = body.get("query", "")
-    if not query:
-        return JSONResponse(
-            content={"message": "No query provided"},
-            status_code=status.HTTP_400_BAD_REQUEST
+
+# Resource fetches run on their own workers and threads rather than the shared threadpool
+RESOURCE_FETCH_CONCURRENCY = int(os.getenv("RESOURCE_FETCH_CONCURRENCY", "4"))
+exa_executor = ThreadPoolExecutor(max_workers=RESOURCE_FETCH_CONCURRENCY, thread_name_prefix="exa")
+resource_queue = ResourceFetchQueue(
+    search=search_resources,
+    store=store_resources,
+    key=normalize_query,
+    concurrency=RESOURCE_FETCH_CONCURRENCY,
+    max_queue=int(os.getenv("RESOURCE_FETCH_QUEUE_SIZE", "100")),
+)
+
+@app.post("/sessions/resources", response_model=ToolResult)
+async def create_session_resources(body: ResourcesRequest):
+    session_id = body.session_id
+    if not exa_breaker.available():
+        # Only the cache can answer while Exa's circuit is open or its half-open probes are taken
+        cached = await resource_cache.get_async(normalize_query(body.query))
+        if cached is None:
+            logger.warning(f"Exa circuit is {exa_breaker.state}, no resources for session {session_id}")
+            return ORJSONResponse(
+                content={"message": "Resources aren't available right now. Continue the conversation with the user."},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(max(1, math.ceil(exa_breaker.retry_after())))}
+            )
+        await store_resources(session_id, [Resource(**resource) for resource in cached])
+        return {
+            "message": "Resources created successfully. Continue the conversation with the user.",
+            "status": "success",
+            "status_code": status.HTTP_200_OK
+        }
+    try:
+        resource_queue.submit(body.query, session_id)
+    except QueueFull:
+        logger.error(f"Resource fetch queue is full, dropping query for session {session_id}")
+        return ORJSONResponse(
+            content={"message": "Resources can't be created right now. Continue the conversation with the user."},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE
         )
-    background_tasks.add_task(fetch_and_store_resources, query, session_id)
     return {
         "message": "Resources created successfully. Continue the conversation with the user.",
         "status": "success",
         "status_code": status.HTTP_200_OK
     }
     
+mailer = Mailer(
+    Outbox(os.getenv("EMAIL_OUTBOX_PATH", ".data/outbox.sqlite3")),
+    pool_size=int(os.getenv("SMTP_POOL_SIZE", "2")),
+    max_idle=float(os.getenv("SMTP_MAX_IDLE", "60")),
+    batch_size=int(os.getenv("EMAIL_BATCH_SIZE", "20")),
+    max_attempts=int(os.getenv("EMAIL_MAX_ATTEMPTS", "6")),
+    retry_base_delay=float(os.getenv("EMAIL_RETRY_BASE_DELAY", "5")),
+    retry_max_delay=float(os.getenv("EMAIL_RETRY_MAX_DELAY", "600")),
+    poll_interval=float(os.getenv("EMAIL_POLL_INTERVAL", "1")),
+    breaker=smtp_circuit_breaker(),
+    retention=float(os.getenv("OUTBOX_RETENTION_SECONDS", str(7 * 24 * 3600))),
+)
+
 @app.get("/")
-def read_root():
-    return {"message": "Hello, World!"}
+def read_root(request: Request):
+    return conditional_json(request, {"message": "Hello, World!"}, cache_control="public, max-age=3600")
+
+@app.get("/ready")
+def get_ready(response: Response):
+    """
+    Readiness probe for the load balancer: 503 until warm-up has finished, and again while shutting down.
+    """
+    set_validators(response, None, NO_STORE)
+    if not warmup.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return warmup.status()
+
+@app.get("/stats")
+def get_stats(response: Response):
+    """
+    Endpoint exposing internal counters for monitoring.
+    """
+    set_validators(response, None, NO_STORE)
+    return {
+        "session_cache": store.cache_stats(),
+        "resource_cache": resource_cache.stats(),
+        "resource_queue": resource_queue.stats(),
+        "mailer": mailer.stats(),
+        "write_behind": dict(write_buffer.stats(), enabled=WRITE_BEHIND),
+        "admission": admission_controller.stats(),
+        "circuits": {
+            "exa": exa_breaker.stats(),
+            "smtp": mailer.breaker.stats() if mailer.breaker is not None else None,
+            "store": store.breaker.stats() if store.breaker is not None else None,
+        },
+    }
+
+@app.get("/metrics")
+def get_metrics():
+    """
+    Endpoint exposing request and dependency metrics in the Prometheus text format.
+    """
+    return Response(
+        content=REGISTRY.render(),
+        media_type=METRICS_CONTENT_TYPE,
+        headers={"Cache-Control": NO_STORE}
+    )
 
-@app.post("/emails")
+@app.post("/emails", response_model=EmailQueued, status_code=status.HTTP_202_ACCEPTED)
 async def send_email(email: Email):
     """
     Sends an email to the user about the insights of the conversation
@@ -151,31 +451,18 @@ async def send_email(email: Email):
             email_address: The users's email address
             
         Returns:
-            A confirmation message
+            The id of the queued email, with a 202 status
         """
     email_address = email.email_address
     insights = email.insights
 
-    if not email_address:
-        logger.error("No email address provided")
-        return JSONResponse(
-            content={"message": "No email address provided"},
-            status_code=status.HTTP_400_BAD_REQUEST
-        )
-    if not insights:
-        logger.error("No insights provided")
-        return JSONResponse(
-            content={"message": "No insights provided"},
-            status_code=status.HTTP_400_BAD_REQUEST
-        )
-
     sender_email = os.getenv("EMAIL_ADDRESS")
     password = os.getenv("EMAIL_PASSWORD")
     
     # Check if email credentials are configured
     if not sender_email or not password:
         logger.error("Email credentials not configured")
-        return JSONResponse(
+        return ORJSONResponse(
             content={"message": "Email service not properly configured"},
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
@@ -212,34 +499,33 @@ async def send_email(email: Email):
     
     msg.attach(MIMEText(email_body, 'plain'))
 
-    smtp_server = "smtp.gmail.com"
-    port = 465  # For SSL
+    # Stored in the outbox, delivery happens on the mailer's SMTP threads
+    email_id = await mailer.submit(msg)
+    logger.info(f"Email {email_id} to {email_address} queued")
+    if mailer.breaker is not None and mailer.breaker.retry_after() > 0:
+        return {"message": "Email queued, delivery is delayed while the email service is unavailable", "email_id": email_id}
+    return {"message": "Email queued for delivery", "email_id": email_id}
 
-    try:
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(smtp_server, port, context=context) as server:
-            server.login(sender_email, password)
-            server.send_message(msg)
-        logger.info(f"Email sent to {email_address}")
-        return JSONResponse(
-            content={"message": "Email sent successfully"},
-            status_code=status.HTTP_200_OK
-        )
-    except Exception as e:
-        error_msg = str(e)
-        logger.error(f"Failed to send email: {error_msg}")
-        return JSONResponse(
-            content={"message": f"Failed to send email: {error_msg}"},
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
+@app.get("/emails/{email_id}", response_model=EmailStatus)
+async def get_email_status(email_id: str, request: Request):
+    """
+    Endpoint to check the delivery status of an email sent through POST /emails.
+    """
+    email_status = await mailer.status(email_id)
+    if email_status is None:
+        return ORJSONResponse(
+            content={"error": "Email not found"},
+            status_code=status.HTTP_404_NOT_FOUND
         )
+    return conditional_json(request, email_status)
 
-@app.post("/sessions/{session_id}/calls")
+@app.post("/sessions/{session_id}/calls", response_model=CallCreated)
 async def create_session_call(session_id: str, request: Request):
     logger.info(f"Received Ultravox request with session_id: {session_id}")
     
     if not session_id:
         logger.error("No session ID provided in request")
-        return JSONResponse(
+        return ORJSONResponse(
             content={"message": "No session ID provided"},
             status_code=status.HTTP_400_BAD_REQUEST
         )
@@ -247,25 +533,19 @@ async def create_session_call(session_id: str, request: Request):
     api_key = os.getenv("ULTRAVOX_API_KEY")
     if not api_key:
         logger.error("Ultravox API key not configured in environment variables")
-        return JSONResponse(
+        return ORJSONResponse(
             content={"error": "Error, please try again later"},
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
     try:
-        payload = get_payload(session_id)
+        with span("payload"):
+            payload = get_payload_json(session_id)
         logger.info(f"Generated payload for session {session_id}")
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.ultravox.ai/api/calls",
-                headers={
-                    "Content-Type": "application/json",
-                    "X-Unsafe-API-Key": api_key,
-                },
-                json=payload,
-            )
-            logger.info(f"Ultravox API response status: {response.status_code}")
-            logger.info(f"Ultravox API response body: {response.text}")
+        with timed("ultravox", "create_call"):
+            response = await call_creator.create(get_http_client(), payload, api_key)
+        logger.info(f"Ultravox API response status: {response.status_code}")
+        logger.info(f"Ultravox API response body: {response.text}")
         try:
             data = response.json()
             # logger.info("data", data)
@@ -276,82 +556,56 @@ async def create_session_call(session_id: str, request: Request):
         else:
             error_text = response.text
             # logger.info(f"Ultravox API error: {error_text}")
-            return JSONResponse(
+            return ORJSONResponse(
                 content={"error": "Failed to create call", "details": error_text},
                 status_code=response.status_code
             )
+    except ultravox.DeadlineExceeded as e:
+        logger.error(f"Creating Ultravox call for session {session_id} timed out: {str(e)}")
+        return ORJSONResponse(
+            content={"error": "Ultravox took too long to create the call, please try again"},
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT
+        )
     except Exception as e:
-        return JSONResponse(
+        return ORJSONResponse(
             content={"error": "Internal server error"},
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         ) 
 
-@app.post("/sessions/cognitive-distortions")
-async def add_session_cognitive_distortions(request: Request):
+@app.post("/sessions/cognitive-distortions", response_model=DistortionsSaved)
+async def add_session_cognitive_distortions(body: CognitiveDistortionsRequest):
     """
     Endpoint handler for the cognitiveDistortions tool.
     Receives cognitive distortions and the session id and stores them in Firestore.
+    Distortions already saved for the session aren't added again.
     """
     try:
-        # Parse the request body
-        body = await request.json()
+        session_id = body.session_id
+        cognitive_distortions = body.cognitiveDistortions
         
-        # Extract session_id from body
-        session_id = body.get("session_id", "")
-        
-        if not session_id:
-            return JSONResponse(
-                content={"message": "No session ID provided"},
-                status_code=status.HTTP_400_BAD_REQUEST
-            )
-            
-        # logger.info("Received cognitive distortions:", body)
-        
-        # Extract the cognitive distortions
-        cognitive_distortions = body.get("cognitiveDistortions", [])
-        
-        if not cognitive_distortions:
-            return JSONResponse(
-                content={"message": "No cognitive distortions provided"},
-                status_code=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Get reference to the document under sessions/{session_id}/cognitive-distortions/distortions_doc
-        doc_ref = db.collection("sessions").document(session_id).collection("cognitive-distortions").document("distortions_doc")
-        doc = doc_ref.get()
-        
-        # Check if document already exists
-        if doc.exists:
-            # Document exists, append to existing distortions list
-            existing_data = doc.to_dict()
-            existing_distortions = existing_data.get("distortions", [])
-            existing_distortions.extend(cognitive_distortions)
-            
-            distortion_data = {
-                "timestamp": datetime.now().isoformat(),
-                "distortions": existing_distortions
-            }
-            doc_ref.update(distortion_data)
-        else:
-            # Document doesn't exist, create new with distortions list
-            distortion_data = {
-                "timestamp": datetime.now().isoformat(),
-                "distortions": cognitive_distortions
-            }
-            doc_ref.set(distortion_data)
+        # Append to the document under sessions/{session_id}/cognitive-distortions/distortions_doc
+        await write_session(lambda writer: writer.append_to_session_array(
+            session_id, COGNITIVE_DISTORTIONS, "distortions", cognitive_distortions
+        ))
         
-        # logger.info(f"Cognitive distortions saved to Firestore: {distortion_data}")
+        # logger.info(f"Cognitive distortions saved to Firestore: {cognitive_distortions}")
         
         return {
-            "message": "Cognitive distortions saved successfully. Continue the conversation with the user.",
-            "distortion_id": doc_ref.id,
+            "message": "Cognitive distortions saved successfully. Distortions already saved for this session are kept once. Continue the conversation with the user.",
+            "distortion_id": COGNITIVE_DISTORTIONS[1],
             "status": "success",
             "status_code": status.HTTP_200_OK
         }
         
+    except BufferFull:
+        logger.error(f"Write-behind buffer is full, cognitive distortions for session {session_id} not saved")
+        return ORJSONResponse(
+            content={"message": "Failed to save cognitive distortions right now. You can still continue the conversation with the user."},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
     except Exception as e:
         logger.info(f"Error saving cognitive distortions: {str(e)}")
-        return JSONResponse(
+        return ORJSONResponse(
             content={
                 "message": "Failed to save cognitive distortions. You can still continue the conversation with the user.",
                 "error": str(e)
@@ -359,56 +613,45 @@ async def add_session_cognitive_distortions(request: Request):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
-@app.post("/sessions/summary")
-async def create_session_summary(request: Request):
-    # logger.info("in conversation summary")
+@app.post("/sessions/summary", response_model=SummarySaved)
+async def create_session_summary(body: SummaryRequest):
     """
     Endpoint handler for the summarizeConversation tool.
     Receives and processes conversation summaries from Maggie.
     """
     try:
-        # Parse the request body
-        body = await request.json()
-        
-        # Extract session_id from body
-        session_id = body.get("session_id", "")
-        
-        if not session_id:
-            return JSONResponse(
-                content={"message": "No session ID provided"},
-                status_code=status.HTTP_400_BAD_REQUEST
-            )
-            
-        # Extract the data
-        conversation_summary = body.get("conversationSummary", "")
-        identified_distortions = body.get("identifiedCognitiveDistortions", [])
-        suggested_exercises = body.get("suggestedExercises", "")
+        session_id = body.session_id
         
         # Create a timestamped summary object
         summary = {
             "timestamp": datetime.now().isoformat(),
-            "summary": conversation_summary,
-            "cognitiveDistortions": identified_distortions,
-            "suggestedExercises": suggested_exercises
+            "summary": body.conversationSummary,
+            "cognitiveDistortions": body.identifiedCognitiveDistortions,
+            "suggestedExercises": body.suggestedExercises
         }
         
         # Save the summary to Firestore under sessions/{session_id}/summaries/
-        doc_ref = db.collection("sessions").document(session_id).collection("summaries").document("summary_doc")
-        doc_ref.set(summary)
+        await write_session(lambda writer: writer.set_session_document(session_id, SUMMARY, summary))
         
         # Return a success response
         # logger.info("Summary saved to Firestore:", summary)
         
         return {
             "message": "Conversation summary saved successfully. Continue the conversation with the user.",
-            "summary_id": doc_ref.id,
+            "summary_id": SUMMARY[1],
             "status": "success",
             "status_code": status.HTTP_200_OK
         }
         
+    except BufferFull:
+        logger.error(f"Write-behind buffer is full, conversation summary for session {session_id} not saved")
+        return ORJSONResponse(
+            content={"message": "Failed to save conversation summary right now. You can still continue the conversation with the user."},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
     except Exception as e:
         logger.info(f"Error saving conversation summary: {str(e)}")
-        return JSONResponse(
+        return ORJSONResponse(
             content={
                 "message": "Failed to save conversation summary. You can still continue the conversation with the user.",
                 "error": str(e)
@@ -416,70 +659,38 @@ async def create_session_summary(request: Request):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
-@app.post("/sessions/tasks")
-async def create_session_task(request: Request):
+@app.post("/sessions/tasks", response_model=TaskSaved)
+async def create_session_task(body: TaskRequest):
     """
     Endpoint handler for the addUserTasks tool.
     Receives and stores tasks created for the user during the conversation.
+    A task already saved for the session isn't added again.
     """
     try:
-        # Parse the request body
-        body = await request.json()
+        session_id = body.session_id
+        task = body.task
         
-        # Extract session_id from body
-        session_id = body.get("session_id", "")
+        # Append to the document under sessions/{session_id}/tasks/tasks_doc
+        await write_session(lambda writer: writer.append_to_session_array(session_id, TASKS, "tasks", [task]))
         
-        if not session_id:
-            return JSONResponse(
-                content={"message": "No session ID provided"},
-                status_code=status.HTTP_400_BAD_REQUEST
-            )
-            
-        # Extract the tasks
-        task = body.get("task", "")
-        
-        if not task:
-            return JSONResponse(
-                content={"message": "No task provided"},
-                status_code=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Get reference to the document under sessions/{session_id}/tasks/
-        doc_ref = db.collection("sessions").document(session_id).collection("tasks").document("tasks_doc")
-        doc = doc_ref.get()
-        
-        # Check if document already exists
-        if doc.exists:
-            # Document exists, append to existing tasks list
-            existing_data = doc.to_dict()
-            existing_tasks = existing_data.get("tasks", [])
-            existing_tasks.append(task)
-            
-            tasks_data = {
-                "timestamp": datetime.now().isoformat(),
-                "tasks": existing_tasks
-            }
-            doc_ref.update(tasks_data)
-        else:
-            # Document doesn't exist, create new with tasks list
-            tasks_data = {
-                "timestamp": datetime.now().isoformat(),
-                "tasks": [task]
-            }
-            doc_ref.set(tasks_data)
-        
-        logger.info(f"User tasks saved to Firestore: {tasks_data}")
+        logger.info(f"User task saved to Firestore: {task}")
         
         return {
-            "message": "User task saved successfully. Continue the conversation with the user.",
-            "task_id": doc_ref.id,
+            "message": "User task saved successfully. A task already saved for this session is kept once. Continue the conversation with the user.",
+            "task_id": TASKS[1],
             "status": "success",
             "status_code": status.HTTP_200_OK
         }
         
+    except BufferFull:
+        logger.error(f"Write-behind buffer is full, user task for session {session_id} not saved")
+        return ORJSONResponse(
+            content={"message": "Failed to save user task right now. You can still continue the conversation with the user."},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
     except Exception as e:
         logger.info(f"Error saving user task: {str(e)}")
-        return JSONResponse(
+        return ORJSONResponse(
             content={
                 "message": "Failed to save user task. You can still continue the conversation with the user.",
                 "error": str(e)
@@ -487,134 +698,212 @@ async def create_session_task(request: Request):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
-@app.get("/summaries")
-async def get_all_summaries():
+def circuit_open_response(error: CircuitOpen) -> ORJSONResponse:
+    """
+    The answer to a request that needed a dependency whose circuit is open
+    """
+    return ORJSONResponse(
+        content={"error": f"{error.dependency} is unavailable, please try again later"},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(math.ceil(error.retry_after) or 1)}
+    )
+
+
+def encode_cursor(timestamp: str, session_id: str) -> str:
     """
-    Endpoint to retrieve all conversation summaries from Firestore.
+    Encodes the position of the last summary of a page as an opaque cursor
+    """
+    raw = json.dumps([timestamp, session_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """
+    Decodes a cursor made by encode_cursor, raising ValueError if it is malformed
     """
     try:
-        # Get all session documents first, then their summaries
-        sessions_ref = db.collection("sessions")
-        session_docs = sessions_ref.stream()
-        
-        # Convert to list of dictionaries
-        summaries = []
-        for session_doc in session_docs:
-            session_id = session_doc.id
-            # Get the summary for this session
-            summary_ref = db.collection("sessions").document(session_id).collection("summaries").document("summary_doc")
-            summary_doc = summary_ref.get()
-            if summary_doc.exists:
-                summary = summary_doc.to_dict()
-                summary["id"] = session_id  # Use session_id as the summary id
-                summary["session_id"] = session_id
-                summaries.append(summary)
-        
-        # Sort by timestamp (most recent first)
-        def safe_timestamp_sort(item):
-            timestamp = item.get("timestamp", "")
-            if hasattr(timestamp, 'isoformat'):
-                # If it's a datetime object, convert to string
-                return timestamp.isoformat()
-            return str(timestamp)
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, session_id = json.loads(raw)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(timestamp, str) or not isinstance(session_id, str):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return timestamp, session_id
+
+
+@app.get("/summaries", response_model=SummaryPage)
+async def get_all_summaries(
+    request: Request,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+):
+    """
+    Endpoint to retrieve conversation summaries from Firestore, most recent first.
+
+        Args:
+            limit: The maximum number of summaries to return
+            cursor: The next_cursor of the previous page
+
+        Returns:
+            A page of summaries and the cursor of the next page, which is null on the last page
+    """
+    try:
+        start_after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        return ORJSONResponse(
+            content={"message": "Invalid cursor"},
+            status_code=status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        # Query every sessions/*/summaries/ collection at once, fetching one extra
+        # summary to find out whether there is another page
+        summaries = await store.list_summaries(limit + 1, start_after)
         
-        summaries.sort(key=safe_timestamp_sort, reverse=True)
+        next_cursor = None
+        if len(summaries) > limit:
+            summaries = summaries[:limit]
+            last = summaries[-1]
+            next_cursor = encode_cursor(last["timestamp"], last["session_id"])
         
-        return {"summaries": summaries}
+        # The page comes from a query, so the ETag is a hash of the body rather than of update times
+        return conditional_json(request, {"summaries": summaries, "next_cursor": next_cursor})
         
+    except CircuitOpen as e:
+        return circuit_open_response(e)
     except Exception as e:
         logger.info(f"Error retrieving conversation summaries: {str(e)}")
-        return JSONResponse(
+        return ORJSONResponse(
             content={"error": str(e)},
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
-@app.get("/summaries/{summary_id}")
-async def get_summary(summary_id: str):
+@app.get("/export/sessions")
+async def export_sessions(
+    since: Optional[str] = None,
+    gzip: bool = False,
+    page_size: int = Query(500, ge=1, le=1000),
+):
+    """
+    Endpoint streaming every session's summary, tasks and cognitive distortions as NDJSON.
+
+        Args:
+            since: Only export sessions with a document updated at or after this ISO 8601 time
+            gzip: Compress the stream, sent with Content-Encoding: gzip
+            page_size: The number of sessions fetched per Firestore round trip
+
+        Returns:
+            One JSON object per line, written as the sessions are read
+    """
+    try:
+        since_time = parse_since(since) if since else None
+    except ValueError:
+        return ORJSONResponse(
+            content={"message": "Invalid since, expected an ISO 8601 date or datetime"},
+            status_code=status.HTTP_400_BAD_REQUEST
+        )
+
+    chunks = ndjson_chunks(store, since_time, page_size)
+    headers = {"Cache-Control": NO_STORE}
+    if gzip:
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(chunks, media_type="application/x-ndjson", headers=headers)
+
+@app.get("/summaries/{summary_id}", response_model=SessionDocument)
+async def get_summary(summary_id: str, request: Request, response: Response):
     """
     Endpoint to retrieve a specific conversation summary from Firestore.
     """
     try:
         # Get the document with the given ID from sessions/{summary_id}/summaries/summary_doc
-        doc_ref = db.collection("sessions").document(summary_id).collection("summaries").document("summary_doc")
-        doc = doc_ref.get()
+        documents = await store.get_versioned_session_documents(summary_id, [SUMMARY])
+        summary, version = documents[SUMMARY]
         
-        if not doc.exists:
-            return JSONResponse(
+        if summary is None:
+            return ORJSONResponse(
                 content={"error": "Summary not found"},
                 status_code=status.HTTP_404_NOT_FOUND
             )
         
-        # Convert to dictionary and add the ID
-        summary = doc.to_dict()
+        etag = make_etag("summary", summary_id, version)
+        if etag_matches(request, etag):
+            return not_modified(etag, REVALIDATE)
+        set_validators(response, etag, REVALIDATE)
+        
+        # Add the ID
         summary["id"] = summary_id
         summary["session_id"] = summary_id
         
         return summary
         
+    except CircuitOpen as e:
+        return circuit_open_response(e)
     except Exception as e:
         logger.info(f"Error retrieving conversation summary: {str(e)}")
-        return JSONResponse(
+        return ORJSONResponse(
             content={"error": str(e)},
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
-@app.get("/sessions/{session_id}/cognitive-distortions")
-async def get_session_cognitive_distortions(session_id: str):
+@app.get("/sessions/{session_id}/cognitive-distortions", response_model=CognitiveDistortions)
+async def get_session_cognitive_distortions(session_id: str, request: Request, response: Response):
     """
     Endpoint to retrieve cognitive distortions for a specific session from Firestore.
     """
     try:
-        # Get all documents from the sessions/{session_id}/cognitiveDistortions/ collection
-        distortions_ref = db.collection("sessions").document(session_id).collection("cognitiveDistortions")
-        docs = distortions_ref.stream()
+        # Get the document from sessions/{session_id}/cognitive-distortions/distortions_doc,
+        # which is where POST /sessions/cognitive-distortions writes
+        documents = await store.get_versioned_session_documents(session_id, [COGNITIVE_DISTORTIONS])
+        data, version = documents[COGNITIVE_DISTORTIONS]
+        
+        etag = make_etag("cognitive-distortions", session_id, version)
+        if etag_matches(request, etag):
+            return not_modified(etag, REVALIDATE)
+        set_validators(response, etag, REVALIDATE)
         
-        # Convert to list of dictionaries
         distortions_data = []
-        for doc in docs:
-            data = doc.to_dict()
-            data["id"] = doc.id
+        if data is not None:
+            data["id"] = COGNITIVE_DISTORTIONS[1]
+            data["session_id"] = session_id
             distortions_data.append(data)
         
-        # Sort by timestamp (most recent first)
-        def safe_timestamp_sort(item):
-            timestamp = item.get("timestamp", "")
-            if hasattr(timestamp, 'isoformat'):
-                return timestamp.isoformat()
-            return str(timestamp)
-        
-        distortions_data.sort(key=safe_timestamp_sort, reverse=True)
-        
         return {"cognitiveDistortions": distortions_data}
         
+    except CircuitOpen as e:
+        return circuit_open_response(e)
     except Exception as e:
         logger.info(f"Error retrieving cognitive distortions: {str(e)}")
-        return JSONResponse(
+        return ORJSONResponse(
             content={"error": str(e)},
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
-@app.get("/sessions/{session_id}/tasks")
-async def get_session_tasks(session_id: str):
+@app.get("/sessions/{session_id}/tasks", response_model=UserTasks)
+async def get_session_tasks(session_id: str, request: Request, response: Response):
     """
     Endpoint to retrieve all user tasks from Firestore.
     """
     try:
         if not session_id:
-            return JSONResponse(
+            return ORJSONResponse(
                 content={"message": "No session ID provided"},
                 status_code=status.HTTP_400_BAD_REQUEST
             )
         
         # Get the document from sessions/{session_id}/tasks/tasks_doc
-        tasks_ref = db.collection("sessions").document(session_id).collection("tasks").document("tasks_doc")
-        doc = tasks_ref.get()
+        documents = await store.get_versioned_session_documents(session_id, [TASKS])
+        data, version = documents[TASKS]
+        
+        etag = make_etag("tasks", session_id, version)
+        if etag_matches(request, etag):
+            return not_modified(etag, REVALIDATE)
+        set_validators(response, etag, REVALIDATE)
         
         # Convert to list of dictionaries
         tasks_data = []
-        if doc.exists:
-            data = doc.to_dict()
-            data["id"] = doc.id
+        if data is not None:
+            data["id"] = TASKS[1]
             data["session_id"] = session_id
             tasks_data.append(data)
         
@@ -629,72 +918,136 @@ async def get_session_tasks(session_id: str):
         
         return {"userTasks": tasks_data}
         
+    except CircuitOpen as e:
+        return circuit_open_response(e)
     except Exception as e:
         logger.info(f"Error retrieving user tasks: {str(e)}")
-        return JSONResponse(
+        return ORJSONResponse(
             content={"error": str(e)},
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
-@app.get("/sessions/{session_id}/resources")
-async def get_session_resources(session_id: str):
+@app.get("/sessions/{session_id}/resources", response_model=SessionDocument)
+async def get_session_resources(session_id: str, request: Request, response: Response):
     """
     Endpoint to retrieve resources for the current session from Firestore.
     """
     try:
         if not session_id:
-            return JSONResponse(
+            return ORJSONResponse(
                 content={"message": "No session ID provided"},
                 status_code=status.HTTP_400_BAD_REQUEST
             )
         
         # Get the document from sessions/{session_id}/resources/resources_doc
-        doc_ref = db.collection("sessions").document(session_id).collection("resources").document("resources_doc")
-        doc = doc_ref.get()
+        documents = await store.get_versioned_session_documents(session_id, [RESOURCES])
+        resources_data, version = documents[RESOURCES]
         
-        if not doc.exists:
-            return JSONResponse(
+        if resources_data is None:
+            return ORJSONResponse(
                 content={"message": "No resources found for this session"},
                 status_code=status.HTTP_404_NOT_FOUND
             )
         
-        # Convert to dictionary and add the ID
-        resources_data = doc.to_dict()
-        resources_data["id"] = doc.id
+        # Resources carry the full page text, so a 304 saves the most here
+        etag = make_etag("resources", session_id, version)
+        if etag_matches(request, etag):
+            return not_modified(etag, REVALIDATE)
+        set_validators(response, etag, REVALIDATE)
+        
+        # Add the ID
+        resources_data["id"] = RESOURCES[1]
         resources_data["session_id"] = session_id
         
         return resources_data
         
+    except CircuitOpen as e:
+        return circuit_open_response(e)
     except Exception as e:
         logger.info(f"Error retrieving resources: {str(e)}")
-        return JSONResponse(
+        return ORJSONResponse(
             content={"error": str(e)},
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
 
-@app.post("/waitlist")
-async def add_to_waitlist(request: Request):
+# Sections of GET /sessions/{session_id}/bundle, by the name used in include=
+BUNDLE_SECTIONS = {
+    "tasks": ("userTasks", TASKS),
+    "cognitive-distortions": ("cognitiveDistortions", COGNITIVE_DISTORTIONS),
+    "resources": ("resources", RESOURCES),
+    "summary": ("summary", SUMMARY),
+}
+
+
+@app.get("/sessions/{session_id}/bundle", response_model=SessionBundle, response_model_exclude_unset=True)
+async def get_session_bundle(session_id: str, request: Request, response: Response, include: Optional[str] = None):
     """
-    Endpoint to add a user to the waitlist.
+    Endpoint to retrieve everything the session results page shows with one Firestore round trip.
+
+        Args:
+            include: Comma-separated sections to return (tasks, cognitive-distortions, resources, summary).
+                     Every section is returned if omitted.
+
+        Returns:
+            userTasks and cognitiveDistortions as lists, resources and summary as objects or null,
+            shaped like the responses of the per-section endpoints
     """
+    sections = [name.strip() for name in include.split(",") if name.strip()] if include else list(BUNDLE_SECTIONS)
+    unknown = [name for name in sections if name not in BUNDLE_SECTIONS]
+    if unknown:
+        return ORJSONResponse(
+            content={"message": f"Unknown sections: {', '.join(unknown)}. Valid sections: {', '.join(BUNDLE_SECTIONS)}"},
+            status_code=status.HTTP_400_BAD_REQUEST
+        )
+
     try:
-        body = await request.json()
-        email = body.get("email", "")
-        if not email:
-            return JSONResponse(
-                content={"message": "No email provided"},
-                status_code=status.HTTP_400_BAD_REQUEST
-            )
-        doc_ref = db.collection("waitlist").document(email)
-        doc_ref.set({"email": email, "timestamp": datetime.now().isoformat()})
-        return JSONResponse(
-            content={"message": "User added to waitlist successfully"},
-            status_code=status.HTTP_200_OK
+        kinds = [BUNDLE_SECTIONS[name][1] for name in sections]
+        documents = await store.get_versioned_session_documents(session_id, kinds)
+
+        etag = make_etag("bundle", session_id, *(f"{name}={documents[BUNDLE_SECTIONS[name][1]][1]}" for name in sections))
+        if etag_matches(request, etag):
+            return not_modified(etag, REVALIDATE)
+        set_validators(response, etag, REVALIDATE)
+
+        bundle = {"session_id": session_id}
+        for name in sections:
+            key, kind = BUNDLE_SECTIONS[name]
+            data = documents[kind][0]
+            if data is not None:
+                # The summary's id is the session id, like in GET /summaries/{summary_id}
+                data["id"] = session_id if kind == SUMMARY else kind[1]
+                data["session_id"] = session_id
+            if kind in (TASKS, COGNITIVE_DISTORTIONS):
+                bundle[key] = [data] if data is not None else []
+            else:
+                bundle[key] = data
+
+        return bundle
+
+    except CircuitOpen as e:
+        return circuit_open_response(e)
+    except Exception as e:
+        logger.info(f"Error retrieving session bundle: {str(e)}")
+        return ORJSONResponse(
+            content={"error": str(e)},
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+
+
+@app.post("/waitlist", response_model=Message)
+async def add_to_waitlist(body: WaitlistRequest):
+    """
+    Endpoint to add a user to the waitlist.
+    """
+    try:
+        await store.add_to_waitlist(body.email)
+        return {"message": "User added to waitlist successfully"}
+    except CircuitOpen as e:
+        return circuit_open_response(e)
     except Exception as e:
         logger.info(f"Error adding user to waitlist: {str(e)}")
-        return JSONResponse(
+        return ORJSONResponse(
             content={"error": str(e)},
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
\ No newline at end of file
@@ -0,0 +1,302 @@
+"""
+Prometheus metrics, served in the text exposition format by GET /metrics.
+
+Requests are counted and timed per route template by InstrumentedRoute, so
+/sessions/{session_id}/tasks is one series however many sessions there are.
+Calls to Firestore, Exa, Ultravox and SMTP are timed with ``timed``, which
+also logs any call slower than the slow operation threshold.
+
+Metrics live in process, one set per worker. They are updated from the event
+loop and from the executor threads the Exa and SMTP calls run on, so every
+update takes the metric's lock.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from fastapi.routing import APIRoute
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a cached Firestore read to an Ultravox call on a bad day
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            samples = sorted(self._values.items())
+        for labels, value in samples:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, labels: Tuple[str, ...] = (), amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, labels: Tuple[str, ...] = (), amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels: Tuple[str, ...] = (), amount: float = 1) -> None:
+        self.inc(labels, -amount)
+
+    def set(self, labels: Tuple[str, ...], value: float) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """
+    Counts observations into fixed buckets. Bucket counts are kept per bucket and only
+    made cumulative when rendered, so an observation increments a single bucket.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count of each bucket, then +Inf, then sum]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, labels: Tuple[str, ...], value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return int(sum(series[:-1])) if series is not None else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            samples = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in samples:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    "http_requests_total", "HTTP requests handled, by route template and status",
+    ("method", "route", "status"),
+))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "Time from routing a request to sending the last byte of its response",
+    ("method", "route"),
+))
+HTTP_IN_PROGRESS = REGISTRY.register(Gauge(
+    "http_requests_in_progress", "HTTP requests being handled",
+    ("method", "route"),
+))
+DEPENDENCY_SECONDS = REGISTRY.register(Histogram(
+    "dependency_call_duration_seconds", "Duration of calls to Firestore, Exa, Ultravox and SMTP",
+    ("dependency", "operation"),
+))
+DEPENDENCY_ERRORS = REGISTRY.register(Counter(
+    "dependency_call_errors_total", "Calls to a dependency that raised",
+    ("dependency", "operation"),
+))
+DEPENDENCY_ATTEMPTS = REGISTRY.register(Counter(
+    "dependency_attempts_total", "Requests made to a dependency, by kind (first, retry or hedge) and outcome",
+    ("dependency", "operation", "kind", "outcome"),
+))
+RETRY_BUDGET_EXHAUSTED = REGISTRY.register(Counter(
+    "retry_budget_exhausted_total", "Retries and hedges not made because the retry budget was spent",
+    ("dependency", "operation"),
+))
+SLOW_OPERATIONS = REGISTRY.register(Counter(
+    "slow_operations_total", "Dependency calls slower than the slow operation threshold",
+    ("dependency", "operation"),
+))
+CIRCUIT_STATE = REGISTRY.register(Gauge(
+    "circuit_breaker_state", "State of a dependency's circuit breaker: 0 closed, 1 half-open, 2 open",
+    ("dependency",),
+))
+CIRCUIT_TRANSITIONS = REGISTRY.register(Counter(
+    "circuit_breaker_transitions_total", "Changes of a dependency's circuit breaker, by the state entered",
+    ("dependency", "state"),
+))
+CIRCUIT_REJECTED = REGISTRY.register(Counter(
+    "circuit_breaker_rejected_total", "Calls to a dependency failed fast because its circuit was open",
+    ("dependency",),
+))
+ADMISSION_QUEUE_SECONDS = REGISTRY.register(Histogram(
+    "admission_queue_seconds", "Time admitted requests waited for a slot, by priority class",
+    ("priority",),
+))
+ADMISSION_WAITING = REGISTRY.register(Gauge(
+    "admission_waiting_requests", "Requests waiting for a slot, by priority class",
+    ("priority",),
+))
+ADMISSION_SHED = REGISTRY.register(Counter(
+    "admission_shed_total", "Requests turned away by admission control, by route, priority class and reason",
+    ("route", "priority", "reason"),
+))
+WRITE_BEHIND_FLUSHES = REGISTRY.register(Counter(
+    "write_behind_flushes_total", "Batches of buffered session writes flushed, by outcome (committed, failed or circuit_open)",
+    ("outcome",),
+))
+WRITE_BEHIND_FLUSH_SECONDS = REGISTRY.register(Histogram(
+    "write_behind_flush_seconds", "Duration of committed write-behind batches",
+))
+WRITE_BEHIND_BATCH_SIZE = REGISTRY.register(Histogram(
+    "write_behind_batch_size", "Session documents in each committed write-behind batch",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500),
+))
+WRITE_BEHIND_PENDING = REGISTRY.register(Gauge(
+    "write_behind_pending_operations", "Session write operations waiting in the write-behind buffer",
+))
+WRITE_BEHIND_DROPPED = REGISTRY.register(Counter(
+    "write_behind_dropped_writes_total", "Buffered session documents dropped after failing every attempt",
+))
+WRITE_BEHIND_REJECTED = REGISTRY.register(Counter(
+    "write_behind_rejected_total", "Session writes refused because the write-behind buffer was full",
+))
+
+# Dependency calls taking at least this many seconds are logged, main.py sets it from SLOW_OPERATION_MS
+_slow_operation_threshold = 1.0
+
+
+def set_slow_operation_threshold(seconds: float) -> None:
+    global _slow_operation_threshold
+    _slow_operation_threshold = seconds
+
+
+class timed:
+    """
+    Times a call to a dependency, with or without await inside the block:
+
+        with timed("firestore", "get"):
+            snapshot = await reference.get()
+
+    A call that raises is timed too, and counted in dependency_call_errors_total.
+    Inside a traced request the call is also a span named dependency.operation.
+    """
+    __slots__ = ("labels", "started", "span")
+
+    def __init__(self, dependency: str, operation: str):
+        self.labels = (dependency, operation)
+        self.span = tracing.span(f"{dependency}.{operation}")
+
+    def __enter__(self) -> "timed":
+        self.span.__enter__()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        elapsed = time.perf_counter() - self.started
+        self.span.__exit__(exc_type, exc, traceback)
+        DEPENDENCY_SECONDS.observe(self.labels, elapsed)
+        if exc_type is not None:
+            DEPENDENCY_ERRORS.inc(self.labels)
+        if elapsed >= _slow_operation_threshold:
+            SLOW_OPERATIONS.inc(self.labels)
+            dependency, operation = self.labels
+            outcome = f"failed with {exc_type.__name__}" if exc_type is not None else "succeeded"
+            logger.warning(f"Slow {dependency} {operation}: {elapsed * 1000:.0f} ms, {outcome}")
+
+
+class InstrumentedRoute(APIRoute):
+    """
+    Route class that counts and times every request it handles, labelled with its path template
+    """
+
+    async def handle(self, scope, receive, send) -> None:
+        method = scope["method"]
+        labels = (method, self.path)
+        response_status: Optional[int] = None
+
+        async def send_with_status(message) -> None:
+            nonlocal response_status
+            if message["type"] == "http.response.start":
+                response_status = message["status"]
+            await send(message)
+
+        HTTP_IN_PROGRESS.inc(labels)
+        started = time.perf_counter()
+        try:
+            await super().handle(scope, receive, send_with_status)
+        except BaseException:
+            # The exception middleware turns it into a 500 further out
+            if response_status is None:
+                response_status = 500
+            raise
+        finally:
+            HTTP_REQUEST_SECONDS.observe(labels, time.perf_counter() - started)
+            HTTP_REQUESTS.inc((method, self.path, str(response_status or 500)))
+            HTTP_IN_PROGRESS.dec(labels)
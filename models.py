@@ -0,0 +1,170 @@
+"""
+Request and response models of the API.
+
+The tool request models mirror the dynamic parameters declared in
+payload.get_selected_tools(), so Maggie's tool calls are checked against the
+schema she is given. Pydantic builds the validator and serializer of every
+model once, when this module is imported, and FastAPI rejects a body that
+doesn't validate before the handler runs.
+"""
+
+from typing import Annotated, List, Optional
+
+from pydantic import BaseModel, ConfigDict, Field
+
+NonEmptyStr = Annotated[str, Field(min_length=1)]
+
+
+# Tool requests
+
+class ResourcesRequest(BaseModel):
+    session_id: NonEmptyStr
+    query: NonEmptyStr
+
+
+class SummaryRequest(BaseModel):
+    session_id: NonEmptyStr
+    # Required in the tool schema, but a summary missing a part is still worth saving
+    conversationSummary: str = ""
+    identifiedCognitiveDistortions: List[str] = []
+    suggestedExercises: str = ""
+
+
+class CognitiveDistortionsRequest(BaseModel):
+    session_id: NonEmptyStr
+    cognitiveDistortions: Annotated[List[str], Field(min_length=1)]
+
+
+class TaskRequest(BaseModel):
+    session_id: NonEmptyStr
+    task: NonEmptyStr
+
+
+# Other requests
+
+class Insights(BaseModel):
+    summary: str
+    tasks: list[str]
+    topics: list[str]
+
+
+class Email(BaseModel):
+    email_address: NonEmptyStr
+    insights: Insights
+
+
+class WaitlistRequest(BaseModel):
+    email: NonEmptyStr
+
+
+# Responses
+
+class Resource(BaseModel):
+    url: str
+    title: str
+    text: str
+    image: Optional[str] = None
+
+
+class Message(BaseModel):
+    message: str
+
+
+class ToolResult(Message):
+    status: str = "success"
+    status_code: int = 200
+
+
+class DistortionsSaved(ToolResult):
+    distortion_id: str
+
+
+class SummarySaved(ToolResult):
+    summary_id: str
+
+
+class TaskSaved(ToolResult):
+    task_id: str
+
+
+class EmailQueued(Message):
+    email_id: str
+
+
+class EmailStatus(BaseModel):
+    email_id: str
+    status: str
+    attempts: int
+    error: Optional[str] = None
+    updated_at: float
+
+
+class CallCreated(BaseModel):
+    joinUrl: str
+
+
+class SessionDocument(BaseModel):
+    """
+    A session document as stored in Firestore, with the ids the frontend looks it up by
+    """
+    model_config = ConfigDict(extra="allow")
+
+    id: str
+    session_id: str
+
+
+class UserTasks(BaseModel):
+    userTasks: List[SessionDocument]
+
+
+class CognitiveDistortions(BaseModel):
+    cognitiveDistortions: List[SessionDocument]
+
+
+class SummaryPage(BaseModel):
+    summaries: List[dict]
+    next_cursor: Optional[str] = None
+
+
+class SessionBundle(BaseModel):
+    """
+    Only the sections asked for are set, so it is returned with response_model_exclude_unset
+    """
+    session_id: str
+    userTasks: Optional[List[SessionDocument]] = None
+    cognitiveDistortions: Optional[List[SessionDocument]] = None
+    resources: Optional[SessionDocument] = None
+    summary: Optional[SessionDocument] = None
+
+
+# Messages of the 400 sent when a required body field is missing or empty, as the handlers sent before
+MISSING_MESSAGES = {
+    "session_id": "No session ID provided",
+    "query": "No query provided",
+    "task": "No task provided",
+    "cognitiveDistortions": "No cognitive distortions provided",
+    "email": "No email provided",
+    "email_address": "No email address provided",
+    "insights": "No insights provided",
+}
+MISSING_ERRORS = {"missing", "string_too_short", "too_short"}
+
+
+def validation_message(errors: List[dict]) -> str:
+    """
+    Describes the first problem with a request body in one sentence
+
+        Args:
+            errors: The errors of a RequestValidationError, all located in the body
+
+        Returns:
+            The message sent back with the 400
+    """
+    if any(error["type"] == "json_invalid" for error in errors):
+        return "Invalid JSON body"
+    error = errors[0]
+    location = error["loc"][1:]
+    if len(location) == 1 and location[0] in MISSING_MESSAGES and error["type"] in MISSING_ERRORS:
+        return MISSING_MESSAGES[location[0]]
+    field = ".".join(str(part) for part in location) or "body"
+    return f"Invalid {field}: {error['msg']}"
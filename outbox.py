@@ -0,0 +1,196 @@
+"""
+Durable outbox for emails.
+
+Every email is written to a local SQLite database before the request returns,
+so a crash or a failing SMTP server doesn't lose it. The mailer's dispatcher
+takes due messages from here, and records each attempt and its outcome.
+
+Emails carry a user's session insights, so a message's body is deleted as
+soon as it is sent or has failed for good, and ``purge`` deletes finished
+messages altogether once their status is no longer needed.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from email import message_from_bytes, policy
+from email.message import Message
+from typing import List, Optional
+
+QUEUED = "queued"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+
+class OutboxMessage:
+    def __init__(self, email_id: str, message: Message, attempts: int):
+        self.email_id = email_id
+        self.message = message
+        self.attempts = attempts
+
+
+class Outbox:
+    """
+    SQLite-backed store of emails and their delivery state.
+
+    The database is opened on first use, so creating an Outbox does no I/O.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS outbox (
+                    email_id TEXT PRIMARY KEY,
+                    recipient TEXT NOT NULL,
+                    message BLOB NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)"
+            )
+            self._connection = connection
+        return self._connection
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            connection = self._connect()
+            rows = connection.execute(sql, params).fetchall()
+            connection.commit()
+            return rows
+
+    def add(self, message: Message) -> str:
+        """
+        Stores a message as queued for immediate delivery
+
+            Returns:
+                The email id
+        """
+        email_id = str(uuid.uuid4())
+        now = time.time()
+        self._execute(
+            "INSERT INTO outbox (email_id, recipient, message, status, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (email_id, str(message["To"]), message.as_bytes(), QUEUED, now, now, now),
+        )
+        return email_id
+
+    def claim_due(self, limit: int) -> List[OutboxMessage]:
+        """
+        Marks up to limit queued messages whose next attempt is due as sending, and returns them
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            rows = connection.execute(
+                "SELECT email_id, message, attempts FROM outbox "
+                "WHERE status = ? AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                (QUEUED, now, limit),
+            ).fetchall()
+            connection.executemany(
+                "UPDATE outbox SET status = ?, updated_at = ? WHERE email_id = ?",
+                [(SENDING, now, row[0]) for row in rows],
+            )
+            connection.commit()
+        return [
+            OutboxMessage(email_id, message_from_bytes(data, policy=policy.SMTP), attempts)
+            for email_id, data, attempts in rows
+        ]
+
+    def mark_sent(self, email_id: str, attempts: int) -> None:
+        self._execute(
+            "UPDATE outbox SET status = ?, attempts = ?, message = ?, last_error = NULL, updated_at = ? "
+            "WHERE email_id = ?",
+            (SENT, attempts, b"", time.time(), email_id),
+        )
+
+    def mark_retry(self, email_id: str, attempts: int, next_attempt_at: float, error: str) -> None:
+        self._execute(
+            "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? "
+            "WHERE email_id = ?",
+            (QUEUED, attempts, next_attempt_at, error, time.time(), email_id),
+        )
+
+    def mark_failed(self, email_id: str, attempts: int, error: str) -> None:
+        self._execute(
+            "UPDATE outbox SET status = ?, attempts = ?, message = ?, last_error = ?, updated_at = ? "
+            "WHERE email_id = ?",
+            (FAILED, attempts, b"", error, time.time(), email_id),
+        )
+
+    def purge(self, older_than: float) -> int:
+        """
+        Deletes sent and failed messages last updated before older_than
+
+            Returns:
+                The number of messages deleted
+        """
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.execute(
+                "DELETE FROM outbox WHERE status IN (?, ?) AND updated_at < ?", (SENT, FAILED, older_than)
+            )
+            connection.commit()
+            return cursor.rowcount
+
+    def requeue_interrupted(self) -> int:
+        """
+        Puts messages left as sending by a previous process back in the queue
+
+            Returns:
+                The number of messages requeued
+        """
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.execute(
+                "UPDATE outbox SET status = ?, updated_at = ? WHERE status = ?",
+                (QUEUED, time.time(), SENDING),
+            )
+            connection.commit()
+            return cursor.rowcount
+
+    def next_attempt_at(self) -> Optional[float]:
+        """
+        Returns when the earliest queued message is due, or None if nothing is queued
+        """
+        rows = self._execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = ?", (QUEUED,))
+        return rows[0][0]
+
+    def status(self, email_id: str) -> Optional[dict]:
+        rows = self._execute(
+            "SELECT status, attempts, last_error, updated_at FROM outbox WHERE email_id = ?", (email_id,)
+        )
+        if not rows:
+            return None
+        status, attempts, error, updated_at = rows[0]
+        return {"email_id": email_id, "status": status, "attempts": attempts, "error": error, "updated_at": updated_at}
+
+    def counts(self) -> dict:
+        return dict(self._execute("SELECT status, COUNT(*) FROM outbox GROUP BY status"))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -1,14 +1,26 @@
 # BASE_URL = "https://maggie-web-api-endpoint.onrender.com"
+import json
 import os
-from dotenv import load_dotenv
+from typing import Optional, Tuple
 
-# Check if BASE_URL is set as an environment variable first
-BASE_URL = os.getenv("BASE_URL")
+# Read on first use, see get_base_url()
+_base_url: Optional[str] = None
 
-# If no environment variable is set, load from .env file
-if BASE_URL is None:
-    load_dotenv()
-    BASE_URL = os.getenv("BASE_URL")
+
+def get_base_url() -> Optional[str]:
+    """
+    Returns the public URL of this API, which the agent's tools call back.
+    Taken from the BASE_URL environment variable, or from the .env file if it isn't set.
+    """
+    global _base_url
+    if _base_url is None:
+        _base_url = os.getenv("BASE_URL")
+        if _base_url is None:
+            from dotenv import load_dotenv
+
+            load_dotenv()
+            _base_url = os.getenv("BASE_URL")
+    return _base_url
 
 def get_system_prompt(session_id:str) -> str:
     return f"""
@@ -184,6 +196,7 @@ def get_system_prompt(session_id:str) -> str:
 
 
 def get_selected_tools() -> list:
+    base_url = get_base_url()
     return [
         {
             "temporaryTool": {
@@ -210,7 +223,7 @@ def get_selected_tools() -> list:
                     }
                 ],
                 "http": {
-                    "baseUrlPattern": f"{BASE_URL}/sessions/resources",
+                    "baseUrlPattern": f"{base_url}/sessions/resources",
                     "httpMethod": "POST"
                 }
             }
@@ -261,7 +274,7 @@ def get_selected_tools() -> list:
                     }
                 ],
                 "http": {
-                    "baseUrlPattern": f"{BASE_URL}/sessions/summary",
+                    "baseUrlPattern": f"{base_url}/sessions/summary",
                     "httpMethod": "POST"
                 }
             }
@@ -294,7 +307,7 @@ def get_selected_tools() -> list:
                     }
                 ],
                 "http": {
-                    "baseUrlPattern": f"{BASE_URL}/sessions/cognitive-distortions",
+                    "baseUrlPattern": f"{base_url}/sessions/cognitive-distortions",
                     "httpMethod": "POST"
                 }
             }
@@ -324,7 +337,7 @@ def get_selected_tools() -> list:
                     }
                 ],
                 "http": {
-                    "baseUrlPattern": f"{BASE_URL}/sessions/tasks",
+                    "baseUrlPattern": f"{base_url}/sessions/tasks",
                     "httpMethod": "POST"
                 }
             }
@@ -353,5 +366,37 @@ def get_payload(session_id: str) -> dict:
     }
 
 
-
-
+# Stands in for the session ID while the payload template is compiled
+SESSION_ID_PLACEHOLDER = "__MAGGIE_SESSION_ID__"
+
+# Encoded payload split around the session ID, see compile_payload_template()
+_payload_template: Optional[Tuple[bytes, bytes]] = None
+
+
+def compile_payload_template() -> Tuple[bytes, bytes]:
+    """
+    Encodes the call payload once, with a placeholder where the session ID goes
+
+        Returns:
+            The JSON bytes before and after the session ID
+    """
+    global _payload_template
+    encoded = json.dumps(
+        get_payload(SESSION_ID_PLACEHOLDER), ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+    parts = encoded.split(SESSION_ID_PLACEHOLDER.encode("utf-8"))
+    if len(parts) != 2:
+        raise ValueError("The session ID must appear exactly once in the call payload")
+    _payload_template = (parts[0], parts[1])
+    return _payload_template
+
+
+def get_payload_json(session_id: str) -> bytes:
+    """
+    Returns the call payload for a session as JSON bytes, ready to send to Ultravox.
+    Only the session ID is encoded per call, the rest comes from the compiled template.
+    """
+    prefix, suffix = _payload_template or compile_payload_template()
+    # Escape the session ID the same way it would be inside a JSON string
+    session_id_json = json.dumps(session_id, ensure_ascii=False)[1:-1].encode("utf-8")
+    return b"".join((prefix, session_id_json, suffix))
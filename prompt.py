@@ -200,4 +200,7 @@ def get_system_prompt() -> str:
     return f""" 
     {PROMPT}
     """
-print(get_system_prompt())
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    print(get_system_prompt())
@@ -0,0 +1,168 @@
+"""
+Bounded worker queue for resource fetching.
+
+Resource searches used to run as Starlette background tasks with no limit on
+how many ran at once. ResourceFetchQueue runs them on a fixed number of worker
+tasks behind a bounded queue, and collapses identical queries that are already
+queued or running into one search whose result is stored for every waiting
+session.
+"""
+
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when a fetch is submitted while the queue is at capacity"""
+
+
+class _Job:
+    def __init__(self, key: str, query: str, session_id: str):
+        self.key = key
+        self.query = query
+        self.session_ids = [session_id]
+        self.enqueued_at = time.monotonic()
+
+
+class ResourceFetchQueue:
+    """
+    Runs ``search(query)`` on at most ``concurrency`` workers and hands each result to
+    ``store(session_id, result)`` for every session that asked for that query.
+
+        Args:
+            search: Coroutine function fetching the resources for a query
+            store: Coroutine function storing the resources for one session
+            key: Maps a query to the key identical queries share
+            concurrency: Number of searches that can run at once
+            max_queue: Number of distinct queries that can wait for a worker
+    """
+
+    def __init__(
+        self,
+        search: Callable[[str], Awaitable[list]],
+        store: Callable[[str, list], Awaitable[None]],
+        key: Callable[[str], str],
+        concurrency: int,
+        max_queue: int,
+    ):
+        self.search = search
+        self.store = store
+        self.key = key
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.completed = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self._waits = deque(maxlen=1000)
+        self._jobs: Dict[str, _Job] = {}
+        self._running = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self) -> None:
+        """
+        Starts the workers on the running event loop, which submit must then be called from
+        """
+        if self._workers:
+            await self.stop()
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._jobs.clear()
+        self._running = 0
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        if self._loop is asyncio.get_running_loop():
+            for worker in self._workers:
+                worker.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        # Workers started on another loop ended when that loop was closed
+        self._workers = []
+        self._queue = None
+        self._loop = None
+
+    async def join(self) -> None:
+        """
+        Waits until every submitted fetch has been processed
+        """
+        if self._queue is not None:
+            await self._queue.join()
+
+    def submit(self, query: str, session_id: str) -> None:
+        """
+        Queues a fetch of query for session_id, joining an identical fetch if one is pending.
+        Must be called from the event loop the queue was started on.
+
+            Raises:
+                QueueFull: If the queue is at capacity
+                RuntimeError: If the queue isn't started on the running event loop
+        """
+        if self._loop is not asyncio.get_running_loop():
+            raise RuntimeError("The resource fetch queue isn't started on this event loop")
+
+        key = self.key(query)
+        job = self._jobs.get(key)
+        if job is not None:
+            job.session_ids.append(session_id)
+            self.deduplicated += 1
+            return
+
+        if self._queue.full():
+            self.rejected += 1
+            raise QueueFull(f"Resource fetch queue is full ({self.max_queue} queries waiting)")
+
+        job = _Job(key, query, session_id)
+        self._jobs[key] = job
+        self._queue.put_nowait(job)
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            self._running += 1
+            self._waits.append(time.monotonic() - job.enqueued_at)
+            try:
+                await self._run(job)
+            finally:
+                self._running -= 1
+                self._queue.task_done()
+
+    async def _run(self, job: _Job) -> None:
+        try:
+            result = await self.search(job.query)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Failed to fetch resources for query {job.query!r}: {str(e)}")
+            return
+        finally:
+            # Later requests for this query start a new fetch (which the cache answers)
+            self._jobs.pop(job.key, None)
+
+        for session_id in job.session_ids:
+            try:
+                await self.store(session_id, result)
+            except Exception as e:
+                logger.error(f"Failed to store resources for session {session_id}: {str(e)}")
+        self.completed += 1
+
+    def stats(self) -> dict:
+        waits = list(self._waits)
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue": self.max_queue,
+            "in_flight": self._running,
+            "concurrency": self.concurrency,
+            "completed": self.completed,
+            "failed": self.failed,
+            "deduplicated": self.deduplicated,
+            "rejected": self.rejected,
+            "wait_seconds_p50": statistics.median(waits) if waits else 0.0,
+            "wait_seconds_max": max(waits) if waits else 0.0,
+        }
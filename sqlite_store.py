@@ -0,0 +1,264 @@
+"""
+SQLite implementation of the session store, for single node deployments and
+benchmarks that shouldn't depend on Google.
+
+Every session document is one row of session_documents, keyed by session and
+collection, with its data as JSON. The timestamp column copies the data's
+timestamp so summaries can be listed from an index, and updated_at is the
+document's version, like Firestore's update time.
+
+sqlite3 is blocking, so queries run on a few dedicated threads, each with its
+own connection. The database is in WAL mode, so reads go on while a write
+commits; writes take the write lock up front and wait for each other.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from cache import TTLCache
+from metrics import timed
+from storage import COGNITIVE_DISTORTIONS, SUMMARY, TASKS, SessionStore, SessionWrite
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS session_documents (
+        session_id TEXT NOT NULL,
+        collection TEXT NOT NULL,
+        data TEXT NOT NULL,
+        timestamp TEXT,
+        updated_at TEXT NOT NULL,
+        PRIMARY KEY (session_id, collection)
+    ) WITHOUT ROWID
+    """,
+    # Summaries listing, most recent first, keyset paginated on (timestamp, session_id)
+    "CREATE INDEX IF NOT EXISTS session_documents_by_timestamp ON session_documents (collection, timestamp, session_id)",
+    "CREATE TABLE IF NOT EXISTS waitlist (email TEXT PRIMARY KEY, timestamp TEXT NOT NULL)",
+]
+
+
+def _encode(data: dict) -> str:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def _union(document: dict, field: str, values: list) -> None:
+    current = list(document.get(field) or [])
+    current.extend(value for value in values if value not in current)
+    document[field] = current
+
+
+class SQLiteStore(SessionStore):
+    """
+    Reads and writes the API's documents in a SQLite database. The database is opened on
+    first use, so creating a SQLiteStore does no I/O.
+
+        Args:
+            path: The database file, or ":memory:" to keep everything in memory
+            cache: Optional cache of per-session documents, keyed by (session_id, kind)
+            workers: The number of query threads. An in-memory database has one.
+    """
+
+    def __init__(self, path: str, cache: Optional[TTLCache] = None, workers: int = 4):
+        super().__init__(cache)
+        self.path = path
+        # Every connection to ":memory:" opens a database of its own, so it gets a single thread
+        self.workers = 1 if path == ":memory:" else workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._version_lock = threading.Lock()
+        self._last_version: Optional[datetime] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self.path != ":memory:":
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+            # Transactions are opened explicitly, writes with BEGIN IMMEDIATE
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            with self._lock:
+                self._connections.append(connection)
+            self._local.connection = connection
+        return connection
+
+    async def _run(self, operation: str, function: Callable, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sqlite")
+        with self._guard(), timed("sqlite", operation):
+            return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _next_version(self) -> str:
+        # Versions are update times, strictly increasing so two writes never share one
+        with self._version_lock:
+            now = datetime.now(timezone.utc)
+            if self._last_version is not None and now <= self._last_version:
+                now = self._last_version + timedelta(microseconds=1)
+            self._last_version = now
+        return now.isoformat()
+
+    def _write(self, apply: Callable[[sqlite3.Connection], None]) -> None:
+        """
+        Runs apply in a write transaction, committed if it returns and rolled back if it raises
+        """
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            apply(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _put(self, connection: sqlite3.Connection, session_id: str, kind: Tuple[str, str], data: dict) -> None:
+        timestamp = data.get("timestamp")
+        connection.execute(
+            "INSERT OR REPLACE INTO session_documents (session_id, collection, data, timestamp, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (session_id, kind[0], _encode(data), timestamp if isinstance(timestamp, str) else None, self._next_version()),
+        )
+
+    def _load(self, connection: sqlite3.Connection, session_id: str, kind: Tuple[str, str]) -> Optional[dict]:
+        row = connection.execute(
+            "SELECT data FROM session_documents WHERE session_id = ? AND collection = ?", (session_id, kind[0])
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _merge_arrays(
+        self, connection: sqlite3.Connection, session_id: str, kind: Tuple[str, str], arrays: Dict[str, list], timestamp: str
+    ) -> None:
+        document = self._load(connection, session_id, kind) or {}
+        for field, values in arrays.items():
+            _union(document, field, values)
+        document["timestamp"] = timestamp
+        self._put(connection, session_id, kind, document)
+
+    async def _set_session_document(self, session_id: str, kind: Tuple[str, str], data: dict) -> None:
+        await self._run("set", self._write, lambda connection: self._put(connection, session_id, kind, data))
+
+    async def _append_to_session_array(
+        self, session_id: str, kind: Tuple[str, str], field: str, values: list, timestamp: str
+    ) -> None:
+        # Read, union and write in one transaction, which holds the write lock throughout
+        await self._run("append", self._write, lambda connection: self._merge_arrays(
+            connection, session_id, kind, {field: values}, timestamp
+        ))
+
+    async def _commit_session_writes(self, writes: List[SessionWrite]) -> None:
+        def apply(connection: sqlite3.Connection) -> None:
+            for write in writes:
+                if write.data is not None:
+                    self._put(connection, write.session_id, write.kind, write.data)
+                else:
+                    self._merge_arrays(connection, write.session_id, write.kind, write.arrays, write.timestamp)
+
+        await self._run("commit", self._write, apply)
+
+    async def _fetch_session_documents(
+        self, session_id: str, missing: List[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], Tuple[Optional[dict], Optional[str]]]:
+        kinds = {kind[0]: kind for kind in missing}
+
+        def fetch() -> list:
+            placeholders = ",".join("?" * len(kinds))
+            return self._connect().execute(
+                "SELECT collection, data, updated_at FROM session_documents "
+                f"WHERE session_id = ? AND collection IN ({placeholders})",
+                (session_id, *kinds),
+            ).fetchall()
+
+        rows = await self._run("get", fetch)
+        return {kinds[collection]: (json.loads(data), updated_at) for collection, data, updated_at in rows}
+
+    async def list_summaries(self, limit: int, start_after: Optional[Tuple[str, str]] = None) -> List[dict]:
+        def fetch() -> list:
+            if start_after is None:
+                return self._connect().execute(
+                    "SELECT session_id, data FROM session_documents "
+                    "WHERE collection = ? AND timestamp IS NOT NULL "
+                    "ORDER BY timestamp DESC, session_id DESC LIMIT ?",
+                    (SUMMARY[0], limit),
+                ).fetchall()
+            return self._connect().execute(
+                "SELECT session_id, data FROM session_documents "
+                "WHERE collection = ? AND timestamp IS NOT NULL AND (timestamp, session_id) < (?, ?) "
+                "ORDER BY timestamp DESC, session_id DESC LIMIT ?",
+                (SUMMARY[0], *start_after, limit),
+            ).fetchall()
+
+        summaries = []
+        for session_id, data in await self._run("list_summaries", fetch):
+            summary = json.loads(data)
+            summary["id"] = session_id  # Use session_id as the summary id
+            summary["session_id"] = session_id
+            summaries.append(summary)
+        return summaries
+
+    async def export_sessions(self, page_size: int = 500, since: Optional[datetime] = None) -> AsyncIterator[dict]:
+        kinds = {SUMMARY[0]: "summary", TASKS[0]: "tasks", COGNITIVE_DISTORTIONS[0]: "cognitiveDistortions"}
+
+        def fetch_page(after: str) -> list:
+            # Every session with any document, in session id order, then the page's documents
+            connection = self._connect()
+            session_ids = [row[0] for row in connection.execute(
+                "SELECT DISTINCT session_id FROM session_documents WHERE session_id > ? ORDER BY session_id LIMIT ?",
+                (after, page_size),
+            )]
+            if not session_ids:
+                return []
+            rows = connection.execute(
+                "SELECT session_id, collection, data, updated_at FROM session_documents "
+                f"WHERE session_id IN ({','.join('?' * len(session_ids))}) AND collection IN (?, ?, ?)",
+                (*session_ids, *kinds),
+            ).fetchall()
+            documents: Dict[str, list] = {session_id: [] for session_id in session_ids}
+            for row in rows:
+                documents[row[0]].append(row[1:])
+            return list(documents.items())
+
+        after = ""
+        while True:
+            page = await self._run("export", fetch_page, after)
+            if not page:
+                return
+            for session_id, rows in page:
+                session = {"session_id": session_id, **{key: None for key in kinds.values()}}
+                latest = None
+                for collection, data, updated_at in rows:
+                    session[kinds[collection]] = json.loads(data)
+                    updated = datetime.fromisoformat(updated_at)
+                    if latest is None or updated > latest:
+                        latest = updated
+                if since is not None and (latest is None or latest < since):
+                    continue
+                yield session
+            after = page[-1][0]
+
+    async def add_to_waitlist(self, email: str) -> None:
+        def add(connection: sqlite3.Connection) -> None:
+            connection.execute(
+                "INSERT OR REPLACE INTO waitlist (email, timestamp) VALUES (?, ?)", (email, datetime.now().isoformat())
+            )
+
+        await self._run("waitlist", self._write, add)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
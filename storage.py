@@ -0,0 +1,500 @@
+"""
+Async data access layer for the sessions, summaries and waitlist used by the API.
+
+Handlers go through a SessionStore instead of building ``db.collection(...)``
+chains themselves. FirestoreStore keeps the data in Firestore and awaits every
+read and write on the async client, so a slow round trip never blocks the
+event loop. SQLiteStore, in sqlite_store.py, keeps it in a local SQLite file
+for single node deployments and benchmarks. ``create_store`` picks one from
+STORAGE_BACKEND.
+
+Per-session documents can be cached in process. Every write through the store
+invalidates the documents it touched, so a read in the same process never
+returns data older than the last write it could see. Other processes writing
+the same documents are only picked up once the entries expire.
+
+A store given a circuit breaker fails fast with CircuitOpen while the
+backend is down, rather than waiting out each call's timeout.
+"""
+
+import copy
+import os
+from abc import ABC, abstractmethod
+from contextlib import nullcontext
+from datetime import datetime
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from cache import TTLCache, approximate_size
+from circuit import CLOSED, CircuitBreaker
+from metrics import timed
+
+# (collection, document) pairs under sessions/{session_id}/
+TASKS = ("tasks", "tasks_doc")
+COGNITIVE_DISTORTIONS = ("cognitive-distortions", "distortions_doc")
+RESOURCES = ("resources", "resources_doc")
+SUMMARY = ("summaries", "summary_doc")
+
+# Firestore accepts at most this many writes in one batch
+MAX_BATCH_WRITES = 500
+
+
+class SessionWrite:
+    """
+    The pending changes to one session document, coalesced from any number of
+    set_session_document and append_to_session_array calls in the order they were made.
+    """
+
+    def __init__(self, session_id: str, kind: Tuple[str, str]):
+        self.session_id = session_id
+        self.kind = kind
+        self.data: Optional[dict] = None  # Replaces the whole document when set
+        self.arrays: Dict[str, list] = {}  # Merged into the document with ArrayUnion otherwise
+        self.timestamp: Optional[str] = None
+        self.operations = 0
+        self.attempts = 0  # Failed commits, counted by the write-behind buffer
+
+    def set(self, data: dict) -> None:
+        self.data = dict(data)
+        self.arrays = {}
+        self.operations += 1
+
+    def append(self, field: str, values: list, timestamp: str) -> None:
+        self._union(field, values, timestamp)
+        self.operations += 1
+
+    def _union(self, field: str, values: list, timestamp: str) -> None:
+        target = self.data if self.data is not None else self.arrays
+        current = list(target.get(field) or [])
+        current.extend(value for value in values if value not in current)
+        target[field] = current
+        if self.data is not None:
+            self.data["timestamp"] = timestamp
+        self.timestamp = timestamp
+
+    def extend(self, later: "SessionWrite") -> None:
+        """
+        Applies the changes of a later write to the same document on top of this one
+        """
+        if later.data is not None:
+            self.data = dict(later.data)
+            self.arrays = {}
+        else:
+            for field, values in later.arrays.items():
+                self._union(field, values, later.timestamp)
+        self.operations += later.operations
+
+
+def document_version(snapshot) -> Optional[str]:
+    """
+    Returns the last update time of an existing document snapshot as a string
+    """
+    update_time = snapshot.update_time
+    if update_time is None:
+        return None
+    # The async client's timestamps keep Firestore's nanoseconds in rfc3339()
+    if hasattr(update_time, "rfc3339"):
+        return update_time.rfc3339()
+    return update_time.isoformat()
+
+
+class SessionStore(ABC):
+    """
+    Reads and writes the session documents (tasks, cognitive distortions, resources and
+    the summary of each session) and the waitlist. Subclasses implement the storage,
+    this class the cache of per-session documents in front of it.
+
+        Args:
+            cache: Optional cache of per-session documents, keyed by (session_id, kind)
+            breaker: Optional circuit breaker that calls to the storage go through
+    """
+
+    def __init__(self, cache: Optional[TTLCache] = None, breaker: Optional[CircuitBreaker] = None):
+        self.cache = cache
+        self.breaker = breaker
+        # Reads that may fill the cache, by key. An invalidation removes the key, so a
+        # read that overlapped a write doesn't cache what it read before the write.
+        self._reads: Dict[Tuple[str, Tuple[str, str]], object] = {}
+
+    def _cached(self, session_id: str, kind: Tuple[str, str]) -> Optional[Tuple[Optional[dict], Optional[str]]]:
+        """
+        Returns (data, version) if the document is cached, with data None for a document known not to exist
+        """
+        if self.cache is None:
+            return None
+        entry = self.cache.get((session_id, kind))
+        if entry is None:
+            return None
+        # Handlers add fields to what they get back, which mustn't leak into the cache
+        data, version = entry
+        return copy.deepcopy(data), version
+
+    def _begin_read(self, session_id: str, kind: Tuple[str, str]) -> Optional[object]:
+        if self.cache is None:
+            return None
+        token = object()
+        self._reads[(session_id, kind)] = token
+        return token
+
+    def _finish_read(
+        self, session_id: str, kind: Tuple[str, str], token: Optional[object], data: Optional[dict], version: Optional[str]
+    ) -> None:
+        key = (session_id, kind)
+        if token is not None and self._reads.get(key) is token:
+            del self._reads[key]
+            self.cache.set(key, (copy.deepcopy(data), version))
+
+    def _guard(self):
+        return self.breaker.guard() if self.breaker is not None else nullcontext()
+
+    def available(self) -> bool:
+        """
+        Whether calls to the storage go ahead, False unless its circuit is closed. While it is
+        half-open only the probe calls do, and the rest fail with CircuitOpen.
+        """
+        return self.breaker is None or self.breaker.state == CLOSED
+
+    def invalidate(self, session_id: str, kind: Tuple[str, str]) -> None:
+        if self.cache is not None:
+            key = (session_id, kind)
+            self.cache.pop(key)
+            self._reads.pop(key, None)
+
+    def cache_stats(self) -> Optional[dict]:
+        if self.cache is None:
+            return None
+        stats = self.cache.stats()
+        stats["approximate_bytes"] = sum(approximate_size(value) for value in self.cache.values())
+        return stats
+
+    async def warm_up(self) -> None:
+        """
+        Opens the connection to the storage with a read that bypasses the cache
+        """
+        await self._fetch_session_documents("__warmup__", [TASKS])
+
+    async def get_session_document(self, session_id: str, kind: Tuple[str, str]) -> Optional[dict]:
+        """
+        Returns the data of sessions/{session_id}/{collection}/{document}, or None if it doesn't exist
+        """
+        documents = await self.get_versioned_session_documents(session_id, [kind])
+        return documents[kind][0]
+
+    async def set_session_document(self, session_id: str, kind: Tuple[str, str], data: dict) -> None:
+        """
+        Replaces a session document
+        """
+        try:
+            await self._set_session_document(session_id, kind, data)
+        finally:
+            self.invalidate(session_id, kind)
+
+    async def append_to_session_array(self, session_id: str, kind: Tuple[str, str], field: str, values: list) -> None:
+        """
+        Appends values to an array field of a session document, creating the document if needed.
+
+        The append is atomic, so concurrent appends to the same session can't overwrite each
+        other. Like Firestore's ArrayUnion, values already in the array aren't added again.
+        """
+        try:
+            await self._append_to_session_array(session_id, kind, field, values, datetime.now().isoformat())
+        finally:
+            self.invalidate(session_id, kind)
+
+    async def commit_session_writes(self, writes: List[SessionWrite]) -> None:
+        """
+        Applies up to MAX_BATCH_WRITES coalesced session writes atomically, so either every
+        document is changed or none is.
+        """
+        try:
+            await self._commit_session_writes(writes)
+        finally:
+            for write in writes:
+                self.invalidate(write.session_id, write.kind)
+
+    async def get_session_documents(self, session_id: str, kinds: List[Tuple[str, str]]) -> Dict[Tuple[str, str], Optional[dict]]:
+        """
+        Returns the data of several documents of one session. Documents that don't exist map to None.
+        """
+        documents = await self.get_versioned_session_documents(session_id, kinds)
+        return {kind: data for kind, (data, _) in documents.items()}
+
+    async def get_versioned_session_documents(
+        self, session_id: str, kinds: List[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], Tuple[Optional[dict], Optional[str]]]:
+        """
+        Returns (data, version) for several documents of one session, fetching the ones that
+        aren't cached in one round trip.
+
+        The version is the document's last update time, so it changes whenever the document
+        does. Documents that don't exist map to (None, None).
+        """
+        documents = {}
+        missing = []
+        for kind in kinds:
+            cached = self._cached(session_id, kind)
+            if cached is not None:
+                documents[kind] = cached
+            else:
+                documents[kind] = (None, None)
+                missing.append(kind)
+        if not missing:
+            return documents
+
+        tokens = {kind: self._begin_read(session_id, kind) for kind in missing}
+        documents.update(await self._fetch_session_documents(session_id, missing))
+        for kind in missing:
+            self._finish_read(session_id, kind, tokens[kind], *documents[kind])
+        return documents
+
+    @abstractmethod
+    async def list_summaries(self, limit: int, start_after: Optional[Tuple[str, str]] = None) -> List[dict]:
+        """
+        Returns a page of session summaries, most recent first, tagged with their session id.
+
+        Pages are keyset paginated on (timestamp, session id), so a deep page costs the same
+        as the first one. Summaries without a timestamp aren't listed.
+
+            Args:
+                limit: The maximum number of summaries to return
+                start_after: The (timestamp, session_id) of the last summary of the previous page
+        """
+
+    @abstractmethod
+    def export_sessions(self, page_size: int = 500, since: Optional[datetime] = None) -> AsyncIterator[dict]:
+        """
+        Yields every session with its summary, tasks and cognitive distortions, one page of
+        page_size sessions at a time, bypassing the cache.
+
+            Args:
+                page_size: The number of sessions fetched per round trip
+                since: Only export sessions with a document updated at or after this time
+        """
+
+    @abstractmethod
+    async def add_to_waitlist(self, email: str) -> None:
+        pass
+
+    @abstractmethod
+    async def _set_session_document(self, session_id: str, kind: Tuple[str, str], data: dict) -> None:
+        pass
+
+    @abstractmethod
+    async def _append_to_session_array(
+        self, session_id: str, kind: Tuple[str, str], field: str, values: list, timestamp: str
+    ) -> None:
+        pass
+
+    @abstractmethod
+    async def _commit_session_writes(self, writes: List[SessionWrite]) -> None:
+        pass
+
+    @abstractmethod
+    async def _fetch_session_documents(
+        self, session_id: str, kinds: List[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], Tuple[Optional[dict], Optional[str]]]:
+        """
+        Returns (data, version) of documents that aren't cached, leaving out the ones that don't exist
+        """
+
+
+class FirestoreStore(SessionStore):
+    """
+    Reads and writes the API's Firestore documents. The Google client libraries are
+    imported when first needed, so importing this module stays cheap.
+
+        Args:
+            client: The async Firestore client
+            cache: Optional cache of per-session documents, keyed by (session_id, kind)
+            connect: Creates the client on first use, when no client is given
+            breaker: Optional circuit breaker that Firestore calls go through
+    """
+
+    def __init__(
+        self,
+        client=None,
+        cache: Optional[TTLCache] = None,
+        connect: Optional[Callable[[], object]] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        super().__init__(cache, breaker)
+        if client is None and connect is None:
+            raise ValueError("FirestoreStore needs a client or a way to connect")
+        self._client = client
+        self._connect = connect
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._connect()
+        return self._client
+
+    def session_document(self, session_id: str, kind: Tuple[str, str]):
+        collection, document = kind
+        return self.client.collection("sessions").document(session_id).collection(collection).document(document)
+
+    async def _set_session_document(self, session_id: str, kind: Tuple[str, str], data: dict) -> None:
+        with self._guard(), timed("firestore", "set"):
+            await self.session_document(session_id, kind).set(data)
+
+    async def _append_to_session_array(
+        self, session_id: str, kind: Tuple[str, str], field: str, values: list, timestamp: str
+    ) -> None:
+        # A single merge write with an ArrayUnion transform, one round trip
+        from google.cloud import firestore
+
+        data = {
+            "timestamp": timestamp,
+            field: firestore.ArrayUnion(values)
+        }
+        with self._guard(), timed("firestore", "set"):
+            await self.session_document(session_id, kind).set(data, merge=True)
+
+    async def _commit_session_writes(self, writes: List[SessionWrite]) -> None:
+        from google.cloud import firestore
+
+        batch = self.client.batch()
+        for write in writes:
+            reference = self.session_document(write.session_id, write.kind)
+            if write.data is not None:
+                batch.set(reference, write.data)
+            else:
+                data = {field: firestore.ArrayUnion(values) for field, values in write.arrays.items()}
+                data["timestamp"] = write.timestamp
+                batch.set(reference, data, merge=True)
+        with self._guard(), timed("firestore", "commit"):
+            await batch.commit()
+
+    async def _fetch_session_documents(
+        self, session_id: str, missing: List[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], Tuple[Optional[dict], Optional[str]]]:
+        # A single get, or a batched get for several documents
+        if len(missing) == 1:
+            with self._guard(), timed("firestore", "get"):
+                snapshots = [await self.session_document(session_id, missing[0]).get()]
+        else:
+            with self._guard(), timed("firestore", "get_all"):
+                snapshots = [
+                    doc async for doc in self.client.get_all([self.session_document(session_id, kind) for kind in missing])
+                ]
+        references = {self.session_document(session_id, kind).path: kind for kind in missing}
+        documents = {}
+        for doc in snapshots:
+            if doc.exists:
+                documents[references[doc.reference.path]] = (doc.to_dict(), document_version(doc))
+        return documents
+
+    async def list_summaries(self, limit: int, start_after: Optional[Tuple[str, str]] = None) -> List[dict]:
+        # A single collection group query over every summaries/ collection, so it also finds
+        # sessions whose parent document was never written. Ordering on the document path
+        # orders on the session id.
+        from google.cloud import firestore
+        from google.cloud.firestore_v1.field_path import FieldPath
+
+        query = (
+            self.client.collection_group(SUMMARY[0])
+            .order_by("timestamp", direction=firestore.Query.DESCENDING)
+            .order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+            .limit(limit)
+        )
+        if start_after is not None:
+            timestamp, session_id = start_after
+            query = query.start_after({
+                "timestamp": timestamp,
+                "__name__": self.session_document(session_id, SUMMARY),
+            })
+
+        summaries = []
+        with self._guard(), timed("firestore", "stream"):
+            async for doc in query.stream():
+                session_id = doc.reference.parent.parent.id
+                summary = doc.to_dict()
+                summary["id"] = session_id  # Use session_id as the summary id
+                summary["session_id"] = session_id
+                summaries.append(summary)
+        return summaries
+
+    async def export_sessions(self, page_size: int = 500, since: Optional[datetime] = None) -> AsyncIterator[dict]:
+        # Sessions are listed including the ones whose parent document was never written, and
+        # each page's documents come from one batched get, so memory stays flat
+        page = []
+        async for reference in self.client.collection("sessions").list_documents(page_size=page_size):
+            page.append(reference.id)
+            if len(page) == page_size:
+                async for session in self._export_page(page, since):
+                    yield session
+                page = []
+        if page:
+            async for session in self._export_page(page, since):
+                yield session
+
+    async def _export_page(self, session_ids: List[str], since: Optional[datetime]) -> AsyncIterator[dict]:
+        kinds = {SUMMARY: "summary", TASKS: "tasks", COGNITIVE_DISTORTIONS: "cognitiveDistortions"}
+        references = {
+            session_id: [(key, self.session_document(session_id, kind).path) for kind, key in kinds.items()]
+            for session_id in session_ids
+        }
+        snapshots = {}
+        with self._guard(), timed("firestore", "get_all"):
+            async for doc in self.client.get_all(
+                [self.client.document(path) for paths in references.values() for _, path in paths]
+            ):
+                if doc.exists:
+                    snapshots[doc.reference.path] = doc
+
+        for session_id, paths in references.items():
+            session = {"session_id": session_id}
+            latest = None
+            for key, path in paths:
+                doc = snapshots.get(path)
+                session[key] = doc.to_dict() if doc is not None else None
+                if doc is not None and (latest is None or doc.update_time > latest):
+                    latest = doc.update_time
+            if since is not None and (latest is None or latest < since):
+                continue
+            yield session
+
+    async def add_to_waitlist(self, email: str) -> None:
+        with self._guard(), timed("firestore", "set"):
+            await self.client.collection("waitlist").document(email).set(
+                {"email": email, "timestamp": datetime.now().isoformat()}
+            )
+
+
+def connect_firestore():
+    """
+    Initializes the Firebase app with the credentials in GOOGLE_APPLICATION_CREDENTIALS
+    and returns its async Firestore client
+    """
+    import firebase_admin
+    from firebase_admin import credentials, firestore_async
+
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        cred = credentials.Certificate(os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "./firebase-key.json"))
+        firebase_admin.initialize_app(cred)
+    return firestore_async.client()
+
+
+def create_store(cache: Optional[TTLCache] = None) -> SessionStore:
+    """
+    Creates the store STORAGE_BACKEND names:
+
+        firestore: Firestore, with the credentials in GOOGLE_APPLICATION_CREDENTIALS (the default)
+        sqlite: A SQLite database at SQLITE_PATH
+        memory: A SQLite database in memory, gone when the process exits
+
+        Raises:
+            ValueError: If STORAGE_BACKEND is none of these
+    """
+    backend = os.getenv("STORAGE_BACKEND", "firestore").lower()
+    if backend == "firestore":
+        # Credentials are only read when the store is first used
+        breaker = CircuitBreaker.from_env("firestore", slow_call_seconds=5.0)
+        return FirestoreStore(cache=cache, connect=connect_firestore, breaker=breaker)
+    if backend in ("sqlite", "memory"):
+        from sqlite_store import SQLiteStore
+
+        path = os.getenv("SQLITE_PATH", ".data/maggie.sqlite3") if backend == "sqlite" else ":memory:"
+        return SQLiteStore(path, cache=cache)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
@@ -0,0 +1,174 @@
+import asyncio
+from unittest.mock import patch
+
+import httpx
+import pytest
+
+import main
+from admission import CRITICAL, EXEMPT, HIGH, LOW, NORMAL, AdmissionController, Shed, TokenBuckets
+from fakes import FakeFirestore
+from metrics import ADMISSION_SHED
+from storage import FirestoreStore
+
+PRIORITIES = {
+    "POST /sessions/tasks": CRITICAL,
+    "POST /sessions/{session_id}/calls": HIGH,
+    "GET /summaries": LOW,
+    "GET /export/sessions": LOW,
+    "GET /ready": EXEMPT,
+}
+SCOPE = {"client": ("10.0.0.1", 1234), "headers": []}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestAdmissionController:
+    """Test queueing, priorities and shedding"""
+
+    def test_free_slot_goes_to_the_most_urgent_waiter(self):
+        controller = AdmissionController(PRIORITIES, max_concurrency=1)
+        admitted = []
+
+        async def request(route):
+            await controller.admit(route, SCOPE)
+            admitted.append(route)
+            controller.release(route)
+
+        async def scenario():
+            await controller.admit("GET /other", SCOPE)
+            waiting = [asyncio.create_task(request(route)) for route in ("GET /summaries", "GET /other", "POST /sessions/tasks")]
+            await asyncio.sleep(0.01)
+            assert controller.stats()["waiting"] == {"low": 1, "normal": 1, "critical": 1}
+            controller.release("GET /other")
+            await asyncio.gather(*waiting)
+
+        asyncio.run(scenario())
+        assert admitted == ["POST /sessions/tasks", "GET /other", "GET /summaries"]
+        assert controller.in_flight == 0
+
+    def test_request_waiting_past_its_target_is_shed(self):
+        controller = AdmissionController(PRIORITIES, max_concurrency=1, queue_targets={LOW: 0.05})
+        before = ADMISSION_SHED.value("GET /summaries", "low", "queue_timeout")
+
+        async def scenario():
+            await controller.admit("POST /sessions/tasks", SCOPE)
+            with pytest.raises(Shed) as shed:
+                await controller.admit("GET /summaries", SCOPE)
+            return shed.value
+
+        shed = asyncio.run(scenario())
+        assert shed.status_code == 503
+        assert shed.response().headers["Retry-After"] == "1"
+        assert ADMISSION_SHED.value("GET /summaries", "low", "queue_timeout") == before + 1
+        assert controller.stats()["waiting"] == {}
+
+    def test_backlog_sheds_on_arrival(self):
+        controller = AdmissionController(PRIORITIES, max_concurrency=1, queue_targets={NORMAL: 1.0, LOW: 0.05})
+
+        async def scenario():
+            await controller.admit("POST /sessions/tasks", SCOPE)
+            waiting = asyncio.create_task(controller.admit("GET /other", SCOPE))
+            await asyncio.sleep(0.1)
+            with pytest.raises(Shed) as shed:
+                await controller.admit("GET /summaries", SCOPE)
+            controller.release("POST /sessions/tasks")
+            await waiting
+            return shed.value
+
+        assert asyncio.run(scenario()).reason == "queue_backlog"
+
+    def test_route_limit(self):
+        controller = AdmissionController(PRIORITIES, max_concurrency=10, route_limits={"GET /export/sessions": 1})
+
+        async def scenario():
+            await controller.admit("GET /export/sessions", SCOPE)
+            second_export = asyncio.create_task(controller.admit("GET /export/sessions", SCOPE))
+            # Other routes aren't held up behind it
+            await asyncio.wait_for(controller.admit("GET /summaries", SCOPE), 0.1)
+            await asyncio.sleep(0.01)
+            assert not second_export.done()
+            controller.release("GET /export/sessions")
+            await asyncio.wait_for(second_export, 0.1)
+
+        asyncio.run(scenario())
+
+    def test_exempt_routes_are_not_counted(self):
+        controller = AdmissionController(PRIORITIES, max_concurrency=1)
+
+        async def scenario():
+            await controller.admit("POST /sessions/tasks", SCOPE)
+            return await asyncio.wait_for(controller.admit("GET /ready", SCOPE), 0.1)
+
+        assert asyncio.run(scenario()) is False
+        assert controller.in_flight == 1
+
+    def test_rate_limits_spare_critical_routes(self):
+        clock = Clock()
+        controller = AdmissionController(PRIORITIES, rate_limits=TokenBuckets(rate=1, burst=2, clock=clock))
+
+        async def scenario():
+            for _ in range(2):
+                await controller.admit("POST /sessions/{session_id}/calls", SCOPE)
+            with pytest.raises(Shed) as shed:
+                await controller.admit("POST /sessions/{session_id}/calls", SCOPE)
+            # Another client has a bucket of its own, and tool callbacks aren't limited
+            await controller.admit("POST /sessions/{session_id}/calls", {"client": ("10.0.0.2", 1), "headers": []})
+            for _ in range(5):
+                await controller.admit("POST /sessions/tasks", SCOPE)
+            clock.now = 1.0
+            await controller.admit("POST /sessions/{session_id}/calls", SCOPE)
+            return shed.value
+
+        shed = asyncio.run(scenario())
+        assert shed.status_code == 429
+        assert shed.retry_after == 1.0
+
+    def test_client_header(self):
+        controller = AdmissionController(PRIORITIES, rate_limits=TokenBuckets(rate=1, burst=1), client_header="X-Forwarded-For")
+        scope = lambda forwarded: {"client": ("10.0.0.1", 1), "headers": [(b"x-forwarded-for", forwarded)]}
+
+        async def scenario():
+            await controller.admit("GET /summaries", scope(b"203.0.113.1, 10.0.0.1"))
+            await controller.admit("GET /summaries", scope(b"203.0.113.2, 10.0.0.1"))
+            with pytest.raises(Shed):
+                await controller.admit("GET /summaries", scope(b"203.0.113.1"))
+
+        asyncio.run(scenario())
+
+
+class TestOverload:
+    """Test the app under more load than it admits"""
+
+    def test_low_priority_is_shed_and_tool_calls_go_through(self):
+        fake = FakeFirestore(latency=0.05)
+        controller = AdmissionController(main.ROUTE_PRIORITIES, max_concurrency=2)
+
+        async def scenario():
+            async with main.app.router.lifespan_context(main.app):
+                transport = httpx.ASGITransport(app=main.app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                    summaries = [client.get("/summaries") for _ in range(30)]
+                    tasks = [
+                        client.post("/sessions/tasks", json={"session_id": f"session_{i}", "task": "Walk"})
+                        for i in range(10)
+                    ]
+                    responses = await asyncio.gather(*summaries, *tasks)
+                    metrics = (await client.get("/metrics")).text
+            return responses[:30], responses[30:], metrics
+
+        with patch("main.store", FirestoreStore(fake)), patch("main.admission_controller", controller), \
+                patch("main.ADMISSION", True):
+            summaries, tasks, metrics = asyncio.run(scenario())
+
+        assert [response.status_code for response in tasks] == [200] * 10
+        shed = [response for response in summaries if response.status_code == 503]
+        assert shed
+        assert all(response.headers["Retry-After"] for response in shed)
+        assert {response.status_code for response in summaries} <= {200, 503}
+        assert 'admission_shed_total{route="GET /summaries",priority="low"' in metrics
@@ -2,8 +2,11 @@ import pytest
 from fastapi.testclient import TestClient
 from unittest.mock import Mock, patch, MagicMock, AsyncMock
 import json
-from datetime import datetime
-from main import app
+import time
+from datetime import datetime, timedelta
+from main import app, resource_queue
+from storage import FirestoreStore
+from cache import TTLCache, TwoTierCache
 
 # Create test client
 client = TestClient(app)
@@ -16,12 +19,12 @@ test_summary_id = "summary_456"
 class TestSessionCalls:
     """Test session call endpoints"""
     
-    @patch('main.get_payload')
-    @patch('httpx.AsyncClient')
-    def test_create_session_call_success(self, mock_client, mock_get_payload):
+    @patch('main.get_payload_json')
+    @patch('main.get_http_client')
+    def test_create_session_call_success(self, mock_get_http_client, mock_get_payload_json):
         """Test POST /sessions/{session_id}/calls"""
         # Mock the payload
-        mock_get_payload.return_value = {"test": "payload"}
+        mock_get_payload_json.return_value = b'{"test": "payload"}'
         
         # Mock the HTTP response
         mock_response = Mock()
@@ -31,7 +34,7 @@ class TestSessionCalls:
         
         mock_client_instance = AsyncMock()
         mock_client_instance.post.return_value = mock_response
-        mock_client.return_value.__aenter__.return_value = mock_client_instance
+        mock_get_http_client.return_value = mock_client_instance
         
         with patch.dict('os.environ', {'ULTRAVOX_API_KEY': 'test_key'}):
             response = client.post(f"/sessions/{test_session_id}/calls")
@@ -54,50 +57,37 @@ class TestSessionCalls:
 class TestSessionCognitiveDistortions:
     """Test cognitive distortions endpoints"""
     
-    @patch('main.db')
-    def test_create_cognitive_distortions_success(self, mock_db):
-        """Test POST /sessions/{session_id}/cognitive-distortions"""
-        # Mock Firestore document reference
-        mock_doc_ref = Mock()
-        mock_doc_ref.id = "distortion_123"
-        mock_collection = Mock()
-        mock_collection.document.return_value = mock_doc_ref
-        mock_db.collection.return_value.document.return_value.collection.return_value = mock_collection
-        
+    def test_create_cognitive_distortions_success(self, fake_db):
+        """Test POST /sessions/cognitive-distortions"""
         response = client.post(
-            f"/sessions/{test_session_id}/cognitive-distortions",
-            json={"cognitiveDistortions": ["catastrophizing", "all-or-nothing"]}
+            "/sessions/cognitive-distortions",
+            json={"session_id": test_session_id, "cognitiveDistortions": ["catastrophizing", "all-or-nothing"]}
         )
         
         assert response.status_code == 200
         data = response.json()
         assert "Cognitive distortions saved successfully" in data["message"]
-        assert data["distortion_id"] == "distortion_123"
+        assert data["distortion_id"] == "distortions_doc"
+        stored = fake_db.dump(f"sessions/{test_session_id}/cognitive-distortions/distortions_doc")
+        assert stored["distortions"] == ["catastrophizing", "all-or-nothing"]
     
     def test_create_cognitive_distortions_empty_list(self):
-        """Test POST /sessions/{session_id}/cognitive-distortions with empty list"""
+        """Test POST /sessions/cognitive-distortions with empty list"""
         response = client.post(
-            f"/sessions/{test_session_id}/cognitive-distortions",
-            json={"cognitiveDistortions": []}
+            "/sessions/cognitive-distortions",
+            json={"session_id": test_session_id, "cognitiveDistortions": []}
         )
         
         assert response.status_code == 400
         data = response.json()
         assert "No cognitive distortions provided" in data["message"]
     
-    @patch('main.db')
-    def test_get_cognitive_distortions_success(self, mock_db):
+    def test_get_cognitive_distortions_success(self, fake_db):
         """Test GET /sessions/{session_id}/cognitive-distortions"""
-        # Mock Firestore response
-        mock_doc = Mock()
-        mock_doc.to_dict.return_value = {
+        fake_db.seed(f"sessions/{test_session_id}/cognitive-distortions/distortions_doc", {
             "timestamp": "2024-01-15T10:30:00Z",
             "distortions": ["catastrophizing"]
-        }
-        mock_doc.id = "distortion_123"
-        
-        mock_stream = [mock_doc]
-        mock_db.collection.return_value.document.return_value.collection.return_value.stream.return_value = mock_stream
+        })
         
         response = client.get(f"/sessions/{test_session_id}/cognitive-distortions")
         
@@ -105,81 +95,98 @@ class TestSessionCognitiveDistortions:
         data = response.json()
         assert "cognitiveDistortions" in data
         assert len(data["cognitiveDistortions"]) == 1
+        assert data["cognitiveDistortions"][0]["distortions"] == ["catastrophizing"]
+
+    def test_get_returns_what_post_wrote(self, fake_db):
+        """GET /sessions/{session_id}/cognitive-distortions reads the document the POST writes"""
+        client.post(
+            "/sessions/cognitive-distortions",
+            json={"session_id": test_session_id, "cognitiveDistortions": ["labeling"]}
+        )
+
+        response = client.get(f"/sessions/{test_session_id}/cognitive-distortions")
+
+        assert response.json()["cognitiveDistortions"][0]["distortions"] == ["labeling"]
+
+    def test_repeated_distortions_are_kept_once(self, fake_db):
+        """Distortions already saved for the session aren't added again, and the response says so"""
+        for distortions in (["labeling", "mind reading"], ["labeling"]):
+            response = client.post(
+                "/sessions/cognitive-distortions",
+                json={"session_id": test_session_id, "cognitiveDistortions": distortions}
+            )
+            assert response.status_code == 200
+            assert "already saved for this session are kept once" in response.json()["message"]
+
+        stored = fake_db.dump(f"sessions/{test_session_id}/cognitive-distortions/distortions_doc")
+        assert stored["distortions"] == ["labeling", "mind reading"]
 
 
 class TestSessionTasks:
     """Test user tasks endpoints"""
     
-    @patch('main.db')
-    def test_create_task_success_new_document(self, mock_db):
-        """Test POST /sessions/{session_id}/tasks - creating new tasks document"""
-        mock_doc_ref = Mock()
-        mock_doc_ref.id = "tasks_doc"
-        
-        mock_doc = Mock()
-        mock_doc.exists = False
-        mock_doc_ref.get.return_value = mock_doc
-        
-        mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value = mock_doc_ref
-        
+    def test_create_task_success_new_document(self, fake_db):
+        """Test POST /sessions/tasks - creating new tasks document"""
         response = client.post(
-            f"/sessions/{test_session_id}/tasks",
-            json={"task": "Practice breathing exercises for 5 minutes daily"}
+            "/sessions/tasks",
+            json={"session_id": test_session_id, "task": "Practice breathing exercises for 5 minutes daily"}
         )
         
         assert response.status_code == 200
         data = response.json()
         assert "User task saved successfully" in data["message"]
         assert data["task_id"] == "tasks_doc"
+        stored = fake_db.dump(f"sessions/{test_session_id}/tasks/tasks_doc")
+        assert stored["tasks"] == ["Practice breathing exercises for 5 minutes daily"]
     
-    @patch('main.db')
-    def test_create_task_append_to_existing(self, mock_db):
-        """Test POST /sessions/{session_id}/tasks - appending to existing tasks"""
-        mock_doc_ref = Mock()
-        mock_doc_ref.id = "tasks_doc"
-        
-        mock_doc = Mock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = {
+    def test_create_task_append_to_existing(self, fake_db):
+        """Test POST /sessions/tasks - appending to existing tasks"""
+        fake_db.seed(f"sessions/{test_session_id}/tasks/tasks_doc", {
             "timestamp": "2024-01-15T10:30:00Z",
             "tasks": ["Existing task"]
-        }
-        mock_doc_ref.get.return_value = mock_doc
-        
-        mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value = mock_doc_ref
+        })
         
         response = client.post(
-            f"/sessions/{test_session_id}/tasks",
-            json={"task": "New task"}
+            "/sessions/tasks",
+            json={"session_id": test_session_id, "task": "New task"}
         )
         
         assert response.status_code == 200
         data = response.json()
         assert "User task saved successfully" in data["message"]
+        stored = fake_db.dump(f"sessions/{test_session_id}/tasks/tasks_doc")
+        assert stored["tasks"] == ["Existing task", "New task"]
+
+    def test_create_task_repeated_task_is_kept_once(self, fake_db):
+        """Test POST /sessions/tasks - a task already saved isn't added again"""
+        for _ in range(2):
+            response = client.post(
+                "/sessions/tasks",
+                json={"session_id": test_session_id, "task": "Journal daily"}
+            )
+            assert response.status_code == 200
+            assert "already saved for this session is kept once" in response.json()["message"]
+
+        stored = fake_db.dump(f"sessions/{test_session_id}/tasks/tasks_doc")
+        assert stored["tasks"] == ["Journal daily"]
     
     def test_create_task_missing_task(self):
-        """Test POST /sessions/{session_id}/tasks with missing task"""
+        """Test POST /sessions/tasks with missing task"""
         response = client.post(
-            f"/sessions/{test_session_id}/tasks",
-            json={}
+            "/sessions/tasks",
+            json={"session_id": test_session_id}
         )
         
         assert response.status_code == 400
         data = response.json()
         assert "No task provided" in data["message"]
     
-    @patch('main.db')
-    def test_get_tasks_success(self, mock_db):
+    def test_get_tasks_success(self, fake_db):
         """Test GET /sessions/{session_id}/tasks"""
-        mock_doc = Mock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = {
+        fake_db.seed(f"sessions/{test_session_id}/tasks/tasks_doc", {
             "timestamp": "2024-01-15T10:30:00Z",
             "tasks": ["Practice breathing exercises", "Journal daily"]
-        }
-        mock_doc.id = "tasks_doc"
-        
-        mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value.get.return_value = mock_doc
+        })
         
         response = client.get(f"/sessions/{test_session_id}/tasks")
         
@@ -193,16 +200,12 @@ class TestSessionTasks:
 class TestSessionSummary:
     """Test session summary endpoints"""
     
-    @patch('main.db')
-    def test_create_summary_success(self, mock_db):
-        """Test POST /sessions/{session_id}/summary"""
-        mock_doc_ref = Mock()
-        mock_doc_ref.id = "summary_doc"
-        mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value = mock_doc_ref
-        
+    def test_create_summary_success(self, fake_db):
+        """Test POST /sessions/summary"""
         response = client.post(
-            f"/sessions/{test_session_id}/summary",
+            "/sessions/summary",
             json={
+                "session_id": test_session_id,
                 "conversationSummary": "User discussed anxiety about work presentations",
                 "identifiedCognitiveDistortions": ["catastrophizing"],
                 "suggestedExercises": "Practice progressive muscle relaxation"
@@ -213,15 +216,18 @@ class TestSessionSummary:
         data = response.json()
         assert "Conversation summary saved successfully" in data["message"]
         assert data["summary_id"] == "summary_doc"
+        stored = fake_db.dump(f"sessions/{test_session_id}/summaries/summary_doc")
+        assert stored["summary"] == "User discussed anxiety about work presentations"
 
 
 class TestSessionResources:
     """Test session resources endpoints"""
     
-    @patch('main.Exa')
-    @patch('main.db')  
-    def test_create_session_resources_success(self, mock_db, mock_exa_class):
-        """Test POST /sessions/{session_id}/resources"""
+    @patch('main.exa_client', None)
+    @patch('main.resource_cache', TwoTierCache(TTLCache(maxsize=10, ttl=60)))
+    @patch('exa_py.Exa')
+    def test_create_session_resources_success(self, mock_exa_class, fake_db):
+        """Test POST /sessions/resources"""
         # Mock Exa API
         mock_exa_instance = Mock()
         mock_result = Mock()
@@ -237,26 +243,50 @@ class TestSessionResources:
         mock_exa_instance.search_and_contents.return_value = mock_result
         mock_exa_class.return_value = mock_exa_instance
         
-        # Mock Firestore
-        mock_doc_ref = Mock()
-        mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value = mock_doc_ref
-        
-        with patch.dict('os.environ', {'EXA_API_KEY': 'test_key'}):
-            response = client.post(
-                f"/sessions/{test_session_id}/resources",
-                json={"query": "anxiety management techniques"}
+        with patch.dict('os.environ', {'EXA_API_KEY': 'test_key'}), TestClient(app) as lifespan_client:
+            response = lifespan_client.post(
+                "/sessions/resources",
+                json={"session_id": test_session_id, "query": "anxiety management techniques"}
             )
+            # Wait for the resource fetch queue to store the results
+            lifespan_client.portal.call(resource_queue.join)
         
         assert response.status_code == 200
         data = response.json()
         assert data["status"] == "success"
         assert "Resources created successfully" in data["message"]
+        stored = fake_db.dump(f"sessions/{test_session_id}/resources/resources_doc")
+        assert stored["resources"][0]["url"] == "https://example.com"
+    
+    @patch('main.exa_client', None)
+    @patch('main.resource_cache', TwoTierCache(TTLCache(maxsize=10, ttl=60)))
+    @patch('exa_py.Exa')
+    def test_repeated_query_uses_cache(self, mock_exa_class, fake_db):
+        """A repeated query is answered from the cache without calling Exa again"""
+        mock_result = Mock()
+        mock_result.results = [
+            Mock(url="https://example.com", title="Breathing", text="Breathe in", image=None, favicon=None)
+        ]
+        mock_exa_class.return_value.search_and_contents.return_value = mock_result
+        
+        with TestClient(app) as lifespan_client:
+            for session_id, query in (("session_a", "Breathing exercises for anxiety"), ("session_b", "  breathing EXERCISES for anxiety? ")):
+                response = lifespan_client.post("/sessions/resources", json={"session_id": session_id, "query": query})
+                assert response.status_code == 200
+                lifespan_client.portal.call(resource_queue.join)
+            stats = lifespan_client.get("/stats").json()
+        
+        assert mock_exa_class.call_count == 1
+        assert mock_exa_class.return_value.search_and_contents.call_count == 1
+        stored = fake_db.dump("sessions/session_b/resources/resources_doc")
+        assert stored["resources"][0]["title"] == "Breathing"
+        assert stats["resource_cache"]["hits"] == 1
     
     def test_create_session_resources_missing_query(self):
-        """Test POST /sessions/{session_id}/resources with missing query"""
+        """Test POST /sessions/resources with missing query"""
         response = client.post(
-            f"/sessions/{test_session_id}/resources",
-            json={}
+            "/sessions/resources",
+            json={"session_id": test_session_id}
         )
         
         assert response.status_code == 400
@@ -273,12 +303,9 @@ class TestSessionResources:
         # FastAPI returns 404 for empty path parameter (route doesn't match)
         assert response.status_code == 404
     
-    @patch('main.db')
-    def test_get_resources_success(self, mock_db):
+    def test_get_resources_success(self, fake_db):
         """Test GET /sessions/{session_id}/resources"""
-        mock_doc = Mock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = {
+        fake_db.seed(f"sessions/{test_session_id}/resources/resources_doc", {
             "timestamp": "2024-01-15T10:30:00Z",
             "resources": [
                 {
@@ -288,9 +315,7 @@ class TestSessionResources:
                     "image": "https://example.com/image.jpg"
                 }
             ]
-        }
-        mock_doc.id = "resources_doc"
-        mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value.get.return_value = mock_doc
+        })
         
         response = client.get(f"/sessions/{test_session_id}/resources")
         
@@ -299,13 +324,8 @@ class TestSessionResources:
         assert "resources" in data
         assert data["id"] == "resources_doc"
     
-    @patch('main.db')
-    def test_get_resources_not_found(self, mock_db):
+    def test_get_resources_not_found(self, fake_db):
         """Test GET /sessions/{session_id}/resources when no resources exist"""
-        mock_doc = Mock()
-        mock_doc.exists = False
-        mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value.get.return_value = mock_doc
-        
         response = client.get(f"/sessions/{test_session_id}/resources")
         
         assert response.status_code == 404
@@ -313,6 +333,60 @@ class TestSessionResources:
         assert "No resources found" in data["message"]
 
 
+class TestSessionBundle:
+    """Test GET /sessions/{session_id}/bundle"""
+
+    def seed_session(self, fake_db):
+        base = f"sessions/{test_session_id}"
+        fake_db.seed(f"{base}/tasks/tasks_doc", {"tasks": ["Journal daily"], "timestamp": "2024-01-15T10:30:00"})
+        fake_db.seed(f"{base}/cognitive-distortions/distortions_doc", {"distortions": ["labeling"], "timestamp": "2024-01-15T10:30:00"})
+        fake_db.seed(f"{base}/summaries/summary_doc", {"summary": "Good progress", "timestamp": "2024-01-15T10:30:00"})
+
+    def test_bundle_in_one_round_trip(self, fake_db):
+        """Every section comes back from a single batched get, missing ones as empty"""
+        self.seed_session(fake_db)
+
+        response = client.get(f"/sessions/{test_session_id}/bundle")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["userTasks"][0]["tasks"] == ["Journal daily"]
+        assert data["cognitiveDistortions"][0]["distortions"] == ["labeling"]
+        assert data["summary"]["summary"] == "Good progress"
+        assert data["summary"]["id"] == test_session_id
+        assert data["resources"] is None
+        assert fake_db.rpc_count == 1
+
+    def test_bundle_matches_section_endpoints(self, fake_db):
+        """Each section is shaped like the response of its own endpoint"""
+        self.seed_session(fake_db)
+
+        bundle = client.get(f"/sessions/{test_session_id}/bundle").json()
+
+        assert bundle["userTasks"] == client.get(f"/sessions/{test_session_id}/tasks").json()["userTasks"]
+        assert bundle["cognitiveDistortions"] == client.get(
+            f"/sessions/{test_session_id}/cognitive-distortions"
+        ).json()["cognitiveDistortions"]
+        assert bundle["summary"] == client.get(f"/summaries/{test_session_id}").json()
+
+    def test_bundle_include(self, fake_db):
+        """include= limits the sections fetched and returned"""
+        self.seed_session(fake_db)
+
+        response = client.get(f"/sessions/{test_session_id}/bundle", params={"include": "tasks,summary"})
+
+        assert response.status_code == 200
+        assert set(response.json()) == {"session_id", "userTasks", "summary"}
+        assert fake_db.documents_read == 2
+
+    def test_bundle_unknown_section(self, fake_db):
+        response = client.get(f"/sessions/{test_session_id}/bundle", params={"include": "tasks,notes"})
+
+        assert response.status_code == 400
+        assert "notes" in response.json()["message"]
+        assert fake_db.rpc_count == 0
+
+
 class TestGlobalEndpoints:
     """Test global (non-session specific) endpoints"""
     
@@ -324,48 +398,16 @@ class TestGlobalEndpoints:
         data = response.json()
         assert data["message"] == "Hello, World!"
     
-    @patch('main.db')
-    def test_get_all_summaries(self, mock_db):
+    def test_get_all_summaries(self, fake_db):
         """Test GET /summaries"""
-        # Mock session documents
-        mock_session_docs = []
         for i in range(3):
-            mock_session_doc = Mock()
-            mock_session_doc.id = f"session_{i}"
-            mock_session_docs.append(mock_session_doc)
-        
-        # Set up the collection chain properly
-        mock_sessions_collection = Mock()
-        mock_sessions_collection.stream.return_value = mock_session_docs
-        
-        # Mock get() for each summary document
-        mock_summary_docs = []
-        for i in range(3):
-            mock_summary_doc = Mock()
-            mock_summary_doc.exists = True
-            mock_summary_doc.to_dict.return_value = {
+            fake_db.seed(f"sessions/session_{i}", {"status": "ended"})
+            fake_db.seed(f"sessions/session_{i}/summaries/summary_doc", {
                 "timestamp": f"2024-01-{15+i}T10:30:00Z",
                 "summary": f"Summary {i}",
                 "cognitiveDistortions": ["catastrophizing"],
                 "suggestedExercises": f"Exercise {i}"
-            }
-            mock_summary_docs.append(mock_summary_doc)
-        
-        # Set up the mock to return sessions collection first, then individual summary docs
-        call_count = 0
-        def mock_collection(*args):
-            nonlocal call_count
-            if args[0] == "sessions" and call_count == 0:
-                call_count += 1
-                return mock_sessions_collection
-            else:
-                # This is for getting individual summaries
-                mock_doc = Mock()
-                mock_doc.collection.return_value.document.return_value.get.return_value = mock_summary_docs[call_count - 1] if call_count <= 3 else Mock(exists=False)
-                call_count += 1
-                return Mock(document=Mock(return_value=mock_doc))
-        
-        mock_db.collection.side_effect = mock_collection
+            })
         
         response = client.get("/summaries")
         
@@ -374,18 +416,28 @@ class TestGlobalEndpoints:
         assert "summaries" in data
         assert len(data["summaries"]) == 3
     
-    @patch('main.db')
-    def test_get_specific_summary(self, mock_db):
+    def test_get_all_summaries_single_query(self, fake_db):
+        """Test GET /summaries returns newest first, including sessions without a parent document"""
+        fake_db.seed("sessions/session_old/summaries/summary_doc", {"timestamp": "2024-01-01T10:30:00", "summary": "Old"})
+        fake_db.seed("sessions/session_new/summaries/summary_doc", {"timestamp": "2024-03-01T10:30:00", "summary": "New"})
+        fake_db.seed("sessions/session_mid", {"status": "ended"})
+        fake_db.seed("sessions/session_mid/summaries/summary_doc", {"timestamp": "2024-02-01T10:30:00", "summary": "Mid"})
+        
+        response = client.get("/summaries")
+        
+        assert response.status_code == 200
+        summaries = response.json()["summaries"]
+        assert [summary["session_id"] for summary in summaries] == ["session_new", "session_mid", "session_old"]
+        assert fake_db.rpc_count == 1
+    
+    def test_get_specific_summary(self, fake_db):
         """Test GET /summaries/{summary_id}"""
-        mock_doc = Mock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = {
+        fake_db.seed(f"sessions/{test_summary_id}/summaries/summary_doc", {
             "timestamp": "2024-01-15T10:30:00Z",
             "summary": "Test summary",
             "cognitiveDistortions": ["catastrophizing"],
             "suggestedExercises": "Test exercise"
-        }
-        mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value.get.return_value = mock_doc
+        })
         
         response = client.get(f"/summaries/{test_summary_id}")
         
@@ -394,26 +446,17 @@ class TestGlobalEndpoints:
         assert data["id"] == test_summary_id
         assert data["summary"] == "Test summary"
     
-    @patch('main.db')
-    def test_get_summary_not_found(self, mock_db):
+    def test_get_summary_not_found(self, fake_db):
         """Test GET /summaries/{summary_id} when summary doesn't exist"""
-        mock_doc = Mock()
-        mock_doc.exists = False
-        mock_db.collection.return_value.document.return_value.collection.return_value.document.return_value.get.return_value = mock_doc
-        
         response = client.get(f"/summaries/{test_summary_id}")
         
         assert response.status_code == 404
         data = response.json()
         assert "Summary not found" in data["error"]
     
-    @patch('main.smtplib.SMTP_SSL')
-    def test_send_email_success(self, mock_smtp):
+    @patch('main.mailer.submit', return_value="email_123")
+    def test_send_email_success(self, mock_submit):
         """Test POST /emails"""
-        # Mock SMTP server
-        mock_server = Mock()
-        mock_smtp.return_value.__enter__.return_value = mock_server
-        
         with patch.dict('os.environ', {
             'EMAIL_ADDRESS': 'test@example.com',
             'EMAIL_PASSWORD': 'test_password'
@@ -430,16 +473,14 @@ class TestGlobalEndpoints:
                 }
             )
         
-        assert response.status_code == 200
+        assert response.status_code == 202
         data = response.json()
-        assert "Email sent successfully" in data["message"]
+        assert "Email queued" in data["message"]
+        assert data["email_id"] == "email_123"
+        assert mock_submit.call_args[0][0]["To"] == "user@example.com"
     
-    @patch('main.db')
-    def test_add_to_waitlist(self, mock_db):
+    def test_add_to_waitlist(self, fake_db):
         """Test POST /waitlist"""
-        mock_doc_ref = Mock()
-        mock_db.collection.return_value.document.return_value = mock_doc_ref
-        
         response = client.post(
             "/waitlist",
             json={"email": "user@example.com"}
@@ -448,6 +489,82 @@ class TestGlobalEndpoints:
         assert response.status_code == 200
         data = response.json()
         assert "User added to waitlist successfully" in data["message"]
+        assert fake_db.dump("waitlist/user@example.com")["email"] == "user@example.com"
+
+
+class TestSummariesPagination:
+    """Test keyset pagination of GET /summaries"""
+    
+    def seed_summaries(self, fake_db, count):
+        for i in range(count):
+            fake_db.seed(f"sessions/session_{i:05d}/summaries/summary_doc", {
+                # Every ten sessions share a timestamp, so ties are broken by session
+                "timestamp": (datetime(2024, 1, 1) + timedelta(seconds=i // 10)).isoformat(),
+                "summary": f"Summary {i}"
+            })
+    
+    def test_pages_cover_every_summary_once(self, fake_db):
+        """Walking every page returns each summary exactly once, newest first"""
+        self.seed_summaries(fake_db, 95)
+        
+        seen = []
+        cursor = None
+        while True:
+            params = {"limit": 10}
+            if cursor:
+                params["cursor"] = cursor
+            response = client.get("/summaries", params=params)
+            assert response.status_code == 200
+            data = response.json()
+            seen.extend(data["summaries"])
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+        
+        assert len(seen) == 95
+        assert len({summary["session_id"] for summary in seen}) == 95
+        keys = [(summary["timestamp"], summary["session_id"]) for summary in seen]
+        assert keys == sorted(keys, reverse=True)
+    
+    def test_page_cost_stays_flat(self, fake_db):
+        """With 10k summaries, a deep page reads and costs the same as the first one"""
+        self.seed_summaries(fake_db, 10000)
+        
+        page_reads = []
+        page_latencies = []
+        cursor = None
+        for _ in range(100):
+            params = {"limit": 100}
+            if cursor:
+                params["cursor"] = cursor
+            reads_before = fake_db.documents_read
+            started = time.perf_counter()
+            response = client.get("/summaries", params=params)
+            page_latencies.append(time.perf_counter() - started)
+            page_reads.append(fake_db.documents_read - reads_before)
+            assert response.status_code == 200
+            cursor = response.json()["next_cursor"]
+        
+        assert cursor is None
+        # Every page reads one extra summary to detect the next page, except the last
+        assert page_reads == [101] * 99 + [100]
+        first_pages = sorted(page_latencies[:10])[5]
+        deep_pages = sorted(page_latencies[-10:])[5]
+        print(f"\nmedian page latency: first pages {first_pages * 1000:.1f} ms, deep pages {deep_pages * 1000:.1f} ms")
+        assert deep_pages < first_pages * 3
+    
+    def test_invalid_cursor(self, fake_db):
+        """Test GET /summaries with a cursor it didn't issue"""
+        response = client.get("/summaries", params={"cursor": "not-a-cursor"})
+        
+        assert response.status_code == 400
+        assert "Invalid cursor" in response.json()["message"]
+    
+    def test_limit_out_of_range(self):
+        """Test GET /summaries with a limit above the maximum page size"""
+        response = client.get("/summaries", params={"limit": 10000})
+        
+        assert response.status_code == 422
 
 
 class TestErrorHandling:
@@ -465,23 +582,25 @@ class TestErrorHandling:
     def test_malformed_json(self):
         """Test endpoints with malformed JSON"""
         response = client.post(
-            f"/sessions/{test_session_id}/tasks",
+            "/sessions/tasks",
             content="invalid json",
             headers={"content-type": "application/json"}
         )
         
-        # When JSON parsing fails inside the endpoint, it returns 500
-        assert response.status_code == 500
+        # The body is rejected before the handler runs
+        assert response.status_code == 400
+        assert response.json()["message"] == "Invalid JSON body"
     
-    @patch('main.db')
-    def test_database_error_handling(self, mock_db):
+    def test_database_error_handling(self):
         """Test handling of database errors"""
+        mock_db = Mock()
         mock_db.collection.side_effect = Exception("Database connection failed")
         
-        response = client.post(
-            f"/sessions/{test_session_id}/tasks",
-            json={"task": "test task"}
-        )
+        with patch('main.store', FirestoreStore(mock_db)):
+            response = client.post(
+                "/sessions/tasks",
+                json={"session_id": test_session_id, "task": "test task"}
+            )
         
         assert response.status_code == 500
         data = response.json()
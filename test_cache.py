@@ -0,0 +1,102 @@
+from cache import DiskCache, TTLCache, TwoTierCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache:
+    """Test the in-process LRU cache"""
+
+    def test_entries_expire(self):
+        clock = FakeClock()
+        cache = TTLCache(maxsize=10, ttl=60, clock=clock)
+        cache.set("key", "value")
+
+        clock.now = 59
+        assert cache.get("key") == "value"
+        clock.now = 60
+        assert cache.get("key") is None
+
+    def test_expired_rows_are_deleted(self, tmp_path):
+        path = str(tmp_path / "exa.sqlite3")
+        clock = FakeClock()
+        cache = DiskCache(path, ttl=60, prune_every=3, clock=clock)
+        cache.set("read", "value")
+        cache.set("unread", "value")
+        clock.now = 61
+
+        # An expired read deletes its row, and every third set deletes the rest
+        assert cache.get("read") is None
+        assert cache.pruned == 1
+        cache.set("fresh", "value")
+        assert cache.pruned == 2
+        assert cache.get("fresh") == "value"
+
+        cache.set("stale", "value")
+        cache.close()
+        clock.now = 200
+        reopened = DiskCache(path, ttl=60, clock=clock)
+        assert reopened.get("missing") is None
+        assert reopened.pruned == 2
+        rows = reopened._connect().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        assert rows == 0
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+        assert len(cache) == 2
+
+
+class TestDiskCache:
+    """Test the persistent compressed cache"""
+
+    def test_values_survive_a_restart(self, tmp_path):
+        path = str(tmp_path / "cache" / "exa.sqlite3")
+        cache = DiskCache(path, ttl=60)
+        cache.set("breathing exercises", [{"url": "https://example.com", "text": "Breathe " * 1000}])
+        cache.close()
+
+        reopened = DiskCache(path, ttl=60)
+        assert reopened.get("breathing exercises")[0]["url"] == "https://example.com"
+        assert reopened.get("something else") is None
+        assert reopened.stats()["hits"] == 1
+        assert reopened.stats()["misses"] == 1
+
+    def test_expired_values_are_misses(self, tmp_path):
+        cache = DiskCache(str(tmp_path / "exa.sqlite3"), ttl=-1)
+        cache.set("key", "value")
+
+        assert cache.get("key") is None
+
+
+class TestTwoTierCache:
+    """Test the memory cache in front of the disk cache"""
+
+    def test_disk_hits_are_promoted_to_memory(self, tmp_path):
+        disk = DiskCache(str(tmp_path / "exa.sqlite3"), ttl=60)
+        disk.set("key", {"value": 1})
+        cache = TwoTierCache(TTLCache(maxsize=10, ttl=60), disk)
+
+        assert cache.get("key") == {"value": 1}
+        assert cache.get("key") == {"value": 1}
+        assert cache.get("missing") is None
+
+        stats = cache.stats()
+        assert stats["hits"] == 2
+        assert stats["misses"] == 1
+        assert stats["memory"]["hits"] == 1
+        assert stats["disk"]["hits"] == 1
@@ -0,0 +1,209 @@
+import asyncio
+import time
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+from cache import TTLCache, TwoTierCache
+from circuit import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+from fakes import FakeFirestore
+import main
+from main import app, normalize_query
+from metrics import CIRCUIT_REJECTED
+from storage import FirestoreStore
+
+test_session_id = "circuit_session"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_breaker(clock=None, **kwargs):
+    kwargs.setdefault("min_calls", 4)
+    kwargs.setdefault("window", 4)
+    kwargs.setdefault("open_seconds", 10.0)
+    return CircuitBreaker("test", clock=clock or Clock(), **kwargs)
+
+
+def fail(breaker, error=ConnectionError("down")):
+    with pytest.raises(type(error)):
+        with breaker.guard():
+            raise error
+
+
+def succeed(breaker):
+    with breaker.guard():
+        pass
+
+
+def open_breaker(dependency: str) -> CircuitBreaker:
+    breaker = CircuitBreaker(dependency, min_calls=1, open_seconds=60)
+    fail(breaker)
+    return breaker
+
+
+class TestCircuitBreaker:
+    """Test opening, failing fast and probing"""
+
+    def test_opens_at_the_failure_rate(self):
+        breaker = make_breaker()
+        succeed(breaker)
+        fail(breaker)
+        succeed(breaker)
+        assert breaker.state == CLOSED
+        fail(breaker)
+        assert breaker.state == OPEN
+
+    def test_needs_min_calls_to_open(self):
+        breaker = make_breaker()
+        for _ in range(3):
+            fail(breaker)
+        assert breaker.state == CLOSED
+
+    def test_opens_on_slow_calls(self):
+        breaker = make_breaker(slow_call_seconds=0.0, slow_call_rate=1.0)
+        for _ in range(4):
+            succeed(breaker)
+        assert breaker.state == OPEN
+
+    def test_open_circuit_fails_fast(self):
+        clock = Clock()
+        breaker = make_breaker(clock, min_calls=1)
+        fail(breaker)
+        clock.now = 4.0
+        before = CIRCUIT_REJECTED.value("test")
+        ran = []
+        with pytest.raises(CircuitOpen) as raised:
+            with breaker.guard():
+                ran.append(True)
+        assert ran == []
+        assert raised.value.retry_after == 6.0
+        assert CIRCUIT_REJECTED.value("test") == before + 1
+
+    def test_probe_closes_the_circuit(self):
+        clock = Clock()
+        breaker = make_breaker(clock, min_calls=1)
+        fail(breaker)
+        assert not breaker.available()
+        clock.now = 10.0
+        assert breaker.retry_after() == 0
+        assert breaker.available()
+        with breaker.guard():
+            assert breaker.state == HALF_OPEN
+            # Only one probe at a time
+            assert not breaker.available()
+            with pytest.raises(CircuitOpen):
+                with breaker.guard():
+                    pass
+        assert breaker.state == CLOSED
+
+    def test_failed_probe_opens_it_again(self):
+        clock = Clock()
+        breaker = make_breaker(clock, min_calls=1)
+        fail(breaker)
+        clock.now = 10.0
+        fail(breaker)
+        assert breaker.state == OPEN
+        assert breaker.retry_after() == 10.0
+
+    def test_cancelled_probe_frees_its_slot(self):
+        clock = Clock()
+        breaker = make_breaker(clock, min_calls=1)
+        fail(breaker)
+        clock.now = 10.0
+        with pytest.raises(asyncio.CancelledError):
+            with breaker.guard():
+                raise asyncio.CancelledError()
+        assert breaker.state == HALF_OPEN
+        succeed(breaker)
+        assert breaker.state == CLOSED
+
+    def test_errors_that_are_not_failures(self):
+        breaker = make_breaker(is_failure=lambda error: not isinstance(error, ValueError))
+        for _ in range(4):
+            fail(breaker, ValueError("bad request"))
+        assert breaker.state == CLOSED
+
+
+class TestDegradedResponses:
+    """Test what the endpoints answer while a circuit is open"""
+
+    def test_resources_unavailable_while_exa_is_open(self):
+        cache = TwoTierCache(TTLCache(maxsize=10, ttl=60), None)
+        with patch("main.exa_breaker", open_breaker("exa")), patch("main.resource_cache", cache), \
+                TestClient(app) as client:
+            response = client.post("/sessions/resources", json={"session_id": test_session_id, "query": "breathing"})
+            assert response.status_code == 503
+            assert int(response.headers["Retry-After"]) > 0
+            assert "Continue the conversation" in response.json()["message"]
+
+            # A cached query is still answered
+            cache.set(normalize_query("sleep"), [])
+            response = client.post("/sessions/resources", json={"session_id": test_session_id, "query": "sleep"})
+            assert response.status_code == 200
+
+    def test_resources_unavailable_while_exa_probe_is_taken(self):
+        clock = Clock()
+        breaker = CircuitBreaker("exa", min_calls=1, open_seconds=60, clock=clock)
+        fail(breaker)
+        clock.now = 60
+        assert breaker.allow()
+        assert breaker.state == HALF_OPEN
+        cache = TwoTierCache(TTLCache(maxsize=10, ttl=60), None)
+        with patch("main.exa_breaker", breaker), patch("main.resource_cache", cache), \
+                patch.object(main.resource_queue, "submit") as submit, TestClient(app) as client:
+            response = client.post("/sessions/resources", json={"session_id": test_session_id, "query": "breathing"})
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "1"
+            submit.assert_not_called()
+
+    def test_store_reads_fail_fast_and_writes_are_buffered(self):
+        fake = FakeFirestore(failure_rate=1.0)
+        breaker = CircuitBreaker("firestore", min_calls=2, window=2, open_seconds=60)
+        with patch("main.store", FirestoreStore(fake, breaker=breaker)), TestClient(app) as client:
+            for _ in range(2):
+                assert client.get(f"/sessions/{test_session_id}/tasks").status_code == 500
+            assert breaker.state == OPEN
+
+            response = client.get(f"/sessions/{test_session_id}/tasks")
+            assert response.status_code == 503
+            assert "Retry-After" in response.headers
+            assert fake.rpc_count == 2
+
+            response = client.post("/sessions/tasks", json={"session_id": test_session_id, "task": "Walk"})
+            assert response.status_code == 200
+            assert client.get("/stats").json()["write_behind"]["pending_operations"] == 1
+            assert client.get("/stats").json()["circuits"]["store"]["state"] == OPEN
+
+    def test_writes_are_buffered_while_the_store_is_failing(self):
+        """The write that opens the circuit and the writes made while it is half-open are buffered, not lost"""
+        fake = FakeFirestore()
+        clock = Clock()
+        breaker = CircuitBreaker("firestore", min_calls=1, window=1, open_seconds=10, clock=clock)
+        with patch("main.store", FirestoreStore(fake, breaker=breaker)), TestClient(app) as client:
+            fake.failure_rate = 1.0
+            response = client.post("/sessions/tasks", json={"session_id": test_session_id, "task": "Walk"})
+            assert response.status_code == 200
+            assert breaker.state == OPEN
+
+            # The buffer's next flush is the probe, which leaves the circuit half-open while it runs
+            fake.latency = 0.5
+            fake.failure_rate = 0.0
+            clock.now = 11
+            for _ in range(200):
+                if breaker.state == HALF_OPEN:
+                    break
+                time.sleep(0.005)
+            assert breaker.state == HALF_OPEN
+            response = client.post("/sessions/tasks", json={"session_id": test_session_id, "task": "Read"})
+            assert response.status_code == 200
+
+            client.portal.call(main.write_buffer.join)
+
+        assert fake.dump(f"sessions/{test_session_id}/tasks/tasks_doc")["tasks"] == ["Walk", "Read"]
@@ -0,0 +1,123 @@
+import asyncio
+import gzip
+import io
+import json
+import resource
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from fastapi.testclient import TestClient
+
+from export import export
+from fakes import FakeFirestore
+from main import app
+from storage import FirestoreStore
+
+client = TestClient(app)
+
+
+def seed_sessions(fake, count):
+    for i in range(count):
+        base = f"sessions/session_{i:06d}"
+        fake.seed(f"{base}/summaries/summary_doc", {"summary": f"Summary {i}", "timestamp": "2024-01-15T10:30:00"})
+        fake.seed(f"{base}/tasks/tasks_doc", {"tasks": [f"Task {i}"], "timestamp": "2024-01-15T10:30:00"})
+        fake.seed(f"{base}/cognitive-distortions/distortions_doc", {"distortions": ["labeling"]})
+
+
+class CountingSink:
+    """File-like object that only counts what is written to it"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.lines = 0
+
+    def write(self, chunk):
+        self.bytes += len(chunk)
+        self.lines += chunk.count(b"\n")
+
+
+class TestExportEndpoint:
+    """Test GET /export/sessions"""
+
+    def test_every_session_is_one_line(self, fake_db):
+        seed_sessions(fake_db, 3)
+        # A session with tasks only, and no summary
+        fake_db.seed("sessions/session_tasks_only/tasks/tasks_doc", {"tasks": ["Breathe"]})
+
+        response = client.get("/export/sessions", params={"page_size": 2})
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        sessions = [json.loads(line) for line in response.text.splitlines()]
+        assert [session["session_id"] for session in sessions] == [
+            "session_000000", "session_000001", "session_000002", "session_tasks_only"
+        ]
+        assert sessions[1]["summary"]["summary"] == "Summary 1"
+        assert sessions[1]["tasks"]["tasks"] == ["Task 1"]
+        assert sessions[1]["cognitiveDistortions"]["distortions"] == ["labeling"]
+        assert sessions[3]["summary"] is None
+
+    def test_gzip(self, fake_db):
+        seed_sessions(fake_db, 10)
+
+        response = client.get("/export/sessions", params={"gzip": "true"})
+
+        assert response.headers["content-encoding"] == "gzip"
+        # httpx decodes the gzip content encoding
+        assert len(response.text.splitlines()) == 10
+
+    def test_since(self, fake_db):
+        seed_sessions(fake_db, 5)
+        cutoff = datetime.now(timezone.utc)
+        time.sleep(0.001)
+        fake_db.seed("sessions/session_000003/tasks/tasks_doc", {"tasks": ["Updated"]})
+
+        response = client.get("/export/sessions", params={"since": cutoff.isoformat()})
+
+        sessions = [json.loads(line) for line in response.text.splitlines()]
+        assert [session["session_id"] for session in sessions] == ["session_000003"]
+        assert sessions[0]["tasks"]["tasks"] == ["Updated"]
+
+    def test_invalid_since(self, fake_db):
+        response = client.get("/export/sessions", params={"since": "last tuesday"})
+
+        assert response.status_code == 400
+
+
+class TestExportScale:
+    """Exporting stays flat in memory however many sessions there are"""
+
+    def test_cli_export_is_gzip_ndjson(self):
+        fake = FakeFirestore()
+        seed_sessions(fake, 25)
+        output = io.BytesIO()
+
+        asyncio.run(export(FirestoreStore(fake), output, since=None, gzip=True, page_size=10))
+
+        lines = gzip.decompress(output.getvalue()).splitlines()
+        assert len(lines) == 25
+        assert json.loads(lines[-1])["session_id"] == "session_000024"
+
+    def test_100k_sessions_with_bounded_memory(self):
+        fake = FakeFirestore()
+        seed_sessions(fake, 100_000)
+        sink = CountingSink()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        asyncio.run(export(FirestoreStore(fake), sink, since=None, gzip=False, page_size=500))
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+        print(f"\nexport: 100000 sessions, {sink.bytes / 1e6:.1f} MB in {elapsed:.1f} s, "
+              f"traced peak {peak / 1e6:.1f} MB, peak RSS growth {rss_growth / 1e3:.1f} MB")
+        assert sink.lines == 100_000
+        # The output is tens of MB; the export holds one page of sessions and one chunk at a time
+        assert sink.bytes > 10_000_000
+        assert peak < 8_000_000
+        # Two round trips per page: one to list the sessions, one batched get
+        assert fake.rpc_count == 2 * 100_000 // 500 + 1
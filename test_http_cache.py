@@ -0,0 +1,92 @@
+
+from fastapi.testclient import TestClient
+
+from main import app
+
+client = TestClient(app)
+test_session_id = "etag_session"
+
+
+class TestConditionalGet:
+    """GET endpoints send ETags and answer a matching If-None-Match with 304"""
+
+    def test_unchanged_tasks_are_not_modified(self, fake_db):
+        fake_db.seed(f"sessions/{test_session_id}/tasks/tasks_doc", {"tasks": ["Journal daily"]})
+
+        first = client.get(f"/sessions/{test_session_id}/tasks")
+        etag = first.headers["etag"]
+        second = client.get(f"/sessions/{test_session_id}/tasks", headers={"If-None-Match": etag})
+
+        assert first.status_code == 200
+        assert first.headers["cache-control"] == "private, no-cache"
+        assert etag.startswith('"')
+        assert second.status_code == 304
+        assert second.content == b""
+        assert second.headers["etag"] == etag
+
+    def test_write_changes_the_etag(self, fake_db):
+        client.post("/sessions/tasks", json={"session_id": test_session_id, "task": "First"})
+        etag = client.get(f"/sessions/{test_session_id}/tasks").headers["etag"]
+
+        client.post("/sessions/tasks", json={"session_id": test_session_id, "task": "Second"})
+        response = client.get(f"/sessions/{test_session_id}/tasks", headers={"If-None-Match": etag})
+
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+        assert response.json()["userTasks"][0]["tasks"] == ["First", "Second"]
+
+    def test_session_endpoints_have_distinct_etags(self, fake_db):
+        """Every session endpoint validates, and no two representations share an ETag"""
+        base = f"sessions/{test_session_id}"
+        fake_db.seed(f"{base}/tasks/tasks_doc", {"tasks": ["Journal daily"]})
+        fake_db.seed(f"{base}/cognitive-distortions/distortions_doc", {"distortions": ["labeling"]})
+        fake_db.seed(f"{base}/resources/resources_doc", {"resources": [{"url": "https://example.com", "text": "x" * 10000}]})
+        fake_db.seed(f"{base}/summaries/summary_doc", {"summary": "Good progress"})
+        urls = [
+            f"/sessions/{test_session_id}/tasks",
+            f"/sessions/{test_session_id}/cognitive-distortions",
+            f"/sessions/{test_session_id}/resources",
+            f"/summaries/{test_session_id}",
+            f"/sessions/{test_session_id}/bundle",
+            f"/sessions/{test_session_id}/bundle?include=tasks",
+        ]
+
+        etags = []
+        for url in urls:
+            etag = client.get(url).headers["etag"]
+            assert client.get(url, headers={"If-None-Match": etag}).status_code == 304, url
+            etags.append(etag)
+        assert len(set(etags)) == len(urls)
+
+    def test_summaries_page_is_not_modified(self, fake_db):
+        fake_db.seed("sessions/session_1/summaries/summary_doc", {"summary": "One", "timestamp": "2024-01-15T10:30:00"})
+
+        etag = client.get("/summaries").headers["etag"]
+        unchanged = client.get("/summaries", headers={"If-None-Match": etag})
+        fake_db.seed("sessions/session_2/summaries/summary_doc", {"summary": "Two", "timestamp": "2024-01-16T10:30:00"})
+        changed = client.get("/summaries", headers={"If-None-Match": etag})
+
+        assert unchanged.status_code == 304
+        assert changed.status_code == 200
+        assert len(changed.json()["summaries"]) == 2
+
+    def test_if_none_match_lists_and_weak_tags(self, fake_db):
+        fake_db.seed(f"sessions/{test_session_id}/summaries/summary_doc", {"summary": "Good progress"})
+        etag = client.get(f"/summaries/{test_session_id}").headers["etag"]
+
+        for header in [f'"other", {etag}', f"W/{etag}", "*"]:
+            response = client.get(f"/summaries/{test_session_id}", headers={"If-None-Match": header})
+            assert response.status_code == 304, header
+        assert client.get(f"/summaries/{test_session_id}", headers={"If-None-Match": '"other"'}).status_code == 200
+
+    def test_missing_documents_have_no_etag(self, fake_db):
+        response = client.get(f"/sessions/{test_session_id}/resources")
+
+        assert response.status_code == 404
+        assert "etag" not in response.headers
+
+    def test_stats_are_not_stored(self):
+        response = client.get("/stats")
+
+        assert response.headers["cache-control"] == "no-store"
+        assert "etag" not in response.headers
@@ -0,0 +1,29 @@
+import os
+
+from benchmarks.bench_import import IMPORT_BUDGET_MS, best_of, measure_import, parse_importtime
+
+# Imported on first use, never by importing main
+LAZY_MODULES = ["firebase_admin", "google.cloud.firestore", "exa_py", "dotenv", "grpc"]
+
+
+class TestImportTime:
+    """Test that importing main is fast and has no side effects"""
+
+    def test_import_needs_no_credentials_and_prints_nothing(self):
+        modules, stdout = measure_import("main")
+        assert stdout == ""
+        imported = [name for name in LAZY_MODULES if name in modules]
+        assert imported == []
+
+    def test_import_is_within_budget(self):
+        budget_ms = float(os.getenv("IMPORT_BUDGET_MS", IMPORT_BUDGET_MS))
+        total_ms, _ = best_of(3)
+        assert total_ms < budget_ms, f"import main took {total_ms:.0f} ms, budget {budget_ms:.0f} ms"
+
+    def test_parse_importtime(self):
+        stderr = (
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       120 |        120 |   json.decoder\n"
+            "import time:        80 |        200 | json\n"
+        )
+        assert parse_importtime(stderr) == {"json.decoder": (120, 120), "json": (80, 200)}
@@ -0,0 +1,38 @@
+import asyncio
+
+from benchmarks.bench_load import build_parser, hermetic_app, run_load
+
+
+def run(*argv):
+    args = build_parser().parse_args(["--firestore-ms", "0", "--ultravox-ms", "0", "--exa-ms", "0", "--smtp-ms", "0", *argv])
+    with hermetic_app(args) as env:
+        report = asyncio.run(run_load(env["app_module"].app, sessions=10, concurrency=5, seed=args.seed))
+    return report, env
+
+
+class TestLoadHarness:
+    """Test the hermetic load test against the fakes"""
+
+    def test_voice_sessions_reach_every_fake(self):
+        report, env = run()
+
+        endpoints = report["endpoints"]
+        assert endpoints["POST /sessions/{session_id}/calls"]["requests"] == 10
+        assert endpoints["POST /sessions/summary"]["requests"] == 10
+        assert report["total"]["errors"] == 0
+        assert report["total"]["p50_ms"] <= report["total"]["p95_ms"] <= report["total"]["p99_ms"]
+        assert len(env["ultravox"].calls) == 10
+        assert env["firestore"].rpc_count > 0
+        assert env["exa"].searches
+
+    def test_injected_failures_are_reported(self):
+        report, _ = run("--ultravox-failure-rate", "1", "--firestore-failure-rate", "1")
+
+        assert report["endpoints"]["POST /sessions/{session_id}/calls"]["errors"] == 10
+        assert report["endpoints"]["POST /sessions/summary"]["errors"] == 10
+
+    def test_runs_with_the_same_seed_send_the_same_traffic(self):
+        first, _ = run("--seed", "7")
+        second, _ = run("--seed", "7")
+        requests = lambda report: {endpoint: stats["requests"] for endpoint, stats in report["endpoints"].items()}
+        assert requests(first) == requests(second)
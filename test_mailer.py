@@ -0,0 +1,309 @@
+import asyncio
+import os
+import threading
+import time
+from email.message import EmailMessage
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from main import app
+from circuit import CircuitBreaker
+from fakes import FakeSMTPServer
+from mailer import Mailer, is_permanent
+from outbox import Outbox
+
+
+def smtp_env(server):
+    return {
+        "SMTP_HOST": server.host,
+        "SMTP_PORT": str(server.port),
+        "SMTP_USE_SSL": "false",
+        "EMAIL_ADDRESS": "maggie@example.com",
+        "EMAIL_PASSWORD": "test_password",
+    }
+
+
+def make_message(to):
+    message = EmailMessage()
+    message["From"] = "maggie@example.com"
+    message["To"] = to
+    message["Subject"] = "Your Insights from Maggie"
+    message.set_content("Hey there")
+    return message
+
+
+def make_mailer(tmp_path, **kwargs):
+    kwargs.setdefault("retry_base_delay", 0.05)
+    kwargs.setdefault("poll_interval", 0.05)
+    return Mailer(Outbox(str(tmp_path / "outbox.sqlite3")), **kwargs)
+
+
+class ThreadRecordingOutbox(Outbox):
+    """An outbox that records which threads its SQLite calls ran on"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.threads = set()
+
+    def _execute(self, sql, params=()):
+        self.threads.add(threading.current_thread())
+        return super()._execute(sql, params)
+
+    def claim_due(self, limit):
+        self.threads.add(threading.current_thread())
+        return super().claim_due(limit)
+
+
+def deliver(test_mailer, messages, between=None, one_by_one=True, retries=True):
+    """Sends messages through test_mailer and returns their statuses once every retry has run"""
+    async def run():
+        await test_mailer.start()
+        email_ids = []
+        for message in messages:
+            email_ids.append(await test_mailer.submit(message))
+            if one_by_one:
+                await test_mailer.join()
+                if between:
+                    between()
+        await test_mailer.join()
+        statuses = [await test_mailer.status(email_id) for email_id in email_ids]
+        # join() doesn't wait for retries that aren't due yet
+        while retries and any(status["status"] == "queued" for status in statuses):
+            await asyncio.sleep(0.05)
+            await test_mailer.join()
+            statuses = [await test_mailer.status(email_id) for email_id in email_ids]
+        await test_mailer.stop()
+        return statuses
+
+    return asyncio.run(run())
+
+
+class TestMailer:
+    """Test email delivery through the SMTP connection pool"""
+
+    def test_email_endpoint_queues_and_delivers(self, tmp_path):
+        """POST /emails returns 202 straight away and the status shows the delivery"""
+        mailer = make_mailer(tmp_path)
+        with FakeSMTPServer() as server, patch.dict(os.environ, smtp_env(server)), \
+                patch.object(main, "mailer", mailer), TestClient(app) as client:
+            response = client.post(
+                "/emails",
+                json={
+                    "email_address": "user@example.com",
+                    "insights": {"summary": "User made progress", "tasks": ["Journal daily"], "topics": ["anxiety"]}
+                }
+            )
+            assert response.status_code == 202
+            email_id = response.json()["email_id"]
+
+            client.portal.call(mailer.join)
+            status_response = client.get(f"/emails/{email_id}")
+
+        assert status_response.status_code == 200
+        assert status_response.json()["status"] == "sent"
+        assert server.messages[0]["to"] == ["user@example.com"]
+        assert b"User made progress" in server.messages[0]["data"]
+
+    def test_unknown_email_status(self, tmp_path):
+        """GET /emails/{email_id} for an id that was never issued"""
+        with patch.object(main, "mailer", make_mailer(tmp_path)), TestClient(app) as client:
+            response = client.get("/emails/unknown")
+
+        assert response.status_code == 404
+
+    def test_connections_are_reused(self, tmp_path):
+        """Ten emails go over one authenticated connection per sending thread"""
+        with FakeSMTPServer() as server, patch.dict(os.environ, smtp_env(server)):
+            statuses = deliver(make_mailer(tmp_path), [make_message(f"user{i}@example.com") for i in range(10)])
+
+        assert [status["status"] for status in statuses] == ["sent"] * 10
+        assert len(server.messages) == 10
+        assert server.connections <= 2
+        assert server.logins == server.connections
+
+    def test_stale_connections_are_replaced(self, tmp_path):
+        """A connection the server dropped is replaced on the next send"""
+        with FakeSMTPServer() as server, patch.dict(os.environ, smtp_env(server)):
+            statuses = deliver(
+                make_mailer(tmp_path, pool_size=1),
+                [make_message("first@example.com"), make_message("second@example.com")],
+                between=server.drop_connections,
+            )
+
+        assert [status["status"] for status in statuses] == ["sent", "sent"]
+        assert server.connections == 2
+
+    def test_failed_delivery_is_reported(self, tmp_path):
+        """An unreachable SMTP server marks the email as failed once its attempts run out"""
+        with FakeSMTPServer() as server:
+            env = smtp_env(server)
+        # The server is shut down now, so nothing listens on its port
+        with patch.dict(os.environ, env):
+            statuses = deliver(make_mailer(tmp_path, max_attempts=3), [make_message("user@example.com")])
+
+        assert statuses[0]["status"] == "failed"
+        assert statuses[0]["attempts"] == 3
+        assert statuses[0]["error"]
+
+    def test_temporary_failures_are_retried(self, tmp_path):
+        """A 4xx reply is retried with backoff until the message goes through"""
+        with FakeSMTPServer() as server, patch.dict(os.environ, smtp_env(server)):
+            server.fail_next(2)
+            statuses = deliver(make_mailer(tmp_path), [make_message("user@example.com")])
+
+        assert statuses[0]["status"] == "sent"
+        assert statuses[0]["attempts"] == 3
+        assert len(server.messages) == 1
+
+    def test_permanent_failures_are_not_retried(self, tmp_path):
+        """A 5xx reply fails the message on the first attempt"""
+        with FakeSMTPServer() as server, patch.dict(os.environ, smtp_env(server)):
+            server.fail_next(1, "554 Transaction failed")
+            statuses = deliver(make_mailer(tmp_path), [make_message("user@example.com")])
+
+        assert statuses[0]["status"] == "failed"
+        assert statuses[0]["attempts"] == 1
+        assert server.messages == []
+
+    def test_messages_are_sent_in_batches(self, tmp_path):
+        """A burst of emails is sent over as few connections as there are batches"""
+        with FakeSMTPServer() as server, patch.dict(os.environ, smtp_env(server)):
+            test_mailer = make_mailer(tmp_path, pool_size=2, batch_size=50)
+            statuses = deliver(test_mailer, [make_message(f"user{i}@example.com") for i in range(100)], one_by_one=False)
+
+        assert [status["status"] for status in statuses] == ["sent"] * 100
+        assert len(server.messages) == 100
+        assert server.connections <= 2
+        assert test_mailer.stats()["outbox"] == {"sent": 100}
+
+    def test_queued_emails_survive_a_restart(self, tmp_path):
+        """Emails stored while the SMTP server was down are sent by the next Mailer on the same outbox"""
+        with FakeSMTPServer() as server:
+            env = smtp_env(server)
+        with patch.dict(os.environ, env):
+            first = make_mailer(tmp_path, retry_base_delay=60)
+            statuses = deliver(first, [make_message("user@example.com")], retries=False)
+        assert statuses[0]["status"] == "queued"
+
+        email_id = statuses[0]["email_id"]
+        with FakeSMTPServer() as server, patch.dict(os.environ, smtp_env(server)):
+            second = make_mailer(tmp_path)
+            # Make the pending retry due now instead of in a minute
+            second.outbox.mark_retry(email_id, 1, 0.0, "down")
+            deliver(second, [])
+
+        assert second.outbox.status(email_id)["status"] == "sent"
+        assert len(server.messages) == 1
+
+    def test_open_circuit_keeps_emails_queued(self, tmp_path):
+        """Once the SMTP circuit opens, the rest of the emails wait without using up attempts"""
+        with FakeSMTPServer() as server:
+            env = smtp_env(server)
+        breaker = CircuitBreaker("smtp", min_calls=2, window=2, open_seconds=60)
+        with patch.dict(os.environ, env):
+            test_mailer = make_mailer(tmp_path, retry_base_delay=60, breaker=breaker)
+            # Stored before the dispatcher starts, so they are all sent in one go
+            email_ids = [test_mailer.outbox.add(make_message(f"user{i}@example.com")) for i in range(5)]
+            deliver(test_mailer, [], retries=False)
+        statuses = [test_mailer.outbox.status(email_id) for email_id in email_ids]
+
+        assert [status["status"] for status in statuses] == ["queued"] * 5
+        assert [status["attempts"] for status in statuses] == [1, 1, 0, 0, 0]
+        assert "circuit is open" in statuses[4]["error"]
+
+    def test_probe_after_the_circuit_opened(self, tmp_path):
+        """Temporary failures open the circuit, and emails go out once a probe succeeds"""
+        breaker = CircuitBreaker(
+            "smtp", min_calls=2, window=2, open_seconds=0.2, is_failure=lambda error: not is_permanent(error)
+        )
+        with FakeSMTPServer() as server, patch.dict(os.environ, smtp_env(server)):
+            server.fail_next(2)
+            statuses = deliver(
+                make_mailer(tmp_path, breaker=breaker), [make_message(f"user{i}@example.com") for i in range(5)],
+                one_by_one=False,
+            )
+
+        assert [status["status"] for status in statuses] == ["sent"] * 5
+        assert [status["attempts"] for status in statuses] == [2, 2, 1, 1, 1]
+        assert len(server.messages) == 5
+
+    def test_outbox_calls_run_off_the_event_loop(self, tmp_path):
+        """Storing, dispatching, recording and looking up emails never touch SQLite on the loop's thread"""
+        outbox = ThreadRecordingOutbox(str(tmp_path / "outbox.sqlite3"))
+        with FakeSMTPServer() as server, patch.dict(os.environ, smtp_env(server)):
+            statuses = deliver(Mailer(outbox, poll_interval=0.05), [make_message("user@example.com")])
+
+        assert statuses[0]["status"] == "sent"
+        assert outbox.threads
+        assert threading.main_thread() not in outbox.threads
+
+    def test_finished_emails_keep_no_body(self, tmp_path):
+        """Sent and failed emails keep their status but not what they said"""
+        with FakeSMTPServer() as server, patch.dict(os.environ, smtp_env(server)):
+            server.fail_next(1, "554 Transaction failed")
+            test_mailer = make_mailer(tmp_path)
+            statuses = deliver(test_mailer, [make_message("first@example.com"), make_message("second@example.com")])
+
+        assert [status["status"] for status in statuses] == ["failed", "sent"]
+        bodies = test_mailer.outbox._execute("SELECT message FROM outbox")
+        assert bodies == [(b"",), (b"",)]
+
+    def test_finished_emails_are_purged_after_the_retention(self, tmp_path):
+        """The dispatcher deletes finished emails once they are older than the retention"""
+        with FakeSMTPServer() as server, patch.dict(os.environ, smtp_env(server)):
+            test_mailer = make_mailer(tmp_path, retention=0.0, purge_interval=0.0)
+            outbox = test_mailer.outbox
+            sent = outbox.add(make_message("sent@example.com"))
+            outbox.mark_sent(sent, 1)
+            queued = outbox.add(make_message("queued@example.com"))
+            outbox.mark_retry(queued, 1, time.time() + 60, "down")
+
+            async def run():
+                await test_mailer.start()
+                while test_mailer.purged == 0:
+                    await asyncio.sleep(0.01)
+                await test_mailer.stop()
+
+            asyncio.run(asyncio.wait_for(run(), 5))
+
+        assert outbox.status(sent) is None
+        assert outbox.status(queued)["status"] == "queued"
+        assert test_mailer.stats()["purged"] == 1
+
+    def test_submit_needs_the_mailer_started_on_the_running_loop(self, tmp_path):
+        """Nothing starts a second dispatcher, pool and executor behind the lifespan hook's back"""
+        test_mailer = make_mailer(tmp_path)
+
+        async def start():
+            await test_mailer.start()
+            return test_mailer._dispatcher
+
+        old_dispatcher = asyncio.run(start())
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(test_mailer.submit(make_message("user@example.com")))
+        assert test_mailer.outbox.counts() == {}
+
+        async def restart():
+            await test_mailer.start()
+            dispatcher = test_mailer._dispatcher
+            await test_mailer.stop()
+            return dispatcher
+
+        assert asyncio.run(restart()) is not old_dispatcher
+        assert test_mailer._dispatcher is None
+
+    def test_restarting_stops_the_old_dispatcher(self, tmp_path):
+        async def run():
+            test_mailer = make_mailer(tmp_path)
+            await test_mailer.start()
+            old_dispatcher, old_executor = test_mailer._dispatcher, test_mailer._executor
+            await test_mailer.start()
+            assert old_dispatcher.cancelled()
+            assert old_executor._shutdown
+            await test_mailer.stop()
+
+        asyncio.run(run())
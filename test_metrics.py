@@ -0,0 +1,104 @@
+import logging
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+import metrics
+from metrics import Counter, Histogram, InstrumentedRoute, Registry, timed
+
+
+def build_app():
+    app = FastAPI()
+    app.router.route_class = InstrumentedRoute
+
+    @app.get("/sessions/{session_id}/ping")
+    async def ping(session_id: str):
+        return {"session_id": session_id}
+
+    @app.get("/missing")
+    async def missing():
+        raise HTTPException(status_code=404, detail="Not found")
+
+    return app
+
+
+class TestRender:
+    """Test the text exposition format"""
+
+    def test_counter_is_rendered_with_labels(self):
+        registry = Registry()
+        counter = registry.register(Counter("things_total", "Things", ("kind",)))
+        counter.inc(("a",))
+        counter.inc(("a",), 2)
+
+        text = registry.render()
+        assert "# TYPE things_total counter" in text
+        assert 'things_total{kind="a"} 3' in text
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("latency_seconds", "Latency", ("op",), buckets=(0.1, 1.0))
+        histogram.observe(("get",), 0.05)
+        histogram.observe(("get",), 0.5)
+        histogram.observe(("get",), 5)
+
+        lines = histogram.render()
+        assert 'latency_seconds_bucket{op="get",le="0.1"} 1' in lines
+        assert 'latency_seconds_bucket{op="get",le="1"} 2' in lines
+        assert 'latency_seconds_bucket{op="get",le="+Inf"} 3' in lines
+        assert 'latency_seconds_count{op="get"} 3' in lines
+        assert 'latency_seconds_sum{op="get"} 5.55' in lines
+
+    def test_label_values_are_escaped(self):
+        counter = Counter("things_total", "Things", ("kind",))
+        counter.inc(('say "hi"',))
+        assert 'things_total{kind="say \\"hi\\""} 1' in counter.render()
+
+
+class TestTimed:
+    """Test the dependency timer"""
+
+    def test_call_is_observed(self):
+        before = metrics.DEPENDENCY_SECONDS.count("test", "observed")
+        with timed("test", "observed"):
+            pass
+        assert metrics.DEPENDENCY_SECONDS.count("test", "observed") == before + 1
+
+    def test_error_is_counted_and_raised(self):
+        before = metrics.DEPENDENCY_ERRORS.value("test", "raises")
+        with pytest.raises(ValueError):
+            with timed("test", "raises"):
+                raise ValueError("boom")
+        assert metrics.DEPENDENCY_ERRORS.value("test", "raises") == before + 1
+
+    def test_slow_call_is_logged(self, caplog):
+        metrics.set_slow_operation_threshold(0)
+        try:
+            with caplog.at_level(logging.WARNING, logger="metrics"):
+                with timed("test", "slow"):
+                    pass
+        finally:
+            metrics.set_slow_operation_threshold(1.0)
+        assert metrics.SLOW_OPERATIONS.value("test", "slow") >= 1
+        assert "Slow test slow" in caplog.text
+
+
+class TestInstrumentedRoute:
+    """Test that requests are counted per route template"""
+
+    def test_requests_are_counted_by_template(self):
+        client = TestClient(build_app())
+        labels = ("GET", "/sessions/{session_id}/ping", "200")
+        before = metrics.HTTP_REQUESTS.value(*labels)
+
+        assert client.get("/sessions/a/ping").status_code == 200
+        assert client.get("/sessions/b/ping").status_code == 200
+
+        assert metrics.HTTP_REQUESTS.value(*labels) == before + 2
+        assert metrics.HTTP_IN_PROGRESS.value("GET", "/sessions/{session_id}/ping") == 0
+
+    def test_status_of_error_responses_is_recorded(self):
+        client = TestClient(build_app())
+        before = metrics.HTTP_REQUESTS.value("GET", "/missing", "404")
+        assert client.get("/missing").status_code == 404
+        assert metrics.HTTP_REQUESTS.value("GET", "/missing", "404") == before + 1
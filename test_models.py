@@ -0,0 +1,87 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from main import app
+
+client = TestClient(app)
+test_session_id = "models_session"
+
+
+class TestRequestValidation:
+    """Tool bodies are validated against their models before any Firestore work"""
+
+    @pytest.mark.parametrize("url, body, message", [
+        ("/sessions/tasks", {"task": "Journal daily"}, "No session ID provided"),
+        ("/sessions/tasks", {"session_id": "", "task": "Journal daily"}, "No session ID provided"),
+        ("/sessions/tasks", {"session_id": test_session_id, "task": ""}, "No task provided"),
+        ("/sessions/cognitive-distortions", {"session_id": test_session_id}, "No cognitive distortions provided"),
+        ("/sessions/summary", {"conversationSummary": "Good progress"}, "No session ID provided"),
+        ("/sessions/resources", {"session_id": test_session_id}, "No query provided"),
+        ("/waitlist", {}, "No email provided"),
+    ])
+    def test_missing_fields(self, fake_db, url, body, message):
+        response = client.post(url, json=body)
+
+        assert response.status_code == 400
+        assert response.json() == {"message": message}
+        assert fake_db.rpc_count == 0
+
+    def test_wrong_types(self, fake_db):
+        """Values aren't coerced: a number isn't a task, and a string isn't a list of distortions"""
+        task = client.post("/sessions/tasks", json={"session_id": test_session_id, "task": 42})
+        distortions = client.post(
+            "/sessions/cognitive-distortions",
+            json={"session_id": test_session_id, "cognitiveDistortions": "labeling"}
+        )
+
+        assert task.status_code == 400
+        assert task.json()["message"].startswith("Invalid task:")
+        assert distortions.status_code == 400
+        assert distortions.json()["message"].startswith("Invalid cognitiveDistortions:")
+        assert fake_db.rpc_count == 0
+
+    def test_body_that_is_not_an_object(self, fake_db):
+        response = client.post("/sessions/tasks", json=["Journal daily"])
+
+        assert response.status_code == 400
+        assert fake_db.rpc_count == 0
+
+    def test_summary_parts_are_optional(self, fake_db):
+        response = client.post("/sessions/summary", json={"session_id": test_session_id})
+
+        assert response.status_code == 200
+        stored = fake_db.dump(f"sessions/{test_session_id}/summaries/summary_doc")
+        assert stored["cognitiveDistortions"] == []
+
+
+class TestResponseModels:
+    """Responses are shaped by their models and encoded with orjson"""
+
+    def test_tool_result(self, fake_db):
+        response = client.post("/sessions/tasks", json={"session_id": test_session_id, "task": "Journal daily"})
+
+        assert response.headers["content-type"] == "application/json"
+        assert response.json() == {
+            "message": "User task saved successfully. A task already saved for this session is kept once. Continue the conversation with the user.",
+            "status": "success",
+            "status_code": 200,
+            "task_id": "tasks_doc",
+        }
+
+    def test_bundle_has_only_the_sections_asked_for(self, fake_db):
+        fake_db.seed(f"sessions/{test_session_id}/tasks/tasks_doc", {"tasks": ["Journal daily"]})
+
+        response = client.get(f"/sessions/{test_session_id}/bundle", params={"include": "tasks,summary"})
+
+        assert response.json() == {
+            "session_id": test_session_id,
+            "userTasks": [{"id": "tasks_doc", "session_id": test_session_id, "tasks": ["Journal daily"]}],
+            "summary": None,
+        }
+
+    def test_openapi_documents_the_models(self):
+        schema = client.get("/openapi.json").json()
+        tasks = schema["paths"]["/sessions/tasks"]["post"]
+
+        assert tasks["requestBody"]["content"]["application/json"]["schema"]["$ref"].endswith("/TaskRequest")
+        assert tasks["responses"]["200"]["content"]["application/json"]["schema"]["$ref"].endswith("/TaskSaved")
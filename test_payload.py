@@ -0,0 +1,18 @@
+import json
+
+from payload import compile_payload_template, get_payload, get_payload_json
+
+
+class TestPayloadTemplate:
+    """Test the precompiled call payload"""
+
+    def test_payload_json_matches_payload(self):
+        """The spliced template decodes to the same payload get_payload builds"""
+        compile_payload_template()
+        assert json.loads(get_payload_json("session_123")) == get_payload("session_123")
+
+    def test_session_id_is_json_escaped(self):
+        """Session IDs with quotes, backslashes and non-ASCII characters stay valid JSON"""
+        session_id = 'odd "session" \\ id ñ'
+        payload = json.loads(get_payload_json(session_id))
+        assert f"Current Session ID: {session_id}" in payload["systemPrompt"]
@@ -0,0 +1,159 @@
+import asyncio
+
+import pytest
+
+from resource_queue import QueueFull, ResourceFetchQueue
+
+
+class Recorder:
+    """Search and store callbacks that record what the queue asked for"""
+
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.searches = []
+        self.stored = {}
+        self.running = 0
+        self.max_running = 0
+
+    async def search(self, query):
+        self.searches.append(query)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delay)
+        self.running -= 1
+        return [f"resource for {query}"]
+
+    async def store(self, session_id, result):
+        self.stored[session_id] = result
+
+
+def make_queue(recorder, concurrency=2, max_queue=100):
+    return ResourceFetchQueue(
+        search=recorder.search,
+        store=recorder.store,
+        key=lambda query: query.lower(),
+        concurrency=concurrency,
+        max_queue=max_queue,
+    )
+
+
+class TestResourceFetchQueue:
+    """Test the bounded resource fetch queue"""
+
+    def test_concurrency_is_capped(self):
+        recorder = Recorder()
+
+        async def run():
+            queue = make_queue(recorder, concurrency=3)
+            await queue.start()
+            for i in range(20):
+                queue.submit(f"query {i}", f"session_{i}")
+            await queue.join()
+            await queue.stop()
+
+        asyncio.run(run())
+        assert recorder.max_running == 3
+        assert len(recorder.stored) == 20
+
+    def test_identical_queries_share_one_search(self):
+        recorder = Recorder()
+
+        async def run():
+            queue = make_queue(recorder)
+            await queue.start()
+            for i in range(10):
+                queue.submit("Breathing exercises", f"session_{i}")
+            queue.submit("breathing EXERCISES", "session_10")
+            await queue.join()
+            stats = queue.stats()
+            await queue.stop()
+            return stats
+
+        stats = asyncio.run(run())
+        assert recorder.searches == ["Breathing exercises"]
+        assert len(recorder.stored) == 11
+        assert all(result == ["resource for Breathing exercises"] for result in recorder.stored.values())
+        assert stats["deduplicated"] == 10
+        assert stats["completed"] == 1
+
+    def test_full_queue_rejects_new_queries(self):
+        recorder = Recorder(delay=0.05)
+
+        async def run():
+            queue = make_queue(recorder, concurrency=1, max_queue=2)
+            await queue.start()
+            queue.submit("query 0", "session_0")
+            # Let the worker pick up the first query so the next two fill the queue
+            await asyncio.sleep(0)
+            queue.submit("query 1", "session_1")
+            queue.submit("query 2", "session_2")
+            with pytest.raises(QueueFull):
+                queue.submit("query 3", "session_3")
+            # Joining a pending query doesn't take a queue slot
+            queue.submit("query 2", "session_4")
+            stats = queue.stats()
+            await queue.join()
+            await queue.stop()
+            return stats
+
+        stats = asyncio.run(run())
+        assert stats["queue_depth"] == 2
+        assert stats["in_flight"] == 1
+        assert stats["rejected"] == 1
+        assert set(recorder.stored) == {"session_0", "session_1", "session_2", "session_4"}
+
+    def test_failed_search_is_counted(self):
+        async def failing_search(query):
+            raise RuntimeError("Exa is down")
+
+        recorder = Recorder()
+
+        async def run():
+            queue = ResourceFetchQueue(failing_search, recorder.store, str.lower, concurrency=1, max_queue=10)
+            await queue.start()
+            queue.submit("query", "session_0")
+            await queue.join()
+            stats = queue.stats()
+            await queue.stop()
+            return stats
+
+        stats = asyncio.run(run())
+        assert stats["failed"] == 1
+        assert recorder.stored == {}
+
+    def test_submit_needs_the_queue_started_on_the_running_loop(self):
+        queue = make_queue(Recorder())
+
+        async def start():
+            await queue.start()
+            return list(queue._workers)
+
+        old_workers = asyncio.run(start())
+
+        async def submit():
+            queue.submit("query", "session_0")
+
+        # Nothing starts workers behind the lifespan hook's back
+        with pytest.raises(RuntimeError):
+            asyncio.run(submit())
+
+        async def restart():
+            await queue.start()
+            workers = list(queue._workers)
+            await queue.stop()
+            return workers
+
+        assert asyncio.run(restart()) != old_workers
+        assert queue._workers == []
+
+    def test_restarting_stops_the_old_workers(self):
+        async def run():
+            queue = make_queue(Recorder())
+            await queue.start()
+            old_workers = list(queue._workers)
+            await queue.start()
+            assert all(worker.cancelled() for worker in old_workers)
+            assert len(queue._workers) == queue.concurrency
+            await queue.stop()
+
+        asyncio.run(run())
@@ -0,0 +1,164 @@
+import asyncio
+import os
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+import pytest
+
+from cache import TTLCache
+from sqlite_store import SQLiteStore
+from storage import COGNITIVE_DISTORTIONS, SUMMARY, TASKS, SessionStore, SessionWrite, create_store
+
+test_session_id = "sqlite_session"
+
+
+@pytest.fixture(params=["file", "memory"])
+def store(request, tmp_path):
+    path = str(tmp_path / "maggie.sqlite3") if request.param == "file" else ":memory:"
+    store = SQLiteStore(path)
+    yield store
+    store.close()
+
+
+class TestSQLiteStore:
+    """Test the SQLite session store"""
+
+    def test_documents_round_trip_with_versions(self, store):
+        async def scenario():
+            await store.set_session_document(test_session_id, TASKS, {"tasks": ["Walk"]})
+            first = await store.get_versioned_session_documents(test_session_id, [TASKS, SUMMARY])
+            await store.set_session_document(test_session_id, TASKS, {"tasks": ["Run"]})
+            second = await store.get_versioned_session_documents(test_session_id, [TASKS])
+            return first, second
+
+        first, second = asyncio.run(scenario())
+        assert first[TASKS][0] == {"tasks": ["Walk"]}
+        assert first[SUMMARY] == (None, None)
+        assert second[TASKS][0] == {"tasks": ["Run"]}
+        assert second[TASKS][1] > first[TASKS][1]
+
+    def test_concurrent_appends_all_land(self, store):
+        async def scenario():
+            await asyncio.gather(*(
+                store.append_to_session_array(test_session_id, TASKS, "tasks", [f"Task {i}"]) for i in range(50)
+            ))
+            return await store.get_session_document(test_session_id, TASKS)
+
+        document = asyncio.run(scenario())
+        assert sorted(document["tasks"]) == sorted(f"Task {i}" for i in range(50))
+        assert "timestamp" in document
+
+    def test_appending_existing_values_adds_nothing(self, store):
+        async def scenario():
+            await store.append_to_session_array(test_session_id, COGNITIVE_DISTORTIONS, "distortions", ["Labeling"])
+            await store.append_to_session_array(test_session_id, COGNITIVE_DISTORTIONS, "distortions", ["Labeling", "Mind reading"])
+            return await store.get_session_document(test_session_id, COGNITIVE_DISTORTIONS)
+
+        assert asyncio.run(scenario())["distortions"] == ["Labeling", "Mind reading"]
+
+    def test_committed_writes_are_applied(self, store):
+        tasks = SessionWrite(test_session_id, TASKS)
+        tasks.append("tasks", ["Walk"], "2024-01-01T00:00:00")
+        tasks.append("tasks", ["Run"], "2024-01-01T00:00:01")
+        summary = SessionWrite(test_session_id, SUMMARY)
+        summary.set({"summary": "Good session", "timestamp": "2024-01-01T00:00:02"})
+
+        async def scenario():
+            await store.append_to_session_array(test_session_id, TASKS, "tasks", ["Breathe"])
+            await store.commit_session_writes([tasks, summary])
+            return await store.get_session_documents(test_session_id, [TASKS, SUMMARY])
+
+        documents = asyncio.run(scenario())
+        assert documents[TASKS]["tasks"] == ["Breathe", "Walk", "Run"]
+        assert documents[SUMMARY]["summary"] == "Good session"
+
+    def test_summaries_are_keyset_paginated(self, store):
+        async def scenario():
+            for i in range(5):
+                await store.set_session_document(f"session_{i}", SUMMARY, {"summary": str(i), "timestamp": f"2024-01-0{i + 1}"})
+            await store.set_session_document("undated", SUMMARY, {"summary": "No timestamp"})
+            first = await store.list_summaries(2)
+            second = await store.list_summaries(10, (first[-1]["timestamp"], first[-1]["session_id"]))
+            return first, second
+
+        first, second = asyncio.run(scenario())
+        assert [summary["session_id"] for summary in first] == ["session_4", "session_3"]
+        assert [summary["session_id"] for summary in second] == ["session_2", "session_1", "session_0"]
+        assert first[0]["id"] == "session_4"
+
+    def test_export_pages_through_every_session(self, store):
+        async def scenario():
+            for i in range(7):
+                await store.append_to_session_array(f"session_{i}", TASKS, "tasks", [f"Task {i}"])
+            return [session async for session in store.export_sessions(page_size=3)]
+
+        sessions = asyncio.run(scenario())
+        assert [session["session_id"] for session in sessions] == [f"session_{i}" for i in range(7)]
+        assert sessions[0]["tasks"]["tasks"] == ["Task 0"]
+        assert sessions[0]["summary"] is None
+
+    def test_export_since_skips_older_sessions(self, store):
+        async def scenario():
+            await store.append_to_session_array("old", TASKS, "tasks", ["Old"])
+            await asyncio.sleep(0.01)
+            since = datetime.now(timezone.utc)
+            await store.append_to_session_array("new", TASKS, "tasks", ["New"])
+            return [session async for session in store.export_sessions(since=since)]
+
+        assert [session["session_id"] for session in asyncio.run(scenario())] == ["new"]
+
+    def test_writes_invalidate_the_cache(self, tmp_path):
+        store = SQLiteStore(str(tmp_path / "maggie.sqlite3"), cache=TTLCache(maxsize=10, ttl=60))
+
+        async def scenario():
+            await store.set_session_document(test_session_id, TASKS, {"tasks": ["Walk"]})
+            await store.get_session_document(test_session_id, TASKS)
+            await store.append_to_session_array(test_session_id, TASKS, "tasks", ["Run"])
+            return await store.get_session_document(test_session_id, TASKS)
+
+        assert asyncio.run(scenario())["tasks"] == ["Walk", "Run"]
+        store.close()
+
+    def test_data_survives_reopening(self, tmp_path):
+        path = str(tmp_path / "maggie.sqlite3")
+        store = SQLiteStore(path)
+        asyncio.run(store.add_to_waitlist("someone@example.com"))
+        asyncio.run(store.set_session_document(test_session_id, TASKS, {"tasks": ["Walk"]}))
+        store.close()
+
+        reopened = SQLiteStore(path)
+        assert asyncio.run(reopened.get_session_document(test_session_id, TASKS)) == {"tasks": ["Walk"]}
+        reopened.close()
+
+
+class TestCreateStore:
+    """Test picking the backend from the environment"""
+
+    def test_sqlite_backend(self, tmp_path):
+        path = str(tmp_path / "data" / "maggie.sqlite3")
+        with patch.dict(os.environ, {"STORAGE_BACKEND": "sqlite", "SQLITE_PATH": path}):
+            store = create_store()
+        assert isinstance(store, SQLiteStore)
+        assert store.path == path
+
+    def test_memory_backend(self):
+        with patch.dict(os.environ, {"STORAGE_BACKEND": "memory"}):
+            store = create_store()
+        assert store.path == ":memory:"
+
+    def test_unknown_backend(self):
+        with patch.dict(os.environ, {"STORAGE_BACKEND": "postgres"}):
+            with pytest.raises(ValueError):
+                create_store()
+
+
+class TestSessionStoreInterface:
+    """Test that backends implement the whole interface"""
+
+    def test_incomplete_backend_cannot_be_created(self):
+        class WriteOnlyStore(SessionStore):
+            async def _set_session_document(self, session_id, kind, data):
+                pass
+
+        with pytest.raises(TypeError, match="_fetch_session_documents"):
+            WriteOnlyStore()
@@ -0,0 +1,151 @@
+import asyncio
+import statistics
+import time
+from unittest.mock import patch
+
+import httpx
+from fastapi.testclient import TestClient
+
+from cache import TTLCache
+from main import app
+from fakes import FakeDocumentReference, FakeFirestore
+from storage import FirestoreStore, TASKS, COGNITIVE_DISTORTIONS
+
+test_session_id = "stress_session"
+
+
+async def fire_parallel(requests):
+    """Sends every (url, json) request at once and returns the sorted latencies"""
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        async def send(url, body):
+            started = time.perf_counter()
+            response = await client.post(url, json=body)
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.text
+
+        await asyncio.gather(*(send(url, body) for url, body in requests))
+    return sorted(latencies)
+
+
+def report(name, latencies):
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"\n{name}: {len(latencies)} appends, p50 {p50:.1f} ms, p99 {p99:.1f} ms")
+
+
+class TestAtomicAppends:
+    """Concurrent appends to one session must all land"""
+
+    def test_parallel_task_appends(self):
+        """Fire 500 parallel POST /sessions/tasks at one session"""
+        fake = FakeFirestore(latency=0.002)
+        requests = [
+            ("/sessions/tasks", {"session_id": test_session_id, "task": f"Task {i}"})
+            for i in range(500)
+        ]
+
+        with patch('main.store', FirestoreStore(fake)):
+            latencies = asyncio.run(fire_parallel(requests))
+
+        report("tasks", latencies)
+        stored = fake.dump(f"sessions/{test_session_id}/{TASKS[0]}/{TASKS[1]}")
+        assert sorted(stored["tasks"]) == sorted(f"Task {i}" for i in range(500))
+        # One write per append, no read beforehand
+        assert fake.rpc_count == 500
+
+    def test_parallel_distortion_appends(self):
+        """Fire 500 parallel POST /sessions/cognitive-distortions at one session"""
+        fake = FakeFirestore(latency=0.002)
+        requests = [
+            ("/sessions/cognitive-distortions", {"session_id": test_session_id, "cognitiveDistortions": [f"Distortion {i}"]})
+            for i in range(500)
+        ]
+
+        with patch('main.store', FirestoreStore(fake)):
+            latencies = asyncio.run(fire_parallel(requests))
+
+        report("cognitive distortions", latencies)
+        path = f"sessions/{test_session_id}/{COGNITIVE_DISTORTIONS[0]}/{COGNITIVE_DISTORTIONS[1]}"
+        assert len(fake.dump(path)["distortions"]) == 500
+        assert fake.rpc_count == 500
+
+
+class TestSessionCache:
+    """Per-session GETs are served from the cache, and writes invalidate it"""
+
+    def make_store(self, fake, maxsize=100):
+        return FirestoreStore(fake, cache=TTLCache(maxsize=maxsize, ttl=60))
+
+    def test_repeated_reads_hit_the_cache(self):
+        fake = FakeFirestore()
+        fake.seed(f"sessions/{test_session_id}/{TASKS[0]}/{TASKS[1]}", {"tasks": ["Journal daily"]})
+        store = self.make_store(fake)
+
+        with patch("main.store", store), TestClient(app) as client:
+            responses = [client.get(f"/sessions/{test_session_id}/tasks") for _ in range(10)]
+
+        assert all(response.json()["userTasks"][0]["tasks"] == ["Journal daily"] for response in responses)
+        assert fake.rpc_count == 1
+        stats = store.cache_stats()
+        assert stats["hits"] == 9
+        assert stats["hit_ratio"] == 0.9
+        assert stats["approximate_bytes"] > 0
+
+    def test_reads_after_writes_are_fresh(self):
+        """Every GET right after a POST to the same session sees that POST"""
+        store = self.make_store(FakeFirestore())
+
+        with patch("main.store", store), TestClient(app) as client:
+            for i in range(5):
+                client.post("/sessions/tasks", json={"session_id": test_session_id, "task": f"Task {i}"})
+                tasks = client.get(f"/sessions/{test_session_id}/tasks").json()["userTasks"][0]["tasks"]
+                assert tasks == [f"Task {j}" for j in range(i + 1)]
+
+                client.post(
+                    "/sessions/cognitive-distortions",
+                    json={"session_id": test_session_id, "cognitiveDistortions": [f"Distortion {i}"]}
+                )
+                bundle = client.get(f"/sessions/{test_session_id}/bundle").json()
+                assert bundle["cognitiveDistortions"][0]["distortions"] == [f"Distortion {j}" for j in range(i + 1)]
+                assert bundle["userTasks"][0]["tasks"] == tasks
+
+                client.post("/sessions/summary", json={"session_id": test_session_id, "conversationSummary": f"Summary {i}"})
+                assert client.get(f"/summaries/{test_session_id}").json()["summary"] == f"Summary {i}"
+
+    def test_read_overlapping_a_write_is_not_cached(self):
+        """A read that fetched the document before a write landed doesn't put the old version in the cache"""
+        fake = FakeFirestore()
+        path = f"sessions/{test_session_id}/{TASKS[0]}/{TASKS[1]}"
+        fake.seed(path, {"tasks": ["Old"]})
+        store = self.make_store(fake)
+        original_get = FakeDocumentReference.get
+
+        async def slow_get(reference):
+            snapshot = await original_get(reference)
+            await asyncio.sleep(0.05)
+            return snapshot
+
+        async def run():
+            with patch.object(FakeDocumentReference, "get", slow_get):
+                read = asyncio.create_task(store.get_session_document(test_session_id, TASKS))
+                await asyncio.sleep(0.01)
+                await store.set_session_document(test_session_id, TASKS, {"tasks": ["New"]})
+                assert (await read)["tasks"] == ["Old"]
+            return await store.get_session_document(test_session_id, TASKS)
+
+        assert asyncio.run(run())["tasks"] == ["New"]
+
+    def test_handlers_cannot_modify_cached_documents(self):
+        fake = FakeFirestore()
+        fake.seed(f"sessions/{test_session_id}/{TASKS[0]}/{TASKS[1]}", {"tasks": ["Journal daily"]})
+        store = self.make_store(fake)
+
+        async def run():
+            first = await store.get_session_document(test_session_id, TASKS)
+            first["tasks"].append("Mutated")
+            first["id"] = "mutated"
+            return await store.get_session_document(test_session_id, TASKS)
+
+        assert asyncio.run(run()) == {"tasks": ["Journal daily"]}
@@ -0,0 +1,148 @@
+import json
+import logging
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import tracing
+from metrics import InstrumentedRoute, timed
+from tracing import BatchExporter, FileExporter, OTLPExporter, Trace, TracingMiddleware, span, start_trace
+
+
+def build_app():
+    app = FastAPI()
+    app.router.route_class = InstrumentedRoute
+    app.add_middleware(TracingMiddleware, timing_allow_origins=["https://front.test"])
+
+    @app.get("/sessions/{session_id}/ping")
+    async def ping(session_id: str):
+        with span("payload"):
+            pass
+        with timed("firestore", "get"):
+            pass
+        logging.getLogger("test_tracing").info("handled")
+        return {"trace_id": tracing.current_trace_id()}
+
+    return app
+
+
+class TestSpans:
+    """Test spans and traces outside of a request"""
+
+    def test_span_outside_a_trace_does_nothing(self):
+        with span("payload"):
+            pass
+        assert tracing.current_trace() is None
+
+    def test_nested_spans_record_their_parent(self):
+        with start_trace("job") as root:
+            with span("outer") as outer:
+                with span("inner"):
+                    pass
+            trace = tracing.current_trace()
+
+        spans = {record.name: record for record in trace.spans}
+        assert spans["inner"].parent_id == spans["outer"].span_id
+        assert spans["outer"].parent_id == root.span_id
+        assert outer.record is spans["outer"]
+
+    def test_failed_span_records_the_exception(self):
+        with start_trace("job"):
+            try:
+                with span("payload"):
+                    raise ValueError("boom")
+            except ValueError:
+                pass
+            trace = tracing.current_trace()
+        assert trace.spans[0].error == "ValueError"
+
+    def test_traceparent_is_continued(self):
+        trace = Trace.from_traceparent("00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01")
+        assert trace.trace_id == "0af7651916cd43dd8448eb211c80319c"
+        assert trace.parent_id == "b7ad6b7169203331"
+
+    def test_invalid_traceparent_starts_a_new_trace(self):
+        trace = Trace.from_traceparent("00-nothex-b7ad6b7169203331-01")
+        assert len(trace.trace_id) == 32
+        assert trace.parent_id is None
+
+    def test_server_timing_sums_spans_per_name(self):
+        with start_trace("job"):
+            for _ in range(2):
+                with span("firestore.get"):
+                    pass
+            trace = tracing.current_trace()
+        header = trace.server_timing(0.0123)
+        assert header.count("firestore.get;dur=") == 1
+        assert "total;dur=12.3" in header
+        assert f'trace;desc="{trace.trace_id}"' in header
+
+
+class TestMiddleware:
+    """Test tracing of HTTP requests"""
+
+    def test_response_has_server_timing(self):
+        client = TestClient(build_app())
+        response = client.get("/sessions/abc/ping", headers={"Origin": "https://front.test"})
+
+        assert response.status_code == 200
+        header = response.headers["server-timing"]
+        assert "payload;dur=" in header
+        assert "firestore.get;dur=" in header
+        assert f'trace;desc="{response.json()["trace_id"]}"' in header
+        assert response.headers["timing-allow-origin"] == "https://front.test"
+
+    def test_timing_is_not_allowed_for_other_origins(self):
+        client = TestClient(build_app())
+        response = client.get("/sessions/abc/ping", headers={"Origin": "https://other.test"})
+        assert "timing-allow-origin" not in response.headers
+
+    def test_incoming_trace_is_continued(self):
+        client = TestClient(build_app())
+        response = client.get(
+            "/sessions/abc/ping",
+            headers={"traceparent": "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"},
+        )
+        assert response.json()["trace_id"] == "0af7651916cd43dd8448eb211c80319c"
+
+    def test_logs_carry_the_trace_id(self, caplog):
+        tracing.install_log_record_factory()
+        client = TestClient(build_app())
+        with caplog.at_level(logging.INFO, logger="test_tracing"):
+            response = client.get("/sessions/abc/ping")
+        record = next(record for record in caplog.records if record.getMessage() == "handled")
+        assert record.trace_id == response.json()["trace_id"]
+
+    def test_finished_trace_is_exported_with_the_route_template(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        exporter = BatchExporter(FileExporter(str(path)), interval=0.01)
+        tracing.set_exporter(exporter)
+        try:
+            TestClient(build_app()).get("/sessions/abc/ping")
+        finally:
+            tracing.set_exporter(None)
+            exporter.close()
+
+        spans = [json.loads(line) for line in path.read_text().splitlines()]
+        names = {record["name"] for record in spans}
+        assert {"payload", "firestore.get", "GET /sessions/{session_id}/ping"} <= names
+        assert len({record["trace_id"] for record in spans}) == 1
+
+
+class TestOTLPExporter:
+    """Test the OTLP/HTTP JSON encoding"""
+
+    def test_payload(self):
+        with start_trace("job"):
+            with span("payload", session_id="abc"):
+                pass
+            trace = tracing.current_trace()
+
+        payload = OTLPExporter("http://collector.test/v1/traces").payload([trace])
+        spans = payload["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        child = next(record for record in spans if record["name"] == "payload")
+        root = next(record for record in spans if record["name"] == "job")
+        assert child["traceId"] == trace.trace_id
+        assert child["parentSpanId"] == root["spanId"]
+        assert child["attributes"] == [{"key": "session_id", "value": {"stringValue": "abc"}}]
+        assert int(child["endTimeUnixNano"]) >= int(child["startTimeUnixNano"])
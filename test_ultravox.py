@@ -0,0 +1,177 @@
+import asyncio
+import os
+import time
+from unittest.mock import patch
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import ultravox
+from benchmarks.common import percentile
+from main import app
+from fakes import FakeUltravoxServer
+from metrics import DEPENDENCY_ATTEMPTS
+
+test_session_id = "test_session_123"
+
+
+class TestUltravoxClient:
+    """Test the shared Ultravox HTTP client"""
+
+    def test_calls_reuse_pooled_connections(self):
+        """1,000 call creations should share the lifespan client's connections"""
+        with FakeUltravoxServer() as server:
+            env = {"ULTRAVOX_API_KEY": "test_key", "ULTRAVOX_API_URL": server.url}
+            with patch.dict(os.environ, env), TestClient(app) as client:
+                for _ in range(1000):
+                    response = client.post(f"/sessions/{test_session_id}/calls")
+                    assert response.status_code == 200
+                    assert response.json()["joinUrl"].startswith("wss://fake.ultravox/calls/")
+
+        assert len(server.calls) == 1000
+        assert server.calls[0][0] == "/api/calls"
+        assert server.connections == 1
+
+    def test_client_configuration_from_environment(self):
+        """Pool limits, timeouts and the base URL come from the environment"""
+        env = {
+            "ULTRAVOX_API_URL": "http://ultravox.test",
+            "ULTRAVOX_MAX_CONNECTIONS": "7",
+            "ULTRAVOX_CONNECT_TIMEOUT": "1.5",
+            "ULTRAVOX_READ_TIMEOUT": "12",
+        }
+        with patch.dict(os.environ, env):
+            client = ultravox.create_client()
+
+        assert str(client.base_url) == "http://ultravox.test"
+        assert client.timeout.connect == 1.5
+        assert client.timeout.read == 12
+        assert client._transport._pool._max_connections == 7
+
+
+def create_calls(url: str, creator: ultravox.CallCreator, count: int) -> list:
+    """
+    Creates count calls one after the other and returns their responses and latencies
+    """
+    async def scenario():
+        results = []
+        async with httpx.AsyncClient(base_url=url) as client:
+            for _ in range(count):
+                started = time.perf_counter()
+                response = await creator.create(client, b"{}", "test_key")
+                results.append((response, time.perf_counter() - started))
+        return results
+
+    return asyncio.run(scenario())
+
+
+def create_with_transport(handler, creator):
+    """Creates one call through a mock transport, returning the response and the number of requests"""
+    calls = []
+
+    def count(request):
+        calls.append(request)
+        return handler(request)
+
+    async def scenario():
+        async with httpx.AsyncClient(base_url="http://ultravox.test", transport=httpx.MockTransport(count)) as client:
+            return await creator.create(client, b"{}", "test_key")
+
+    return asyncio.run(scenario()), len(calls)
+
+
+class TestCallCreator:
+    """Test the deadline, retries and hedging of call creation"""
+
+    def test_retries_retryable_statuses(self):
+        before = DEPENDENCY_ATTEMPTS.value("ultravox", "create_call", "retry", "503")
+        with FakeUltravoxServer(failure_rate=1.0) as server:
+            [(response, _)] = create_calls(server.url, ultravox.CallCreator(backoff=0.001, seed=1), 1)
+
+        assert response.status_code == 503
+        assert len(server.calls) == 3
+        assert DEPENDENCY_ATTEMPTS.value("ultravox", "create_call", "retry", "503") == before + 2
+
+    def test_retries_errors_raised_before_sending(self):
+        errors = [httpx.ConnectError("refused"), httpx.ConnectTimeout("timed out")]
+
+        def handler(request):
+            if errors:
+                raise errors.pop(0)
+            return httpx.Response(201, json={"joinUrl": "wss://example.com"})
+
+        response, calls = create_with_transport(handler, ultravox.CallCreator(backoff=0.001, seed=1))
+        assert response.status_code == 201
+        assert calls == 3
+
+    @pytest.mark.parametrize("error", [httpx.ReadTimeout, httpx.WriteError, httpx.RemoteProtocolError])
+    def test_errors_after_sending_are_not_retried(self, error):
+        """Ultravox may have created the call, so it isn't asked again"""
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            raise error("lost the response")
+
+        with pytest.raises(error):
+            create_with_transport(handler, ultravox.CallCreator(backoff=0.001, seed=1))
+        assert len(calls) == 1
+
+    def test_creator_configuration_from_environment(self):
+        env = {"ULTRAVOX_MAX_BACKOFF": "2.5", "ULTRAVOX_HEDGE_DELAY": "0.2", "ULTRAVOX_HEDGE": "true"}
+        with patch.dict(os.environ, env):
+            creator = ultravox.CallCreator.from_env()
+
+        assert creator.max_backoff == 2.5
+        assert creator.hedge_delay == 0.2
+        assert creator.current_hedge_delay() == 0.2
+
+    def test_retries_are_capped_by_the_budget(self):
+        budget = ultravox.RetryBudget(ratio=0.0, min_per_second=0.0, max_tokens=1.0)
+        creator = ultravox.CallCreator(backoff=0.001, budget=budget, seed=1)
+        with FakeUltravoxServer(failure_rate=1.0) as server:
+            create_calls(server.url, creator, 3)
+
+        # One retry for the first call, then none
+        assert len(server.calls) == 4
+
+    def test_deadline(self):
+        creator = ultravox.CallCreator(deadline=0.1)
+        with FakeUltravoxServer(latency=0.5) as server:
+            with pytest.raises(ultravox.DeadlineExceeded):
+                create_calls(server.url, creator, 1)
+
+    def test_endpoint_answers_504_after_the_deadline(self):
+        with FakeUltravoxServer(latency=0.5) as server:
+            env = {"ULTRAVOX_API_KEY": "test_key", "ULTRAVOX_API_URL": server.url}
+            with patch.dict(os.environ, env), patch("main.call_creator", ultravox.CallCreator(deadline=0.1)), \
+                    TestClient(app) as client:
+                response = client.post(f"/sessions/{test_session_id}/calls")
+
+        assert response.status_code == 504
+
+    def test_hedging_cuts_the_tail(self):
+        """Every 20th call takes 300 ms: hedging races it with a fast one"""
+        def p99(hedge: bool) -> float:
+            creator = ultravox.CallCreator(hedge=hedge, hedge_delay=0.03, min_hedge_delay=0.03)
+            with FakeUltravoxServer(latency=0.005, tail_latency=0.3, tail_every=20) as server:
+                results = create_calls(server.url, creator, 100)
+            assert all(response.status_code == 201 for response, _ in results)
+            return percentile(sorted(latency for _, latency in results), 99)
+
+        unhedged, hedged = p99(False), p99(True)
+        assert unhedged >= 0.3
+        assert hedged < 0.15
+
+    def test_budget_refills_over_time(self):
+        now = [0.0]
+        budget = ultravox.RetryBudget(ratio=0.5, min_per_second=1.0, max_tokens=2.0, clock=lambda: now[0])
+        assert budget.try_withdraw() and budget.try_withdraw()
+        assert not budget.try_withdraw()
+        budget.deposit()
+        budget.deposit()
+        assert budget.try_withdraw()
+        now[0] = 1.0
+        assert budget.try_withdraw()
+        assert not budget.try_withdraw()
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import time
+from unittest.mock import patch
+
+import httpx
+from fastapi.testclient import TestClient
+
+import ultravox
+from fakes import FakeFirestore, FakeUltravoxServer
+from main import app
+from storage import FirestoreStore
+from warmup import WarmUp
+
+
+def wait_until_ready(client: TestClient, timeout: float = 5.0) -> httpx.Response:
+    deadline = time.monotonic() + timeout
+    response = client.get("/ready")
+    while response.status_code == 503 and time.monotonic() < deadline:
+        time.sleep(0.01)
+        response = client.get("/ready")
+    return response
+
+
+class TestWarmUp:
+    """Test running the warm-up steps"""
+
+    def test_ready_once_steps_finish(self):
+        ran = []
+
+        async def step():
+            await asyncio.sleep(0.01)
+            ran.append("step")
+
+        async def scenario():
+            warmup = WarmUp()
+            warmup.start({"step": step})
+            before = warmup.ready
+            await warmup._task
+            return warmup, before
+
+        warmup, before = asyncio.run(scenario())
+        assert before is False
+        assert warmup.ready
+        assert ran == ["step"]
+        assert warmup.status()["steps"]["step"]["status"] == "ok"
+
+    def test_failed_step_is_reported_but_still_ready(self):
+        async def broken():
+            raise ConnectionError("Firestore unavailable")
+
+        async def ok():
+            pass
+
+        warmup = WarmUp()
+        asyncio.run(warmup.run({"store": broken, "payload": ok}))
+        assert warmup.ready
+        assert warmup.results["store"]["status"] == "failed"
+        assert warmup.results["store"]["error"] == "Firestore unavailable"
+        assert warmup.results["payload"]["status"] == "ok"
+
+    def test_ready_after_timeout(self):
+        async def hangs():
+            await asyncio.sleep(10)
+
+        warmup = WarmUp(timeout=0.05)
+        asyncio.run(warmup.run({"ultravox": hangs}))
+        assert warmup.ready
+        assert warmup.results["ultravox"]["status"] == "timed out"
+
+    def test_stop_drains_and_cancels(self):
+        async def hangs():
+            await asyncio.sleep(10)
+
+        async def scenario():
+            warmup = WarmUp()
+            warmup.start({"ultravox": hangs})
+            await asyncio.sleep(0)
+            await warmup.stop()
+            return warmup
+
+        warmup = asyncio.run(scenario())
+        assert not warmup.ready
+        assert warmup.status()["status"] == "draining"
+
+
+class TestReadyEndpoint:
+    """Test the readiness probe"""
+
+    def test_ready_after_warm_up(self):
+        fake = FakeFirestore()
+        with FakeUltravoxServer() as server:
+            env = {"ULTRAVOX_API_KEY": "test_key", "ULTRAVOX_API_URL": server.url}
+            with patch.dict(os.environ, env), patch("main.WARMUP", True), patch("main.warmup", WarmUp()), \
+                    patch("main.store", FirestoreStore(fake)), TestClient(app) as client:
+                response = wait_until_ready(client)
+                assert response.status_code == 200
+                steps = response.json()["steps"]
+                assert {"payload", "models", "store", "ultravox"} <= set(steps)
+                assert all(step["status"] == "ok" for step in steps.values())
+                assert response.headers["Cache-Control"] == "no-store"
+
+                client.post("/sessions/warm_session/calls")
+
+        assert fake.rpc_count == 1
+        # The call reused the connection opened while warming up
+        assert server.connections == 1
+        assert len(server.calls) == 1
+
+    def test_not_ready_while_warming(self):
+        async def hangs():
+            await asyncio.sleep(10)
+
+        with patch("main.WARMUP", True), patch("main.warm_up_steps", lambda: {"store": hangs}), \
+                TestClient(app) as client:
+            response = client.get("/ready")
+            assert response.status_code == 503
+            assert response.json()["status"] == "warming"
+
+    def test_ready_when_warm_up_is_off(self):
+        with patch("main.WARMUP", False), patch("main.warmup", WarmUp()), TestClient(app) as client:
+            response = client.get("/ready")
+            assert response.status_code == 200
+            assert response.json()["status"] == "ready"
+
+
+class TestUltravoxWarmUp:
+    """Test opening Ultravox connections ahead of calls"""
+
+    def test_opens_the_requested_connections(self):
+        async def scenario(url):
+            async with httpx.AsyncClient(base_url=url) as client:
+                await ultravox.warm_up(client, connections=3)
+
+        with FakeUltravoxServer() as server:
+            asyncio.run(scenario(server.url))
+
+        assert server.connections == 3
+        assert server.calls == []
@@ -0,0 +1,251 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+from fakes import FakeFirestore
+from main import app
+from metrics import REGISTRY, WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_DROPPED, WRITE_BEHIND_FLUSH_SECONDS, WRITE_BEHIND_FLUSHES, WRITE_BEHIND_PENDING
+from storage import COGNITIVE_DISTORTIONS, SUMMARY, TASKS, FirestoreStore
+from test_storage import fire_parallel, report
+from write_behind import BufferFull, WriteBehindBuffer
+
+test_session_id = "write_behind_session"
+
+
+def document_path(session_id, kind):
+    return f"sessions/{session_id}/{kind[0]}/{kind[1]}"
+
+
+def make_buffer(fake, **kwargs):
+    return WriteBehindBuffer(commit=FirestoreStore(fake).commit_session_writes, **kwargs)
+
+
+class TestWriteBehindBuffer:
+    """Test coalescing and flushing of buffered session writes"""
+
+    def test_appends_to_one_document_are_coalesced(self):
+        fake = FakeFirestore()
+
+        async def run():
+            buffer = make_buffer(fake, flush_interval=60)
+            await buffer.start()
+            for i in range(50):
+                await buffer.append_to_session_array(test_session_id, TASKS, "tasks", [f"Task {i}"])
+            await buffer.join()
+            return buffer.stats()
+
+        stats = asyncio.run(run())
+        assert fake.dump(document_path(test_session_id, TASKS))["tasks"] == [f"Task {i}" for i in range(50)]
+        assert fake.rpc_count == 1
+        assert stats["operations"] == 50
+        assert stats["documents_written"] == 1
+
+    def test_set_then_append_keeps_order(self):
+        """An append after a replace lands in the replaced document, a replace drops earlier appends"""
+        fake = FakeFirestore()
+        fake.seed(document_path(test_session_id, TASKS), {"tasks": ["Old"]})
+
+        async def run():
+            buffer = make_buffer(fake, flush_interval=60)
+            await buffer.start()
+            await buffer.append_to_session_array(test_session_id, SUMMARY, "notes", ["dropped"])
+            await buffer.set_session_document(test_session_id, SUMMARY, {"summary": "Done"})
+            await buffer.append_to_session_array(test_session_id, SUMMARY, "notes", ["kept"])
+            await buffer.append_to_session_array(test_session_id, TASKS, "tasks", ["New"])
+            await buffer.join()
+
+        asyncio.run(run())
+        summary = fake.dump(document_path(test_session_id, SUMMARY))
+        assert summary["summary"] == "Done"
+        assert summary["notes"] == ["kept"]
+        assert fake.dump(document_path(test_session_id, TASKS))["tasks"] == ["Old", "New"]
+        assert fake.batch_sizes == [2]
+
+    def test_flushes_when_full(self):
+        """Reaching max_pending flushes without waiting for the interval"""
+        fake = FakeFirestore()
+
+        async def run():
+            buffer = make_buffer(fake, flush_interval=60, max_pending=10)
+            await buffer.start()
+            for i in range(10):
+                await buffer.append_to_session_array(f"session_{i}", TASKS, "tasks", ["Task"])
+            await asyncio.sleep(0.05)
+            stats = buffer.stats()
+            await buffer.stop()
+            return stats
+
+        stats = asyncio.run(run())
+        assert stats["flushes"] == 1
+        assert stats["batch_size_max"] == 10
+        assert stats["pending_operations"] == 0
+
+    def test_failed_flush_is_retried(self):
+        """A failed batch goes back in the buffer, merged with the writes made since"""
+        fake = FakeFirestore()
+        fake.fail_batches = 1
+
+        async def run():
+            buffer = make_buffer(fake, flush_interval=60)
+            await buffer.start()
+            await buffer.append_to_session_array(test_session_id, TASKS, "tasks", ["First"])
+            await buffer.join()
+            await buffer.append_to_session_array(test_session_id, TASKS, "tasks", ["Second"])
+            assert buffer.stats()["pending_operations"] == 2
+            await buffer.join()
+            return buffer.stats()
+
+        stats = asyncio.run(run())
+        assert stats["failures"] == 1
+        assert stats["flushes"] == 1
+        assert fake.dump(document_path(test_session_id, TASKS))["tasks"] == ["First", "Second"]
+
+    def test_bad_write_is_split_off_and_dropped(self):
+        """A write that always fails is isolated from its batch and dropped after max_attempts"""
+        fake = FakeFirestore()
+        store = FirestoreStore(fake)
+
+        async def commit(writes):
+            if any(write.session_id == "bad_session" for write in writes):
+                raise ValueError("Invalid document")
+            await store.commit_session_writes(writes)
+
+        committed = WRITE_BEHIND_FLUSHES.value("committed")
+        dropped = WRITE_BEHIND_DROPPED.value()
+        timed_flushes = WRITE_BEHIND_FLUSH_SECONDS.count()
+        sized_batches = WRITE_BEHIND_BATCH_SIZE.count()
+
+        async def run():
+            buffer = WriteBehindBuffer(commit, flush_interval=60, max_attempts=2)
+            await buffer.start()
+            for session_id in ("session_0", "session_1", "bad_session", "session_2"):
+                await buffer.append_to_session_array(session_id, TASKS, "tasks", ["Task"])
+            await buffer.join()
+            assert buffer.stats()["pending_documents"] == 1
+            await buffer.join()
+            return buffer.stats()
+
+        stats = asyncio.run(run())
+        for i in range(3):
+            assert fake.dump(document_path(f"session_{i}", TASKS))["tasks"] == ["Task"]
+        assert fake.dump(document_path("bad_session", TASKS)) is None
+        assert stats["dropped"] == 1
+        assert stats["pending_documents"] == 0
+        assert WRITE_BEHIND_FLUSHES.value("committed") - committed == 2
+        assert WRITE_BEHIND_DROPPED.value() - dropped == 1
+        assert WRITE_BEHIND_PENDING.value() == 0
+        # Only committed batches are observed: the first half, then the good write split off the second
+        assert WRITE_BEHIND_FLUSH_SECONDS.count() - timed_flushes == 2
+        assert WRITE_BEHIND_BATCH_SIZE.count() - sized_batches == 2
+        assert "write_behind_flush_seconds_count" in REGISTRY.render()
+
+    def test_full_buffer_refuses_writes(self):
+        """Writes past max_buffered raise BufferFull instead of growing the buffer"""
+        fake = FakeFirestore()
+
+        async def run():
+            buffer = make_buffer(fake, flush_interval=60, max_pending=100, max_buffered=3)
+            await buffer.start()
+            for i in range(3):
+                await buffer.append_to_session_array(test_session_id, TASKS, "tasks", [f"Task {i}"])
+            assert WRITE_BEHIND_PENDING.value() == 3
+            with pytest.raises(BufferFull):
+                await buffer.append_to_session_array(test_session_id, TASKS, "tasks", ["One too many"])
+            await buffer.join()
+            await buffer.append_to_session_array(test_session_id, TASKS, "tasks", ["After the flush"])
+            await buffer.join()
+            return buffer.stats()
+
+        stats = asyncio.run(run())
+        assert stats["rejected"] == 1
+        assert fake.dump(document_path(test_session_id, TASKS))["tasks"] == ["Task 0", "Task 1", "Task 2", "After the flush"]
+
+
+    def test_writes_need_the_buffer_started_on_the_running_loop(self):
+        """Writes left by a closed loop are flushed by the next start, and nothing rebinds silently"""
+        fake = FakeFirestore()
+        buffer = make_buffer(fake, flush_interval=60)
+
+        async def write():
+            await buffer.append_to_session_array(test_session_id, TASKS, "tasks", ["Task"])
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(write())
+
+        async def start_and_write():
+            await buffer.start()
+            await write()
+
+        asyncio.run(start_and_write())
+        assert buffer.stats()["pending_operations"] == 1
+        with pytest.raises(RuntimeError):
+            asyncio.run(write())
+
+        async def restart():
+            await buffer.start()
+            await buffer.stop()
+
+        asyncio.run(restart())
+        assert fake.dump(document_path(test_session_id, TASKS))["tasks"] == ["Task"]
+
+    def test_restarting_drains_the_old_flusher(self):
+        fake = FakeFirestore()
+
+        async def run():
+            buffer = make_buffer(fake, flush_interval=60)
+            await buffer.start()
+            old_flusher = buffer._flusher
+            await buffer.append_to_session_array(test_session_id, TASKS, "tasks", ["Task"])
+            await buffer.start()
+            assert old_flusher.cancelled()
+            assert fake.dump(document_path(test_session_id, TASKS))["tasks"] == ["Task"]
+            await buffer.stop()
+
+        asyncio.run(run())
+
+class TestWriteBehindEndpoints:
+    """The tool endpoints acknowledge before Firestore does when write-behind is enabled"""
+
+    def test_parallel_appends_are_batched(self):
+        """500 parallel tool calls against a 20 ms Firestore answer without waiting on it"""
+        fake = FakeFirestore(latency=0.02)
+        buffer = make_buffer(fake, flush_interval=0.01)
+        requests = [
+            ("/sessions/tasks", {"session_id": f"session_{i % 50}", "task": f"Task {i}"})
+            for i in range(250)
+        ] + [
+            ("/sessions/cognitive-distortions", {"session_id": f"session_{i % 50}", "cognitiveDistortions": [f"Distortion {i}"]})
+            for i in range(250)
+        ]
+
+        async def run():
+            await buffer.start()
+            latencies = await fire_parallel(requests)
+            await buffer.stop()
+            return latencies
+
+        with patch("main.store", FirestoreStore(fake)), patch("main.write_buffer", buffer), \
+                patch("main.WRITE_BEHIND", True):
+            latencies = asyncio.run(run())
+
+        report("write-behind", latencies)
+        # Requests are answered before their write could have reached Firestore
+        assert latencies[int(len(latencies) * 0.99) - 1] < 0.02
+        assert fake.rpc_count < 20
+        for i in range(50):
+            tasks = fake.dump(document_path(f"session_{i}", TASKS))["tasks"]
+            distortions = fake.dump(document_path(f"session_{i}", COGNITIVE_DISTORTIONS))["distortions"]
+            assert len(tasks) == 5
+            assert len(distortions) == 5
+
+    def test_full_buffer_answers_503(self):
+        """The tool endpoints push back with a 503 while the buffer is full"""
+        buffer = make_buffer(FakeFirestore(), flush_interval=60, max_buffered=0)
+        with patch("main.store", FirestoreStore(FakeFirestore())), patch("main.write_buffer", buffer), \
+                patch("main.WRITE_BEHIND", True), TestClient(app) as client:
+            response = client.post("/sessions/tasks", json={"session_id": test_session_id, "task": "Journal daily"})
+
+        assert response.status_code == 503
+        assert "continue the conversation" in response.json()["message"]
@@ -0,0 +1,433 @@
+"""
+Lightweight request tracing.
+
+TracingMiddleware opens a trace for every HTTP request, continuing the trace
+of an incoming W3C traceparent header if there is one. Code handling the
+request opens spans with ``span``, and ``metrics.timed`` opens one around
+every Firestore, Exa, Ultravox and SMTP call, so a slow request breaks down
+into its phases. The trace id is added to every log record as ``trace_id``.
+
+When the response starts, the spans finished so far are summed per name into
+a Server-Timing header for the frontend. Finished traces go to the exporter
+set with ``set_exporter``, which appends them to a JSON lines file or posts
+them to an OTLP/HTTP collector from a background thread.
+"""
+
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+
+# Server-Timing entries per response, the slowest are kept
+MAX_SERVER_TIMING_ENTRIES = 20
+
+# httpcore trace events -> the phase of an outbound HTTP request they time
+HTTP_PHASES = {
+    "connect_tcp": "connect",
+    "start_tls": "tls",
+    "send_request_headers": "send",
+    "send_request_body": "send",
+    "receive_response_headers": "wait",
+    "receive_response_body": "receive",
+}
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "kind", "start_ns", "duration", "attributes", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], kind: int = INTERNAL, attributes: Optional[dict] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.duration = 0.0
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Trace:
+    """
+    The spans of one request or background job. Spans are appended as they finish,
+    from the event loop or the threads work was handed to.
+    """
+
+    def __init__(self, trace_id: Optional[str] = None, parent_id: Optional[str] = None):
+        self.trace_id = trace_id or secrets.token_hex(16)
+        # Span of the caller this trace continues, from its traceparent header
+        self.parent_id = parent_id
+        self.spans: List[Span] = []
+
+    @classmethod
+    def from_traceparent(cls, header: Optional[str]) -> "Trace":
+        """
+        Continues the caller's trace if the header is a valid W3C traceparent, else starts a new one
+        """
+        if header:
+            parts = header.strip().split("-")
+            if (
+                len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16
+                and _is_hex(parts[1]) and _is_hex(parts[2])
+                and parts[1] != "0" * 32 and parts[2] != "0" * 16
+            ):
+                return cls(parts[1].lower(), parts[2].lower())
+        return cls()
+
+    def server_timing(self, total: Optional[float] = None) -> str:
+        """
+        Returns the finished spans summed per name as a Server-Timing header value, in milliseconds
+        """
+        durations: Dict[str, float] = {}
+        for span in list(self.spans):
+            if span.kind != SERVER:
+                durations[span.name] = durations.get(span.name, 0.0) + span.duration
+        slowest = sorted(durations.items(), key=lambda item: item[1], reverse=True)[:MAX_SERVER_TIMING_ENTRIES]
+        entries = [f"{name};dur={duration * 1000:.1f}" for name, duration in slowest]
+        if total is not None:
+            entries.append(f"total;dur={total * 1000:.1f}")
+        entries.append(f'trace;desc="{self.trace_id}"')
+        return ", ".join(entries)
+
+
+def _is_hex(value: str) -> bool:
+    try:
+        int(value, 16)
+    except ValueError:
+        return False
+    return True
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[str]] = ContextVar("current_span", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+class span:
+    """
+    Times a phase of the current trace, with or without await inside the block:
+
+        with span("payload"):
+            payload = get_payload_json(session_id)
+
+    Does nothing outside a trace. A phase that raises is recorded with the exception's type.
+    """
+    __slots__ = ("name", "attributes", "trace", "record", "previous", "started")
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self) -> "span":
+        self.trace = _current_trace.get()
+        if self.trace is None:
+            return self
+        self.previous = _current_span.get()
+        self.record = Span(self.name, self.trace.trace_id, self.previous or self.trace.parent_id, attributes=self.attributes)
+        _current_span.set(self.record.span_id)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        if self.trace is None:
+            return
+        self.record.duration = time.perf_counter() - self.started
+        if exc_type is not None:
+            self.record.error = exc_type.__name__
+        _current_span.set(self.previous)
+        self.trace.spans.append(self.record)
+
+
+@contextmanager
+def start_trace(name: str, kind: int = INTERNAL, trace: Optional[Trace] = None, **attributes) -> Iterator[Span]:
+    """
+    Runs the block as the root span of a trace, and exports the trace when the block ends.
+    For work that doesn't run inside a request, e.g. on the mailer's threads.
+    """
+    trace = trace or Trace()
+    root = Span(name, trace.trace_id, trace.parent_id, kind, attributes)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(root.span_id)
+    started = time.perf_counter()
+    try:
+        yield root
+    except BaseException as e:
+        root.error = type(e).__name__
+        raise
+    finally:
+        root.duration = time.perf_counter() - started
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        trace.spans.append(root)
+        if _exporter is not None:
+            _exporter.submit(trace)
+
+
+def http_phases(prefix: str) -> Optional[Callable]:
+    """
+    Returns an httpx trace extension that records connection setup, sending, waiting for
+    the response headers and reading the body as spans named prefix.connect, prefix.wait...
+    Returns None outside a trace, so the request isn't traced at all.
+
+        await client.post(url, extensions={"trace": http_phases("ultravox")})
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    parent_id = _current_span.get()
+    started: Dict[str, tuple] = {}
+
+    async def record(event_name: str, info: dict) -> None:
+        # e.g. "connection.connect_tcp.started" or "http11.receive_response_headers.complete"
+        step, _, outcome = event_name.rpartition(".")
+        phase = HTTP_PHASES.get(step.rpartition(".")[2])
+        if phase is None:
+            return
+        if outcome == "started":
+            started[step] = (time.perf_counter(), Span(f"{prefix}.{phase}", trace.trace_id, parent_id, CLIENT))
+            return
+        begun = started.pop(step, None)
+        if begun is None:
+            return
+        began_at, record_span = begun
+        record_span.duration = time.perf_counter() - began_at
+        if outcome == "failed":
+            exception = info.get("exception")
+            record_span.error = type(exception).__name__ if exception is not None else "failed"
+        trace.spans.append(record_span)
+
+    return record
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware that traces every HTTP request and adds its Server-Timing header.
+
+    Browsers only show Server-Timing to scripts of another origin if Timing-Allow-Origin
+    allows it, so it's sent to the origins in timing_allow_origins.
+    """
+
+    def __init__(self, app, timing_allow_origins: Sequence[str] = ()):
+        self.app = app
+        self.timing_allow_origins = {origin.encode("latin-1") for origin in timing_allow_origins}
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or ())
+        traceparent = headers.get(b"traceparent")
+        trace = Trace.from_traceparent(traceparent.decode("latin-1") if traceparent else None)
+        origin = headers.get(b"origin")
+        started = time.perf_counter()
+
+        async def send_with_timing(message) -> None:
+            if message["type"] == "http.response.start":
+                response_headers = list(message.get("headers") or ())
+                response_headers.append(
+                    (b"server-timing", trace.server_timing(time.perf_counter() - started).encode("latin-1"))
+                )
+                if origin is not None and origin in self.timing_allow_origins:
+                    response_headers.append((b"timing-allow-origin", origin))
+                message = dict(message, headers=response_headers)
+            await send(message)
+
+        with start_trace(f"{scope['method']} {scope['path']}", SERVER, trace, **{"http.method": scope["method"]}) as root:
+            try:
+                await self.app(scope, receive, send_with_timing)
+            finally:
+                # The router stores the matched route in the scope, name the span after its template
+                route_path = getattr(scope.get("route"), "path", None)
+                if route_path:
+                    root.name = f"{scope['method']} {route_path}"
+
+
+class BatchExporter:
+    """
+    Exports finished traces from a background thread so requests never wait on the disk or
+    the collector. Traces are dropped, and counted, when the queue is full.
+    """
+
+    def __init__(self, export: Callable[[List[Trace]], None], max_queue: int = 2048, batch_size: int = 64, interval: float = 1.0):
+        self._export = export
+        self._queue: "queue.Queue[Optional[Trace]]" = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, trace: Trace) -> None:
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                item = self._queue.get(timeout=self.interval)
+                while True:
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            if batch:
+                try:
+                    self._export(batch)
+                except Exception as e:
+                    logger.error(f"Exporting {len(batch)} traces failed: {str(e)}")
+
+    def close(self) -> None:
+        """
+        Exports what's queued and stops the thread
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout=5)
+
+
+class FileExporter:
+    """
+    Appends every span as a line of JSON
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __call__(self, traces: List[Trace]) -> None:
+        lines = [json.dumps(span.to_dict(), default=str) for trace in traces for span in trace.spans]
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+class OTLPExporter:
+    """
+    Posts spans to an OpenTelemetry collector with OTLP/HTTP in its JSON encoding
+    """
+
+    def __init__(self, endpoint: str, service_name: str = "maggie-web-api", timeout: float = 5.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.client = httpx.Client(timeout=timeout)
+
+    def payload(self, traces: List[Trace]) -> dict:
+        spans = []
+        for trace in traces:
+            for span in trace.spans:
+                otlp_span = {
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    "name": span.name,
+                    "kind": span.kind,
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.start_ns + int(span.duration * 1e9)),
+                    "attributes": [
+                        {"key": key, "value": {"stringValue": str(value)}} for key, value in span.attributes.items()
+                    ],
+                    "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+                }
+                if span.parent_id:
+                    otlp_span["parentSpanId"] = span.parent_id
+                spans.append(otlp_span)
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "maggie.tracing"}, "spans": spans}],
+            }]
+        }
+
+    def __call__(self, traces: List[Trace]) -> None:
+        self.client.post(self.endpoint, json=self.payload(traces)).raise_for_status()
+
+
+_exporter: Optional[BatchExporter] = None
+
+
+def set_exporter(exporter: Optional[BatchExporter]) -> None:
+    global _exporter
+    _exporter = exporter
+
+
+def exporter_from_env() -> Optional[BatchExporter]:
+    """
+    TRACE_EXPORT=file appends spans to TRACE_FILE, TRACE_EXPORT=otlp posts them to
+    TRACE_OTLP_ENDPOINT. Anything else keeps traces in the Server-Timing header only.
+    """
+    mode = os.getenv("TRACE_EXPORT", "").lower()
+    if mode == "file":
+        return BatchExporter(FileExporter(os.getenv("TRACE_FILE", "traces.jsonl")))
+    if mode == "otlp":
+        return BatchExporter(OTLPExporter(
+            os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces"),
+            service_name=os.getenv("TRACE_SERVICE_NAME", "maggie-web-api"),
+        ))
+    return None
+
+
+def install_log_record_factory() -> None:
+    """
+    Adds the current trace id to every log record as trace_id, "-" outside a trace
+    """
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, "adds_trace_id", False):
+        return
+
+    def record_factory(*args, **kwargs) -> logging.LogRecord:
+        record = factory(*args, **kwargs)
+        record.trace_id = current_trace_id() or "-"
+        return record
+
+    record_factory.adds_trace_id = True
+    logging.setLogRecordFactory(record_factory)
@@ -0,0 +1,304 @@
+"""
+Shared HTTP client for the Ultravox API.
+
+One long-lived client is created in the app lifespan so every call creation
+reuses pooled keep-alive connections instead of paying for a new TCP and TLS
+handshake. Pool limits and timeouts can be tuned through the environment.
+warm_up() opens those connections before the first call needs them.
+
+CallCreator creates calls on that client within a deadline, retrying failed
+attempts and optionally hedging slow ones, under a retry budget shared by all
+calls so retries can't multiply the load on Ultravox when it's struggling.
+"""
+
+import asyncio
+import importlib.util
+import logging
+import math
+import os
+import random
+import time
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple, Union
+
+import httpx
+
+import tracing
+from metrics import DEPENDENCY_ATTEMPTS, RETRY_BUDGET_EXHAUSTED
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_URL = "https://api.ultravox.ai"
+
+# HTTP/2 needs the optional h2 package (installed with httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def create_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=int(os.getenv("ULTRAVOX_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("ULTRAVOX_MAX_KEEPALIVE_CONNECTIONS", "20")),
+        keepalive_expiry=float(os.getenv("ULTRAVOX_KEEPALIVE_EXPIRY", "60")),
+    )
+    timeout = httpx.Timeout(
+        connect=float(os.getenv("ULTRAVOX_CONNECT_TIMEOUT", "5")),
+        read=float(os.getenv("ULTRAVOX_READ_TIMEOUT", "30")),
+        write=float(os.getenv("ULTRAVOX_WRITE_TIMEOUT", "10")),
+        pool=float(os.getenv("ULTRAVOX_POOL_TIMEOUT", "5")),
+    )
+    return httpx.AsyncClient(
+        base_url=os.getenv("ULTRAVOX_API_URL", DEFAULT_API_URL),
+        limits=limits,
+        timeout=timeout,
+        http2=HTTP2_AVAILABLE,
+    )
+
+
+async def warm_up(client: httpx.AsyncClient, connections: int = 1) -> None:
+    """
+    Opens connections to the API with concurrent HEAD requests, so they are pooled when calls
+    are created. Any response will do, it's the TCP and TLS handshake that's being paid for.
+    """
+    await asyncio.gather(*(client.head("/") for _ in range(connections)))
+
+
+# Responses worth trying again: rate limited, or Ultravox or its load balancer failing
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Errors raised before the request was sent, so Ultravox can't have created a call yet.
+# After a read timeout or a dropped connection it may have, and a retry could create a second one.
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when no attempt at creating a call succeeded within the deadline
+    """
+
+
+class RetryBudget:
+    """
+    Caps retries and hedged requests at a fraction of the calls made, so a struggling
+    Ultravox gets a bounded amount of extra traffic rather than a retry storm.
+
+    Every call deposits ratio tokens and every retry or hedge takes one. Tokens also
+    accrue at min_per_second, so a quiet worker can still retry, up to max_tokens.
+
+        Args:
+            ratio: Retries allowed per call on top of min_per_second
+            min_per_second: Retries allowed per second however few calls are made
+            max_tokens: Most retries that can be saved up
+    """
+
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 1.0, max_tokens: float = 10.0, clock: Callable[[], float] = time.monotonic):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._clock = clock
+        self._refilled = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self._refilled) * self.min_per_second)
+        self._refilled = now
+
+    def deposit(self) -> None:
+        self._refill()
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_withdraw(self) -> bool:
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class LatencyWindow:
+    """
+    The latencies of the last few successful attempts, to hedge after a percentile of them
+    """
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """
+        Returns the nearest-rank percentile, or None until there are min_samples
+        """
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+class CallCreator:
+    """
+    Creates Ultravox calls within a deadline.
+
+    An attempt that fails with a retryable status, or with a transport error raised before
+    the request was sent, is retried after a jittered exponential backoff, while the deadline
+    and the shared retry budget allow. Other transport errors are raised straight away.
+    With hedging on, an attempt that hasn't answered after the p95 latency of recent
+    attempts gets a second request racing it, and the first usable response wins. A call
+    created by the losing request is never joined and expires on Ultravox's side.
+
+    Every attempt is counted in dependency_attempts_total by kind and outcome, logged,
+    and traced as an ultravox.attempt span.
+
+        Args:
+            deadline: Seconds to create the call in, retries and hedges included
+            max_attempts: Requests made one after the other at most, hedges not included
+            backoff: Seconds before the first retry, doubled for each one after
+            max_backoff: Longest wait before a retry
+            hedge: Whether to race slow attempts with a second request
+            hedge_percentile: The percentile of recent latencies to hedge after
+            hedge_delay: Seconds to hedge after until there are enough latencies
+            min_hedge_delay: Hedge no sooner than this, however fast Ultravox has been
+            budget: Retry budget shared by every call, a new one if not given
+    """
+
+    def __init__(
+        self,
+        deadline: float = 10.0,
+        max_attempts: int = 3,
+        backoff: float = 0.1,
+        max_backoff: float = 1.0,
+        hedge: bool = False,
+        hedge_percentile: float = 95.0,
+        hedge_delay: float = 1.0,
+        min_hedge_delay: float = 0.05,
+        budget: Optional[RetryBudget] = None,
+        seed: Optional[int] = None,
+    ):
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.budget = budget or RetryBudget()
+        self.latencies = LatencyWindow()
+        self._random = random.Random(seed)
+
+    @classmethod
+    def from_env(cls) -> "CallCreator":
+        return cls(
+            deadline=float(os.getenv("ULTRAVOX_CALL_DEADLINE", "10")),
+            max_attempts=int(os.getenv("ULTRAVOX_MAX_ATTEMPTS", "3")),
+            backoff=float(os.getenv("ULTRAVOX_RETRY_BACKOFF", "0.1")),
+            max_backoff=float(os.getenv("ULTRAVOX_MAX_BACKOFF", "1")),
+            hedge=os.getenv("ULTRAVOX_HEDGE", "false").lower() == "true",
+            hedge_percentile=float(os.getenv("ULTRAVOX_HEDGE_PERCENTILE", "95")),
+            hedge_delay=float(os.getenv("ULTRAVOX_HEDGE_DELAY", "1")),
+            min_hedge_delay=float(os.getenv("ULTRAVOX_MIN_HEDGE_DELAY", "0.05")),
+            budget=RetryBudget(ratio=float(os.getenv("ULTRAVOX_RETRY_BUDGET_RATIO", "0.1"))),
+        )
+
+    def current_hedge_delay(self) -> float:
+        observed = self.latencies.percentile(self.hedge_percentile)
+        return max(self.min_hedge_delay, observed if observed is not None else self.hedge_delay)
+
+    async def create(self, client: httpx.AsyncClient, payload: Union[str, bytes], api_key: str) -> httpx.Response:
+        """
+        Posts the call to Ultravox and returns the first usable response, or the last retryable one
+        if the attempts or the retry budget ran out. Raises a transport error that isn't retryable
+        straight away, the last retryable one if no attempt got a response, and DeadlineExceeded
+        if the deadline passed first.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        self.budget.deposit()
+        kind = "first"
+        for attempt in range(1, self.max_attempts + 1):
+            response, error = await self._attempt(client, payload, api_key, kind, attempt, deadline)
+            if error is None and response.status_code not in RETRYABLE_STATUSES:
+                return response
+            if error is not None and not isinstance(error, RETRYABLE_ERRORS):
+                raise error
+            if attempt == self.max_attempts:
+                break
+            delay = self._backoff(attempt, response)
+            if loop.time() + delay >= deadline:
+                break
+            if not self.budget.try_withdraw():
+                RETRY_BUDGET_EXHAUSTED.inc(("ultravox", "create_call"))
+                logger.warning("Ultravox retry budget exhausted, not retrying")
+                break
+            await asyncio.sleep(delay)
+            kind = "retry"
+        if error is not None:
+            raise error
+        return response
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        # A Retry-After in seconds is honoured, otherwise full jitter
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return self._random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    async def _attempt(
+        self, client: httpx.AsyncClient, payload: Union[str, bytes], api_key: str, kind: str, attempt: int, deadline: float
+    ) -> Tuple[Optional[httpx.Response], Optional[Exception]]:
+        """
+        Makes one attempt, hedged if it's slow, and returns its (response, None) or (None, error)
+        """
+        loop = asyncio.get_running_loop()
+        requests = [asyncio.create_task(self._request(client, payload, api_key, kind, attempt))]
+        outcome: Tuple[Optional[httpx.Response], Optional[Exception]] = (None, None)
+        try:
+            if self.hedge:
+                done, _ = await asyncio.wait(requests, timeout=min(self.current_hedge_delay(), max(0.0, deadline - loop.time())))
+                if not done and loop.time() < deadline:
+                    if self.budget.try_withdraw():
+                        requests.append(asyncio.create_task(self._request(client, payload, api_key, "hedge", attempt)))
+                    else:
+                        RETRY_BUDGET_EXHAUSTED.inc(("ultravox", "create_call"))
+            pending = set(requests)
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise DeadlineExceeded(f"No Ultravox call created within {self.deadline:g}s")
+                for request in done:
+                    outcome = request.result()
+                    response, error = outcome
+                    if error is None and response.status_code not in RETRYABLE_STATUSES:
+                        return outcome
+            return outcome
+        finally:
+            for request in requests:
+                request.cancel()
+
+    async def _request(
+        self, client: httpx.AsyncClient, payload: Union[str, bytes], api_key: str, kind: str, attempt: int
+    ) -> Tuple[Optional[httpx.Response], Optional[Exception]]:
+        started = time.perf_counter()
+        outcome = "cancelled"
+        try:
+            with tracing.span("ultravox.attempt", kind=kind, attempt=attempt):
+                response = await client.post(
+                    "/api/calls",
+                    headers={"Content-Type": "application/json", "X-Unsafe-API-Key": api_key},
+                    content=payload,
+                    # Splits the attempt into connection setup, sending and waiting on Ultravox
+                    extensions={"trace": tracing.http_phases("ultravox")},
+                )
+            outcome = str(response.status_code)
+            if response.status_code not in RETRYABLE_STATUSES:
+                self.latencies.record(time.perf_counter() - started)
+            return response, None
+        except httpx.TransportError as e:
+            outcome = type(e).__name__
+            return None, e
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            DEPENDENCY_ATTEMPTS.inc(("ultravox", "create_call", kind, outcome))
+            logger.info(f"Ultravox {kind} attempt {attempt}: {outcome} in {elapsed_ms:.0f} ms")
@@ -0,0 +1,101 @@
+"""
+Warm-up of a new worker before it takes traffic.
+
+Right after a deploy the first requests would pay for the Firestore channel,
+the Ultravox TLS handshake, building the Exa client and compiling the call
+payload. WarmUp runs those steps concurrently in the background when the app
+starts, and GET /ready answers 503 until they are done, so the load balancer
+only sends traffic to warm workers.
+
+A step that fails is logged and reported by /ready but doesn't keep the
+worker out of rotation: a dependency being down is no reason for every
+worker to stay unready, and requests handle the failure as they always have.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Not started, running, ready, or draining once the app is shutting down
+PENDING = "pending"
+WARMING = "warming"
+READY = "ready"
+DRAINING = "draining"
+
+
+class WarmUp:
+    """
+    Runs named warm-up steps and tracks whether the worker is ready.
+
+        Args:
+            timeout: Seconds after which the worker is ready whatever steps are left
+    """
+
+    def __init__(self, timeout: float = 30.0):
+        self.timeout = timeout
+        self.state = PENDING
+        self.results: Dict[str, dict] = {}
+        self.duration_ms: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state == READY
+
+    def start(self, steps: Dict[str, Callable[[], Awaitable[None]]]) -> None:
+        """
+        Starts running the steps, coroutine functions by name, concurrently in the background.
+        Must be called from the event loop.
+        """
+        self.state = WARMING
+        self._task = asyncio.create_task(self.run(steps))
+
+    def skip(self) -> None:
+        self.state = READY
+
+    async def run(self, steps: Dict[str, Callable[[], Awaitable[None]]]) -> None:
+        self.state = WARMING
+        self.results = {}
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(self._run_step(name, step)) for name, step in steps.items()]
+        try:
+            _, pending = await asyncio.wait(tasks, timeout=self.timeout) if tasks else (set(), set())
+        finally:
+            # Steps left at the timeout, or all of them if the app stops first
+            for task in tasks:
+                task.cancel()
+        if pending:
+            for name in steps:
+                self.results.setdefault(name, {"status": "timed out"})
+            logger.warning(f"Warm-up timed out after {self.timeout:g}s")
+        self.duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        if self.state == WARMING:
+            self.state = READY
+        logger.info(f"Warm-up finished in {self.duration_ms:.0f} ms: {self.results}")
+
+    async def _run_step(self, name: str, step: Callable[[], Awaitable[None]]) -> None:
+        started = time.perf_counter()
+        try:
+            await step()
+            result = {"status": "ok"}
+        except Exception as e:
+            logger.warning(f"Warm-up step {name} failed: {str(e)}")
+            result = {"status": "failed", "error": str(e)}
+        result["ms"] = round((time.perf_counter() - started) * 1000, 1)
+        self.results[name] = result
+
+    async def stop(self) -> None:
+        """
+        Marks the worker as draining, so /ready fails while it shuts down, and cancels a warm-up still running
+        """
+        self.state = DRAINING
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def status(self) -> dict:
+        return {"status": self.state, "duration_ms": self.duration_ms, "steps": self.results}
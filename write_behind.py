@@ -0,0 +1,270 @@
+"""
+Write-behind buffer for the tool endpoints.
+
+Ultravox waits for a tool call's response before the agent carries on
+talking, so every Firestore round trip in those handlers is heard as a pause.
+With write-behind enabled the handlers only record the change here and answer
+straight away. Pending changes to the same session document are coalesced,
+and the buffer flushes them as Firestore batched writes every
+``flush_interval`` seconds, or as soon as ``max_pending`` operations are
+waiting. A write is lost if the process dies before its flush, and reads
+can lag the acknowledged writes by up to one flush interval.
+
+A batch that fails is split in halves until the writes that fail are on
+their own, so one bad write doesn't hold back the others. A write is retried
+on the following flushes and dropped, with an error in the log, once it has
+failed ``max_attempts`` times. The buffer holds at most ``max_buffered``
+operations; past that, writes raise BufferFull rather than piling up while
+Firestore is down. Flush outcomes are exported in /metrics.
+"""
+
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from circuit import CircuitOpen
+from metrics import (
+    WRITE_BEHIND_BATCH_SIZE,
+    WRITE_BEHIND_DROPPED,
+    WRITE_BEHIND_FLUSH_SECONDS,
+    WRITE_BEHIND_FLUSHES,
+    WRITE_BEHIND_PENDING,
+    WRITE_BEHIND_REJECTED,
+)
+from storage import MAX_BATCH_WRITES, SessionWrite
+
+logger = logging.getLogger(__name__)
+
+
+class BufferFull(Exception):
+    """Raised when a write is buffered while the buffer is at capacity"""
+
+
+class WriteBehindBuffer:
+    """
+    Coalesces session writes and hands them to ``commit(writes)`` in batches.
+
+    It has the same write methods as FirestoreStore, so handlers can use either.
+
+        Args:
+            commit: Coroutine function applying up to MAX_BATCH_WRITES writes atomically
+            flush_interval: Seconds between flushes
+            max_pending: Number of buffered operations that triggers an early flush
+            max_buffered: Number of buffered operations past which writes are refused
+            max_attempts: Failed commits after which a write is dropped
+    """
+
+    def __init__(
+        self,
+        commit: Callable[[List[SessionWrite]], Awaitable[None]],
+        flush_interval: float = 0.05,
+        max_pending: int = 100,
+        max_buffered: int = 10000,
+        max_attempts: int = 5,
+    ):
+        self.commit = commit
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_buffered = max_buffered
+        self.max_attempts = max_attempts
+        self.operations = 0
+        self.flushes = 0
+        self.documents_written = 0
+        self.failures = 0
+        self.dropped = 0
+        self.rejected = 0
+        self._flush_seconds = deque(maxlen=1000)
+        self._batch_sizes = deque(maxlen=1000)
+        self._pending: Dict[Tuple[str, Tuple[str, str]], SessionWrite] = {}
+        self._pending_operations = 0
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._full: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._running = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self) -> None:
+        """
+        Starts the periodic flush on the running event loop, which writes must then be made from
+        """
+        if self._flusher is not None:
+            await self.stop()
+        self._loop = asyncio.get_running_loop()
+        self._flush_lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._running = True
+        self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def stop(self) -> None:
+        """
+        Stops the periodic flush and writes out whatever is still pending
+        """
+        # wait_for can swallow a cancellation that races with the event, so the loop also checks this flag
+        self._running = False
+        if self._loop is asyncio.get_running_loop():
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            await self.flush()
+        # A flusher started on another loop ended when that loop was closed, and what it
+        # left pending is flushed once the buffer is started again
+        self._flusher = None
+        self._loop = None
+
+    async def join(self) -> None:
+        """
+        Flushes every pending write now
+        """
+        await self.flush()
+
+    def _buffer(self, session_id: str, kind: Tuple[str, str]) -> SessionWrite:
+        """
+        Returns the pending write of a document, adding one if there is none
+
+            Raises:
+                BufferFull: If max_buffered operations are waiting
+                RuntimeError: If the buffer isn't started on the running event loop
+        """
+        if self._loop is not asyncio.get_running_loop():
+            raise RuntimeError("The write-behind buffer isn't started on this event loop")
+
+        if self._pending_operations >= self.max_buffered:
+            self.rejected += 1
+            WRITE_BEHIND_REJECTED.inc()
+            raise BufferFull(f"Write-behind buffer is full ({self.max_buffered} operations waiting)")
+
+        key = (session_id, kind)
+        write = self._pending.get(key)
+        if write is None:
+            write = self._pending[key] = SessionWrite(session_id, kind)
+        self.operations += 1
+        self._set_pending(self._pending_operations + 1)
+        if self._pending_operations >= self.max_pending:
+            self._full.set()
+        return write
+
+    def _set_pending(self, operations: int) -> None:
+        self._pending_operations = operations
+        WRITE_BEHIND_PENDING.set((), operations)
+
+    async def set_session_document(self, session_id: str, kind: Tuple[str, str], data: dict) -> None:
+        self._buffer(session_id, kind).set(data)
+
+    async def append_to_session_array(self, session_id: str, kind: Tuple[str, str], field: str, values: list) -> None:
+        self._buffer(session_id, kind).append(field, values, datetime.now().isoformat())
+
+    async def _flush_forever(self) -> None:
+        while self._running:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            writes = list(self._pending.values())
+            self._pending = {}
+            self._set_pending(0)
+
+            retry = []
+            for start in range(0, len(writes), MAX_BATCH_WRITES):
+                batch = writes[start:start + MAX_BATCH_WRITES]
+                try:
+                    retry.extend(await self._commit(batch))
+                except CircuitOpen:
+                    # The store is down and failed fast, the writes wait for it here
+                    WRITE_BEHIND_FLUSHES.inc(("circuit_open",))
+                    retry.extend(writes[start:])
+                    break
+            self._requeue(retry)
+
+    async def _commit(self, batch: List[SessionWrite]) -> List[SessionWrite]:
+        """
+        Commits a batch, splitting it in halves if it fails, and returns the writes to retry
+
+            Raises:
+                CircuitOpen: If the store failed fast before any of the batch was tried
+        """
+        started = time.monotonic()
+        try:
+            await self.commit(batch)
+        except CircuitOpen:
+            raise
+        except Exception as e:
+            self.failures += 1
+            WRITE_BEHIND_FLUSHES.inc(("failed",))
+            if len(batch) == 1:
+                return self._failed(batch[0], e)
+            logger.warning(f"Failed to flush {len(batch)} session writes, splitting the batch: {str(e)}")
+            middle = len(batch) // 2
+            retry = []
+            for half in (batch[:middle], batch[middle:]):
+                try:
+                    retry.extend(await self._commit(half))
+                except CircuitOpen:
+                    retry.extend(half)
+            return retry
+        elapsed = time.monotonic() - started
+        self._flush_seconds.append(elapsed)
+        self._batch_sizes.append(len(batch))
+        WRITE_BEHIND_FLUSH_SECONDS.observe((), elapsed)
+        WRITE_BEHIND_BATCH_SIZE.observe((), len(batch))
+        self.flushes += 1
+        self.documents_written += len(batch)
+        WRITE_BEHIND_FLUSHES.inc(("committed",))
+        return []
+
+    def _failed(self, write: SessionWrite, error: Exception) -> List[SessionWrite]:
+        """
+        Counts a failed commit of a single write, returning it to retry unless it is out of attempts
+        """
+        write.attempts += 1
+        document = f"sessions/{write.session_id}/{write.kind[0]}/{write.kind[1]}"
+        if write.attempts >= self.max_attempts:
+            self.dropped += 1
+            WRITE_BEHIND_DROPPED.inc()
+            logger.error(
+                f"Dropping {write.operations} buffered writes to {document} after {write.attempts} attempts: {str(error)}"
+            )
+            return []
+        logger.error(f"Failed to flush the writes to {document}, retrying next flush: {str(error)}")
+        return [write]
+
+    def _requeue(self, writes: List[SessionWrite]) -> None:
+        """
+        Puts writes that weren't committed back in the buffer, under any change made since
+        """
+        for write in writes:
+            key = (write.session_id, write.kind)
+            later = self._pending.get(key)
+            if later is not None:
+                write.extend(later)
+            self._pending[key] = write
+        self._set_pending(sum(write.operations for write in self._pending.values()))
+
+    def stats(self) -> dict:
+        flush_seconds = list(self._flush_seconds)
+        batch_sizes = list(self._batch_sizes)
+        return {
+            "pending_documents": len(self._pending),
+            "pending_operations": self._pending_operations,
+            "operations": self.operations,
+            "flushes": self.flushes,
+            "documents_written": self.documents_written,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "flush_seconds_p50": statistics.median(flush_seconds) if flush_seconds else 0.0,
+            "flush_seconds_max": max(flush_seconds) if flush_seconds else 0.0,
+            "batch_size_p50": statistics.median(batch_sizes) if batch_sizes else 0,
+            "batch_size_max": max(batch_sizes) if batch_sizes else 0,
+        }